@@ -0,0 +1,52 @@
+"""Benchmark advertisement construction time and per object size
+
+Compares MopekaAdvertisement with CompactMopekaAdvertisement.
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import sys
+import timeit
+
+from mopeka_pro_check.advertisement import MopekaAdvertisement, CompactMopekaAdvertisement
+
+BLE_MOPEKA_MFG = bytes.fromhex(
+    "01 00 01 76 3C C4 05 9D E7 12  0D  FF  59  00  03  5D  31  2C  C1  C4  3C  76  3B  F9  03  02  E5  FE  A0")
+
+COUNT = 100000
+
+def object_size(o) -> int:
+  """ size of the object plus its attribute dict and attribute values.
+  The packet buffer is shared with the caller so it is not counted."""
+  size = sys.getsizeof(o)
+  d = getattr(o, "__dict__", None)
+  if d is not None:
+    size += sys.getsizeof(d)
+    size += sum(sys.getsizeof(v) for v in d.values() if v is not BLE_MOPEKA_MFG)
+  return size
+
+for cls in (MopekaAdvertisement, CompactMopekaAdvertisement):
+  elapsed = min(timeit.repeat(lambda: cls(BLE_MOPEKA_MFG), number=COUNT, repeat=3))
+  print(f"{cls.__name__:<28} {elapsed / COUNT * 1e6:>6.2f} us/construct  "
+        f"{object_size(cls(BLE_MOPEKA_MFG)):>5} bytes/object")
+
+# derived properties.  Formula is the pre lookup table implementation for reference
+from mopeka_pro_check.advertisement import MOPEKA_TANK_LEVEL_COEFFICIENTS_PROPANE as C
+
+def formula(ma):
+  level = int(ma._raw_tank_level * (C[0] + (C[1] * ma._raw_temp) + (C[2] * ma._raw_temp * ma._raw_temp)))
+  percent = (((ma._raw_battery / 32.0) - 2.2) / 0.65) * 100
+  percent = 100.0 if percent > 100.0 else 0.0 if percent < 0.0 else round(percent, 1)
+  return level, percent
+
+ma = MopekaAdvertisement(BLE_MOPEKA_MFG)
+cma = CompactMopekaAdvertisement(BLE_MOPEKA_MFG)
+for label, fn in (
+  ("formula", lambda: formula(ma)),
+  ("table (compact)", lambda: (cma.TankLevelInMM, cma.BatteryPercent)),
+  ("table + cache", lambda: (ma.TankLevelInMM, ma.BatteryPercent)),
+):
+  elapsed = min(timeit.repeat(fn, number=COUNT, repeat=3))
+  print(f"TankLevelInMM + BatteryPercent {label:<16} {elapsed / COUNT * 1e9:>6.0f} ns")
@@ -0,0 +1,33 @@
+"""Benchmark the vectorized batch decoder against per object decoding
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import time
+
+from mopeka_pro_check.advertisement import MopekaAdvertisement
+from mopeka_pro_check.batch import MopekaAdvertisementBatch
+
+BLE_MOPEKA_MFG = bytes.fromhex(
+    "01 00 01 76 3C C4 05 9D E7 12  0D  FF  59  00  03  5D  31  2C  C1  C4  3C  76  3B  F9  03  02  E5  FE  A0")
+
+COUNT = 200000
+
+packets = [BLE_MOPEKA_MFG] * COUNT
+payloads = BLE_MOPEKA_MFG[11:24] * COUNT
+
+start = time.perf_counter()
+for p in packets:
+  ma = MopekaAdvertisement(p)
+  (ma.TankLevelInMM, ma.TemperatureInCelsius, ma.BatteryPercent, ma.ReadingQualityStars)
+scalar = time.perf_counter() - start
+
+start = time.perf_counter()
+batch = MopekaAdvertisementBatch(payloads)
+(batch.TankLevelInMM, batch.TemperatureInCelsius, batch.BatteryPercent, batch.ReadingQualityStars)
+vector = time.perf_counter() - start
+
+print(f"Scalar {COUNT / scalar:>14,.0f} ads/sec")
+print(f"Batch  {COUNT / vector:>14,.0f} ads/sec  ({scalar / vector:.0f}x)")
@@ -0,0 +1,44 @@
+"""Benchmark duplicate advertisement suppression
+
+Sensors repeat each payload many times.  Replays traffic from monitored
+sensors where each payload is repeated and compares the service with
+DeduplicateReadings on and off.
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import time
+
+from mopeka_pro_check.replay import MakeMopekaPacket, Replay
+from mopeka_pro_check.service import MopekaService, MopekaSensor
+
+SENSORS = 20
+REPEATS = 10
+MACS = ["E7:9D:05:C4:00:%02X" % i for i in range(SENSORS)]
+
+records = []
+for level in range(1000):
+  for _ in range(REPEATS):
+    for i, mac in enumerate(MACS):
+      records.append((0.0, MakeMopekaPacket(mac, raw_level=level + i, rssi=-60 - (level % 7))))
+
+
+def run(dedup: bool) -> float:
+  best = float("inf")
+  for _ in range(3):
+    service = MopekaService()
+    service.DeduplicateReadings = dedup
+    service.AddSensorsToMonitor(MopekaSensor(m) for m in MACS)
+    start = time.perf_counter()
+    Replay(service, records)
+    best = min(best, time.perf_counter() - start)
+  return best
+
+
+off = run(False)
+on = run(True)
+print(f"{len(records):,} packets, each payload repeated {REPEATS} times")
+print(f"Deduplicate off {len(records) / off:>12,.0f} pkt/s")
+print(f"Deduplicate on  {len(records) / on:>12,.0f} pkt/s  ({off / on:.1f}x)")
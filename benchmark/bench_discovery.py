@@ -0,0 +1,71 @@
+"""Benchmark discovery mode caches
+
+Replays traffic from many non Mopeka devices (with manufacturer data) and
+Mopeka sensors whose sync button is not pressed.  Compares filtered mode,
+discovery mode with the caches and discovery mode without them.
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import random
+import time
+
+from mopeka_pro_check.replay import MakeMopekaPacket, Replay
+from mopeka_pro_check.service import MopekaService, MopekaSensor
+
+SENSORS = 20
+FOREIGN = 200
+PACKETS = 200000
+MACS = ["E7:9D:05:C4:00:%02X" % i for i in range(SENSORS)]
+
+rng = random.Random(0)
+foreign = []
+for _ in range(FOREIGN):
+  # 0x004C (Apple) mfg data like most phones and beacons send
+  mac = bytes(rng.getrandbits(8) for _ in range(6))
+  foreign.append(bytes([0x01, 0x00, 0x01]) + mac + bytes([0x0D, 0x02, 0x01, 0x06, 0x09, 0xFF, 0x4C, 0x00, 0x10, 0x05, 0x01, 0x18, 0x2A, 0x3B, 0xB0]))
+
+records = []
+for i in range(PACKETS):
+  if rng.random() < 0.1:
+    data = MakeMopekaPacket(rng.choice(MACS), raw_level=rng.randrange(0x3FFF))
+  else:
+    data = rng.choice(foreign)
+  records.append((0.0, data))
+
+
+def run(make) -> float:
+  best = float("inf")
+  for _ in range(3):
+    service = make()
+    start = time.perf_counter()
+    Replay(service, records)
+    best = min(best, time.perf_counter() - start)
+  return best, service
+
+
+def filtered():
+  service = MopekaService()
+  service.AddSensorsToMonitor(MopekaSensor(m) for m in MACS)
+  return service
+
+
+def discovery(cache_size):
+  def make():
+    service = MopekaService()
+    service.DiscoveryCacheSize = cache_size
+    service.DoSensorDiscovery()
+    return service
+  return make
+
+
+f, _ = run(filtered)
+off, _ = run(discovery(0))
+on, service = run(discovery(4096))
+print(f"{len(records):,} packets, {SENSORS} sensors without sync button, {FOREIGN} other devices")
+print(f"Filtered mode            {len(records) / f:>12,.0f} pkt/s")
+print(f"Discovery without cache  {len(records) / off:>12,.0f} pkt/s")
+print(f"Discovery with cache     {len(records) / on:>12,.0f} pkt/s  ({off / on:.1f}x)")
+print(service.DiscoveryCacheStats)
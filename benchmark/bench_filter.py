@@ -0,0 +1,96 @@
+"""Benchmark tank level filtering
+
+Replays noisy traffic from monitored sensors: a slowly falling level with
+measurement noise, low quality readings that read far off and bursts where
+the tank is moved (accelerometer off its resting value and a wild level).
+Reports packet rate and the error of the raw and filtered level against
+the true level for each filter mode.
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import math
+import random
+import time
+
+from mopeka_pro_check.filters import FilterMode, LevelFilter
+from mopeka_pro_check.profiles import PROPANE
+from mopeka_pro_check.replay import MakeMopekaPacket, Replay
+from mopeka_pro_check.service import MopekaService, MopekaSensor
+
+SENSORS = 20
+READINGS = 5000
+MACS = ["E7:9D:05:C4:00:%02X" % i for i in range(SENSORS)]
+RAW_TEMP = 0x31
+# raw level to mm at the temperature of every packet
+FACTOR = PROPANE.LevelFactors[RAW_TEMP]
+
+rng = random.Random(0)
+records = []
+truth = []
+for n in range(READINGS):
+  for i, mac in enumerate(MACS):
+    level = 1500 - n * 0.1 + i
+    quality = 3
+    accel = 0x3B
+    raw = level + rng.gauss(0, 4)
+    r = rng.random()
+    if r < 0.05:
+      quality = rng.choice((0, 1))
+      raw = level + rng.uniform(-400, 400)
+    elif n % 500 < 10:
+      # accelerometer swings while the tank is carried
+      accel = 0x3B + rng.randint(20, 60)
+      raw = level + rng.uniform(-600, 600)
+    records.append((0.0, MakeMopekaPacket(mac, raw_level=int(raw), raw_temp=RAW_TEMP, quality=quality, x_accel=accel)))
+    truth.append(level)
+
+
+def make_service(make_filter) -> MopekaService:
+  service = MopekaService()
+  sensors = [MopekaSensor(m) for m in MACS]
+  for sensor in sensors:
+    sensor.Forecast = None
+    sensor.Filter = make_filter()
+  service.AddSensorsToMonitor(sensors)
+  return service
+
+
+def rate(make_filter) -> float:
+  best = float("inf")
+  for _ in range(3):
+    service = make_service(make_filter)
+    start = time.perf_counter()
+    Replay(service, records)
+    best = min(best, time.perf_counter() - start)
+  return len(records) / best
+
+
+def rms_error(make_filter) -> float:
+  """ error of the level a reading callback sees against the true level """
+  service = make_service(make_filter)
+  service.DeduplicateReadings = False
+  errors = []
+  expected = iter(truth)
+
+  def on_reading(sensor, reading):
+    level = next(expected) * FACTOR
+    value = reading.TankLevelInMM if sensor.Filter is None else sensor.FilteredLevelInMM
+    if value is not None:
+      errors.append(value - level)
+
+  service.AddReadingCallback(on_reading)
+  Replay(service, records)
+  return math.sqrt(sum(e * e for e in errors) / len(errors))
+
+
+print(f"{len(records):,} packets from {SENSORS} sensors")
+for name, factory in (
+  ("no filter", lambda: None),
+  ("median", lambda: LevelFilter(FilterMode.MEDIAN)),
+  ("ewma", lambda: LevelFilter(FilterMode.EWMA)),
+  ("median, no tilt", lambda: LevelFilter(FilterMode.MEDIAN, tilt_threshold=None)),
+):
+  print(f"{name:<16} {rate(factory):>12,.0f} pkt/s   rms error {rms_error(factory):8.1f} mm")
@@ -0,0 +1,33 @@
+"""Benchmark the cost of packets the service ignores
+
+Reports ignored packets per second in filtered and discovery mode
+using synthetic hci packets (no BLE adapter required).
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import timeit
+from types import SimpleNamespace
+
+from mopeka_pro_check.service import MopekaService, MopekaSensor
+
+BLE_NOT_MOPEKA = bytes.fromhex(
+    "01 00 01 3b 69 19 46 88 c0 19 02 01 02 11 09 44 56 33 33 30 30 53 2d 34 2e 30 2d 30 39 33 42 03 03 32 a0 a2")
+
+COUNT = 200000
+
+def run(service: MopekaService, label: str) -> None:
+  packet = SimpleNamespace(data=BLE_NOT_MOPEKA)
+  process = service.ProcessAdvertisementPacket
+  elapsed = min(timeit.repeat(lambda: process(packet), number=COUNT, repeat=3))
+  print(f"{label:<16} {COUNT / elapsed:>12,.0f} ignored packets/sec")
+
+service = MopekaService()
+service.AddSensorToMonitor(MopekaSensor("e7:9d:05:c4:3c:76"))
+run(service, "Filtered mode")
+
+service = MopekaService()
+service.DoSensorDiscovery()
+run(service, "Discovery mode")
@@ -0,0 +1,34 @@
+"""Benchmark the overhead of service metrics
+
+Replays synthetic traffic with metrics enabled and disabled.
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import time
+
+from mopeka_pro_check.replay import GenerateTraffic, Replay
+from mopeka_pro_check.service import MopekaService, MopekaSensor
+
+COUNT = 200000
+MACS = ["E7:9D:05:C4:00:%02X" % i for i in range(20)]
+
+def run_once(enable: bool, records) -> float:
+  service = MopekaService()
+  service.EnableMetrics(enable)
+  service.AddSensorsToMonitor(MopekaSensor(m) for m in MACS)
+  start = time.perf_counter()
+  Replay(service, records)
+  return time.perf_counter() - start
+
+for ratio in (0.01, 0.1, 0.5):
+  records = GenerateTraffic(COUNT, MACS, mopeka_ratio=ratio)
+  # interleave runs and keep the best of each to reduce noise
+  off = on = float("inf")
+  for _ in range(7):
+    off = min(off, run_once(False, records))
+    on = min(on, run_once(True, records))
+  print(f"Mopeka ratio {ratio:4.2f}:  off {COUNT / off:>10,.0f} pkt/s  on {COUNT / on:>10,.0f} pkt/s  "
+        f"overhead {(on - off) / off * 100:5.1f}%")
@@ -0,0 +1,42 @@
+"""Benchmark exception based parsing against TryParse on mixed traffic
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import time
+
+from mopeka_pro_check.advertisement import MopekaAdvertisement
+from mopeka_pro_check.replay import GenerateTraffic
+
+COUNT = 200000
+MACS = ["E7:9D:05:C4:00:%02X" % i for i in range(20)]
+
+
+def constructor(packets):
+  for data in packets:
+    try:
+      MopekaAdvertisement(data)
+    except Exception:
+      pass
+
+
+def try_parse(packets):
+  parse = MopekaAdvertisement.TryParse
+  for data in packets:
+    parse(data)
+
+
+for ratio in (0.01, 0.1, 0.5):
+  packets = [data for _, data in GenerateTraffic(COUNT, MACS, mopeka_ratio=ratio)]
+  results = {}
+  for fn in (constructor, try_parse):
+    best = float("inf")
+    for _ in range(3):
+      start = time.perf_counter()
+      fn(packets)
+      best = min(best, time.perf_counter() - start)
+    results[fn.__name__] = best
+  print(f"Mopeka ratio {ratio:4.2f}:  constructor {COUNT / results['constructor']:>10,.0f} pkt/s  "
+        f"TryParse {COUNT / results['try_parse']:>10,.0f} pkt/s")
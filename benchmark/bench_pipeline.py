@@ -0,0 +1,82 @@
+"""Replay driven scaling benchmark for the multiprocess parsing pipeline
+
+Replays a capture (or synthetic traffic from many monitored sensors with
+no repeated payloads) through the service parsing inline and through a
+ParsingPipeline with 1..N workers.  Reports how fast the adapter callback
+returns (what decides whether the kernel drops HCI events) and the end to
+end rate until every reading has been delivered.
+
+    python benchmark/bench_pipeline.py [--capture FILE] [--count N] [--sensors N] [--max-workers N]
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import argparse
+import os
+import time
+
+from mopeka_pro_check.pipeline import ParsingPipeline
+from mopeka_pro_check.replay import LoadCapture, GenerateTraffic, Replay
+from mopeka_pro_check.advertisement import CompactMopekaAdvertisement
+from mopeka_pro_check.service import MopekaService, MopekaSensor
+
+
+def make_service(macs):
+  service = MopekaService()
+  service.AddSensorsToMonitor(MopekaSensor(m) for m in macs)
+  return service
+
+
+def report(label, count, callback, total, dropped=0):
+  print(f"{label:<12} callback {count / callback:>12,.0f} pkt/s   end to end {count / total:>12,.0f} pkt/s"
+        + (f"   dropped {dropped:,}" if dropped else ""))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--capture", help="btsnoop or CaptureWriter file")
+  parser.add_argument("--count", type=int, default=200000)
+  parser.add_argument("--sensors", type=int, default=500)
+  parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+  args = parser.parse_args()
+
+  macs = ["E7:9D:05:%02X:%02X:%02X" % (i >> 16, (i >> 8) & 0xFF, i & 0xFF) for i in range(args.sensors)]
+  if args.capture:
+    records = LoadCapture(args.capture)
+    macs = sorted({CompactMopekaAdvertisement(d).mac.address for _, d in records if _is_mopeka(d)})
+  else:
+    records = GenerateTraffic(args.count, macs, mopeka_ratio=0.9)
+
+  print(f"{len(records):,} packets, {len(macs)} monitored sensors, {os.cpu_count()} cpus")
+
+  service = make_service(macs)
+  start = time.perf_counter()
+  Replay(service, records)
+  elapsed = time.perf_counter() - start
+  report("inline", len(records), elapsed, elapsed)
+
+  workers = 1
+  while workers <= args.max_workers:
+    service = make_service(macs)
+    with ParsingPipeline(service, workers=workers, ring_size=1 << 16) as pipeline:
+      start = time.perf_counter()
+      Replay(service, records)
+      callback = time.perf_counter() - start
+      pipeline.Flush(timeout=600)
+      total = time.perf_counter() - start
+    report(f"{workers} workers", len(records), callback, total, pipeline.DroppedCount)
+    workers *= 2
+
+
+def _is_mopeka(data):
+  try:
+    CompactMopekaAdvertisement(data)
+    return True
+  except Exception:
+    return False
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,104 @@
+"""Replay driven throughput benchmark
+
+Feeds a capture file (btsnoop or simple capture format) or synthetic
+traffic through the service and reports packets/sec and per packet
+latency percentiles for filtered mode, discovery mode and the parser alone.
+
+    python benchmark/bench_replay.py [--capture FILE] [--count N] [--ratio R] [--sensors N]
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import argparse
+import time
+
+from mopeka_pro_check.advertisement import MopekaAdvertisement, IsMopekaAdvertisement
+from mopeka_pro_check.replay import LoadCapture, GenerateTraffic, Replay, ReplayPacket
+from mopeka_pro_check.service import MopekaService, MopekaSensor
+
+
+def percentiles(samples, points=(50, 90, 99, 99.9)):
+  samples = sorted(samples)
+  return [samples[min(len(samples) - 1, int(len(samples) * p / 100))] for p in points]
+
+
+def report(label, count, elapsed, latencies_ns):
+  p50, p90, p99, p999 = (x / 1000 for x in percentiles(latencies_ns))
+  print(f"{label:<10} {count / elapsed:>12,.0f} pkt/s   "
+        f"p50 {p50:6.2f}us  p90 {p90:6.2f}us  p99 {p99:6.2f}us  p99.9 {p999:6.2f}us")
+
+
+def latencies(handler, packets):
+  out = []
+  clock = time.perf_counter_ns
+  for p in packets:
+    start = clock()
+    handler(p)
+    out.append(clock() - start)
+  return out
+
+
+def bench_service(label, make_service, records):
+  service = make_service()
+  start = time.perf_counter()
+  Replay(service, records)
+  elapsed = time.perf_counter() - start
+
+  service = make_service()
+  packets = [ReplayPacket(data) for _, data in records]
+  report(label, len(records), elapsed, latencies(service.HandleMetaEvent, packets))
+
+
+def parse(data):
+  try:
+    return MopekaAdvertisement(data)
+  except Exception:
+    return None
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("--capture", help="capture file to replay instead of synthetic traffic")
+  parser.add_argument("--count", type=int, default=200000, help="synthetic packet count")
+  parser.add_argument("--ratio", type=float, default=0.1, help="synthetic fraction of Mopeka packets")
+  parser.add_argument("--sensors", type=int, default=20, help="synthetic Mopeka sensor count")
+  args = parser.parse_args()
+
+  macs = ["E7:9D:05:C4:%02X:%02X" % (i >> 8, i & 0xFF) for i in range(args.sensors)]
+  if args.capture:
+    records = LoadCapture(args.capture)
+  else:
+    records = GenerateTraffic(args.count, macs, mopeka_ratio=args.ratio)
+
+  def filtered():
+    service = MopekaService()
+    if args.capture:
+      # monitor every Mopeka sensor found in the capture
+      found = {parse(d).mac.address for _, d in records if IsMopekaAdvertisement(d) and parse(d)}
+      service.AddSensorsToMonitor(MopekaSensor(m) for m in found)
+    else:
+      service.AddSensorsToMonitor(MopekaSensor(m) for m in macs)
+    return service
+
+  def discovery():
+    service = MopekaService()
+    service.DoSensorDiscovery()
+    return service
+
+  print(f"{len(records):,} packets")
+  bench_service("filtered", filtered, records)
+  bench_service("discovery", discovery, records)
+
+  mopeka = [d for _, d in records if IsMopekaAdvertisement(d)]
+  if mopeka:
+    start = time.perf_counter()
+    for d in mopeka:
+      parse(d)
+    elapsed = time.perf_counter() - start
+    report("parser", len(mopeka), elapsed, latencies(parse, mopeka))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,88 @@
+"""Benchmark the HTTP state endpoint
+
+A scanning thread feeds packets for many sensors as fast as it can while
+clients poll /state (with If-None-Match) over kept alive connections.
+Reports polls per second and the scanning rate with and without polling.
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import argparse
+import asyncio
+import threading
+import time
+
+from mopeka_pro_check.replay import MakeMopekaPacket, ReplayPacket
+from mopeka_pro_check.server import StateServer
+from mopeka_pro_check.service import MopekaService, MopekaSensor
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--sensors", type=int, default=500)
+parser.add_argument("--clients", type=int, default=8)
+parser.add_argument("--seconds", type=float, default=3.0)
+parser.add_argument("--packet-rate", type=float, default=200.0, help="packets per second.  0 is as fast as possible")
+args = parser.parse_args()
+
+MACS = ["E7:9D:05:%02X:%02X:%02X" % (i >> 16, (i >> 8) & 0xFF, i & 0xFF) for i in range(args.sensors)]
+PACKETS = [ReplayPacket(MakeMopekaPacket(mac, raw_level=1000 + n)) for n in range(8) for mac in MACS]
+
+
+def scan(service: MopekaService, stop: threading.Event, counter: list) -> None:
+  interval = 1.0 / args.packet_rate if args.packet_rate else 0.0
+  next_time = time.perf_counter()
+  i = 0
+  while not stop.is_set():
+    service.ProcessAdvertisementPacket(PACKETS[i % len(PACKETS)])
+    i += 1
+    if interval:
+      next_time += interval
+      delay = next_time - time.perf_counter()
+      if delay > 0:
+        time.sleep(delay)
+  counter.append(i)
+
+
+async def poll(port: int, stop: asyncio.Event, counts: dict) -> None:
+  reader, writer = await asyncio.open_connection("127.0.0.1", port)
+  etag = ""
+  while not stop.is_set():
+    writer.write(f"GET /state HTTP/1.1\r\nHost: bench\r\nIf-None-Match: {etag}\r\n\r\n".encode("ascii"))
+    head = await reader.readuntil(b"\r\n\r\n")
+    headers = dict(line.split(": ", 1) for line in head.decode("ascii").split("\r\n")[1:] if ": " in line)
+    etag = headers["ETag"]
+    if head.startswith(b"HTTP/1.1 304"):
+      counts["304"] += 1
+    else:
+      await reader.readexactly(int(headers["Content-Length"]))
+      counts["200"] += 1
+  writer.close()
+
+
+async def run(polling: bool):
+  service = MopekaService()
+  service.AddSensorsToMonitor(MopekaSensor(m) for m in MACS)
+  counts = {"200": 0, "304": 0}
+  scanned = []
+  stop_scan = threading.Event()
+  async with StateServer(service, port=0) as server:
+    thread = threading.Thread(target=scan, args=(service, stop_scan, scanned))
+    thread.start()
+    stop = asyncio.Event()
+    clients = [asyncio.ensure_future(poll(server.Port, stop, counts)) for _ in range(args.clients if polling else 0)]
+    await asyncio.sleep(args.seconds)
+    stop.set()
+    stop_scan.set()
+    await asyncio.gather(*clients)
+    thread.join()
+    return scanned[0] / args.seconds, counts, server.RenderCount
+
+
+idle_rate, _, _ = asyncio.run(run(False))
+busy_rate, counts, renders = asyncio.run(run(True))
+polls = counts["200"] + counts["304"]
+print(f"{args.sensors:,} sensors, {args.clients} clients, {args.seconds:g}s")
+print(f"Polls      {polls / args.seconds:10,.0f} /s  ({counts['304'] / max(polls, 1):.0%} not modified, {renders} renders)")
+print(f"Scan alone {idle_rate:10,.0f} packets/s")
+print(f"Scan+polls {busy_rate:10,.0f} packets/s")
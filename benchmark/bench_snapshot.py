@@ -0,0 +1,49 @@
+"""Benchmark service snapshot and restore
+
+Fills a service with monitored sensors that each have a full reading
+history, then times SnapshotService and RestoreService into a new service.
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import argparse
+import time
+
+from mopeka_pro_check.replay import MakeMopekaPacket, Replay
+from mopeka_pro_check.service import MopekaService, MopekaSensor
+from mopeka_pro_check.snapshot import RestoreService, SnapshotService
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--sensors", type=int, default=1000)
+parser.add_argument("--history", type=int, default=64, help="readings kept per sensor")
+args = parser.parse_args()
+
+MACS = ["E7:9D:05:%02X:%02X:%02X" % (i >> 16, (i >> 8) & 0xFF, i & 0xFF) for i in range(args.sensors)]
+
+service = MopekaService()
+service.AddSensorsToMonitor(MopekaSensor(m, args.history) for m in MACS)
+records = [
+  (0.0, MakeMopekaPacket(mac, raw_level=1000 + n + i % 100))
+  for n in range(args.history)
+  for i, mac in enumerate(MACS)
+]
+Replay(service, records)
+
+
+def best(fn, repeat: int = 5) -> float:
+  times = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    times.append(time.perf_counter() - start)
+  return min(times)
+
+
+data = SnapshotService(service)
+save = best(lambda: SnapshotService(service))
+load = best(lambda: RestoreService(MopekaService(), data))
+print(f"{args.sensors:,} sensors, {args.history} readings each, snapshot {len(data) / 1024:,.0f} KiB")
+print(f"Snapshot {save * 1000:8.1f} ms")
+print(f"Restore  {load * 1000:8.1f} ms")
@@ -0,0 +1,12 @@
+"""python -m mopeka_pro_check
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import sys
+
+from .cli import main
+
+sys.exit(main())
@@ -5,19 +5,28 @@ Copyright (c) 2021 Sean Brogan
 SPDX-License-Identifier: MIT
 
 """
-from enum import Enum
+from enum import Enum, IntEnum
 import logging
-from typing import Optional
+from typing import Optional, Tuple, TYPE_CHECKING
 
-from bleson import BDAddress
-from bleson.core.hci.type_converters import rssi_from_byte
-from bleson.core.hci.constants import GAP_MFG_DATA, GAP_NAME_COMPLETE
+from .hci import GAP_MFG_DATA, GAP_NAME_COMPLETE, rssi_from_byte, ToBDAddress
+
+if TYPE_CHECKING:
+    from bleson import BDAddress
 
 # converting sensor value to height - contact Mopeka for other fluids/gases
 MOPEKA_TANK_LEVEL_COEFFICIENTS_PROPANE = (0.573045, -0.002822, -0.00000535)
+MOPEKA_TANK_LEVEL_COEFFICIENTS_AIR = (0.153096, 0.000327, -0.000000294)
+MOPEKA_TANK_LEVEL_COEFFICIENTS_WATER = (0.600592, 0.003124, -0.00001368)
 
 MOPEKA_MANUFACTURE_ID = 0x0059
 
+MOPEKA_MFG_DATA_LENGTH = 13
+""" Length of the Mopeka GAP_MFG_DATA report including the type byte """
+
+_GAP_DATA_OFFSET = 10
+""" Offset of the first GAP report within the HCI advertising report """
+
 _LOGGER = logging.getLogger(__name__)
 
 class NoGapDataException(Exception):
@@ -27,6 +36,34 @@ class NoGapDataException(Exception):
     pass
 
 
+def MacToRaw(mac: str) -> bytes:
+    """ "AA:BB:CC:DD:EE:FF" to the 6 little endian bytes used in hci packets """
+    return bytes(reversed(bytes.fromhex(mac.replace(":", ""))))
+
+
+def IsMopekaAdvertisement(data: bytes) -> bool:
+    """ Cheap check that an HCI advertising report carries Mopeka mfg data.
+
+    Walks the GAP reports in place looking for a GAP_MFG_DATA report of the
+    expected length with the Mopeka manufacturer id.  No objects are created
+    so this can be used to reject foreign packets before parsing.
+    """
+    end = len(data) - 1  # last byte is rssi
+    offset = _GAP_DATA_OFFSET
+    while offset < end:
+        length = data[offset]
+        if (
+            length == MOPEKA_MFG_DATA_LENGTH
+            and offset + 4 <= end
+            and data[offset + 1] == GAP_MFG_DATA
+            and data[offset + 2] == (MOPEKA_MANUFACTURE_ID & 0xFF)
+            and data[offset + 3] == (MOPEKA_MANUFACTURE_ID >> 8)
+        ):
+            return True
+        offset += 1 + length
+    return False
+
+
 class HardwareId(Enum):
     """ definition of the known Mopeka hardware ids."""
     STD_BOTTOM_UP_PROPANE = 0x3
@@ -34,7 +71,182 @@ class HardwareId(Enum):
     BOTTOM_UP_WATER = 0x5
 
 
-class MopekaAdvertisement(object):
+_HARDWARE_IDS = {h.value: h for h in HardwareId}
+
+
+class ParseStatus(IntEnum):
+    """ Result of MopekaAdvertisement.TryParse """
+    OK = 0
+    NO_GAP_DATA = 1
+    """ packet has no GAP data.  Mopeka sensors send these, not an error """
+    NO_MFG_DATA = 2
+    """ packet has no GAP_MFG_DATA report """
+    UNSUPPORTED_LENGTH = 3
+    UNSUPPORTED_MANUFACTURER = 4
+    UNSUPPORTED_HARDWARE = 5
+
+
+def _scan_gap(data: bytes) -> Tuple[ParseStatus, int, int]:
+    """ Validate the GAP reports of an hci packet without raising.
+
+    Returns (status, offset, name_offset).  offset is the type byte of the
+    mfg data report (or of the offending report on failure).  name_offset
+    is the type byte of the GAP_NAME_COMPLETE report or -1.
+    """
+    end = len(data) - 1  # last byte is rssi
+    if end <= _GAP_DATA_OFFSET:
+        return (ParseStatus.NO_GAP_DATA, -1, -1)
+
+    mfg_offset = -1
+    name_offset = -1
+    offset = _GAP_DATA_OFFSET
+    while offset < end:
+        length = data[offset]
+        if length > 0:
+            gap_type = data[offset + 1]
+            if gap_type == GAP_MFG_DATA:
+                if min(length, end - offset - 1) != MOPEKA_MFG_DATA_LENGTH:
+                    return (ParseStatus.UNSUPPORTED_LENGTH, offset + 1, name_offset)
+                if data[offset + 2] + (data[offset + 3] << 8) != MOPEKA_MANUFACTURE_ID:
+                    return (ParseStatus.UNSUPPORTED_MANUFACTURER, offset + 1, name_offset)
+                if data[offset + 4] not in HARDWARE_LEVEL_FACTOR_TABLES:
+                    return (ParseStatus.UNSUPPORTED_HARDWARE, offset + 1, name_offset)
+                mfg_offset = offset + 1
+            elif gap_type == GAP_NAME_COMPLETE:
+                name_offset = offset + 1
+        offset += 1 + length
+
+    if mfg_offset < 0:
+        return (ParseStatus.NO_MFG_DATA, -1, name_offset)
+    return (ParseStatus.OK, mfg_offset, name_offset)
+
+
+def _parse_exception(status: ParseStatus, data: bytes, offset: int) -> Exception:
+    """ Exception matching what MopekaAdvertisement raises for a failed status """
+    if status == ParseStatus.NO_GAP_DATA:
+        return NoGapDataException("No GAP data")
+    if status == ParseStatus.UNSUPPORTED_LENGTH:
+        length = min(data[offset - 1], len(data) - 1 - offset)
+        return Exception(f"Unsupported Data Length (0x{length:X})")
+    if status == ParseStatus.UNSUPPORTED_MANUFACTURER:
+        manufacturer_id = data[offset + 1] + (data[offset + 2] << 8)
+        return Exception(f"Advertising Data has Unsupported Manufacturer ID 0x{manufacturer_id}")
+    if status == ParseStatus.UNSUPPORTED_HARDWARE:
+        hardware_id = _HARDWARE_IDS.get(data[offset + 3], data[offset + 3])
+        return Exception(f"Advertising Data has Unsupported Hardware ID {hardware_id}")
+    return Exception("Incomplete Sensor Data")
+
+
+##
+## Conversion tables.  The raw temperature and battery fields are 7 bits so
+## every derived value is precomputed once at import with the same float
+## operations the formulas use, giving identical results.
+##
+def _battery_percent(raw_battery: int) -> float:
+    """Battery Percentage based on 3 volt CR2032 battery"""
+    percent = (((raw_battery / 32.0) - 2.2) / 0.65) * 100
+    if percent > 100.0:
+        return 100.0
+    if percent < 0.0:
+        return 0.0
+    return round(percent, 1)
+
+
+def _tank_level_factor(coefficients: Tuple[float, float, float], raw_temp: int) -> float:
+    """ temperature compensated multiplier converting raw tank level to mm """
+    return coefficients[0] + (coefficients[1] * raw_temp) + (coefficients[2] * raw_temp * raw_temp)
+
+
+BATTERY_PERCENT_TABLE = tuple(_battery_percent(b) for b in range(128))
+""" BatteryPercent indexed by the 7 bit raw battery value """
+
+TEMPERATURE_FAHRENHEIT_TABLE = tuple((((t - 40) * 9) / 5) + 32 for t in range(128))
+""" TemperatureInFahrenheit indexed by the 7 bit raw temperature value """
+
+def BuildLevelFactorTable(coefficients: Tuple[float, float, float]) -> Tuple[float, ...]:
+    """ raw tank level to mm multipliers indexed by the 7 bit raw temperature value """
+    return tuple(_tank_level_factor(coefficients, t) for t in range(128))
+
+
+TANK_LEVEL_FACTOR_PROPANE_TABLE = BuildLevelFactorTable(MOPEKA_TANK_LEVEL_COEFFICIENTS_PROPANE)
+""" Propane raw tank level to mm multiplier indexed by the 7 bit raw temperature value """
+
+HARDWARE_LEVEL_FACTOR_TABLES = {
+    HardwareId.STD_BOTTOM_UP_PROPANE.value: TANK_LEVEL_FACTOR_PROPANE_TABLE,
+    HardwareId.TOP_DOWN_AIR_SPACE.value: BuildLevelFactorTable(MOPEKA_TANK_LEVEL_COEFFICIENTS_AIR),
+    HardwareId.BOTTOM_UP_WATER.value: BuildLevelFactorTable(MOPEKA_TANK_LEVEL_COEFFICIENTS_WATER),
+}
+""" Default level multiplier table per supported hardware id.  Packets from
+hardware ids not listed are rejected.  See mopeka_pro_check.profiles """
+
+
+class _MopekaReadingMixin(object):
+    """ Derived values shared by the advertisement classes.
+
+    Subclasses provide rssi, SyncButtonPressed, ReadingQualityStars,
+    _raw_hardware_id, _raw_battery, _raw_temp, _raw_tank_level and _raw_mfg_data.
+    """
+
+    __slots__ = ()
+
+    @property
+    def BatteryVoltage(self) -> float:
+        """Battery reading in volts"""
+        return self._raw_battery / 32.0
+
+    @property
+    def BatteryPercent(self) -> float:
+        """Battery Percentage based on 3 volt CR2032 battery"""
+        return BATTERY_PERCENT_TABLE[self._raw_battery]
+
+    @property
+    def TemperatureInCelsius(self) -> int:
+        """Temperature in Celsius
+
+        Note: This temperature has not been characterized against ambient temperature
+        """
+        return self._raw_temp - 40
+
+    @property
+    def TemperatureInFahrenheit(self) -> float:
+        """Temperature in Fahrenheit
+
+        Note: This temperature has not been characterized against ambient temperature
+        """
+        return TEMPERATURE_FAHRENHEIT_TABLE[self._raw_temp]
+
+    @property
+    def TankLevelInMM(self) -> int:
+        """ The tank level/depth in mm using the default profile for the hardware id.
+        For STD_BOTTOM_UP_PROPANE this is the propane depth.  For TOP_DOWN_AIR_SPACE
+        it is the distance from the sensor to the fluid surface.
+        """
+        return int(self._raw_tank_level * HARDWARE_LEVEL_FACTOR_TABLES[self._raw_hardware_id][self._raw_temp])
+
+    @property
+    def TankLevelInInches(self) -> float:
+        """ The tank level/depth in inches"""
+        return round(self.TankLevelInMM / 25.4, 2)
+
+    def __str__(self) -> str:
+        return ("MopekaAdvertisement -  " +
+                f"RSSI: {self.rssi}dBm  " +
+                f"Battery: {self.BatteryVoltage} volts {self.BatteryPercent}%  " +
+                f"Button Pressed: {self.SyncButtonPressed}  " +
+                f"Temperature {self.TemperatureInCelsius}C {self.TemperatureInFahrenheit}F  " +
+                f"Confidence Stars {self.ReadingQualityStars}  " +
+                f"Fluid Height {self.TankLevelInMM} mm")
+
+    def Dump(self):
+        """ Helper routine that prints ad data plus all mfg data"""
+        print(self)
+        print("MfgData: ", end="")
+        for a in self._raw_mfg_data:
+            print("0x%02X" % a, end="  ")
+        print("\n")
+
+
+class MopekaAdvertisement(_MopekaReadingMixin):
     """ BLE GAP/Advertisement parser.
     Will parse a single packet with multiple GAP reports.
 
@@ -46,10 +258,15 @@ class MopekaAdvertisement(object):
 
     rssi: int
     name: Optional[str]
-    mac: BDAddress
 
     # Private Members
+    _raw_mac: bytes
     _raw_mfg_data: bytes
+    _mac: Optional["BDAddress"] = None
+
+    # decoded values cached on first access
+    _tank_level_mm: Optional[int] = None
+    _battery_percent: Optional[float] = None
 
     def __init__(self, data: bytes):
         """ init from ble advertising data
@@ -67,7 +284,7 @@ class MopekaAdvertisement(object):
         """
 
         self.rssi = rssi_from_byte(data[-1])
-        self.mac = BDAddress(data[3:9])
+        self._raw_mac = data[3:9]
         self.name = None
         self._raw_mfg_data = None
 
@@ -90,6 +307,51 @@ class MopekaAdvertisement(object):
             # Make sure we found the required MFG_DATA for Mopeka Sensor
             raise Exception("Incomplete Sensor Data")
 
+    @property
+    def mac(self) -> "BDAddress":
+        """ sensor address.  Built on first access """
+        mac = self._mac
+        if mac is None:
+            mac = self._mac = ToBDAddress(self._raw_mac)
+        return mac
+
+    @property
+    def TankLevelInMM(self) -> int:
+        """ The tank level/depth in mm, see _MopekaReadingMixin.TankLevelInMM """
+        level = self._tank_level_mm
+        if level is None:
+            level = self._tank_level_mm = _MopekaReadingMixin.TankLevelInMM.fget(self)
+        return level
+
+    @property
+    def BatteryPercent(self) -> float:
+        """Battery Percentage based on 3 volt CR2032 battery"""
+        percent = self._battery_percent
+        if percent is None:
+            percent = self._battery_percent = BATTERY_PERCENT_TABLE[self._raw_battery]
+        return percent
+
+    @classmethod
+    def TryParse(cls, data: bytes) -> Tuple[ParseStatus, Optional["MopekaAdvertisement"]]:
+        """ Parse without raising.
+
+        Returns (ParseStatus.OK, advertisement) on success otherwise
+        (status, None).  Much cheaper than catching the exceptions raised by
+        the constructor when most packets are not from a Mopeka sensor.
+        """
+        status, offset, name_offset = _scan_gap(data)
+        if status != ParseStatus.OK:
+            return (status, None)
+
+        self = cls.__new__(cls)
+        self.rssi = rssi_from_byte(data[-1])
+        self._raw_mac = data[3:9]
+        self.name = None
+        if name_offset >= 0:
+            self._process_gap_name_complete(data[name_offset : name_offset + data[name_offset - 1]])
+        self._process_gap_mfg_data(data[offset : offset + MOPEKA_MFG_DATA_LENGTH])
+        return (ParseStatus.OK, self)
+
     def _process_gap(self, data: bytes) -> None:
         """ Process supported BLE GAP reports.
 
@@ -111,7 +373,7 @@ class MopekaAdvertisement(object):
 
     def _process_gap_name_complete(self, data:bytes) -> None:
         """ process GAP data of type GAP_NAME_COMPLETE """
-        self.name = data[1:].decode("ascii")
+        self.name = data[1:].decode("ascii", errors="replace")
 
     def _process_gap_mfg_data(self, data:bytes) ->None:
         """ process GAP data of type GAP_MFG_DATA
@@ -120,7 +382,7 @@ class MopekaAdvertisement(object):
         """
 
         MfgDataLength = len(data)
-        if MfgDataLength != 13:
+        if MfgDataLength != MOPEKA_MFG_DATA_LENGTH:
             raise Exception(f"Unsupported Data Length (0x{MfgDataLength:X})")
 
         self.ManufacturerId = data[1] + (data[2] << 8)
@@ -129,11 +391,12 @@ class MopekaAdvertisement(object):
                 f"Advertising Data has Unsupported Manufacturer ID 0x{self.ManufacturerId}"
             )
 
-        self.HardwareId = HardwareId(data[3])
-        if self.HardwareId != HardwareId.STD_BOTTOM_UP_PROPANE:
+        if data[3] not in HARDWARE_LEVEL_FACTOR_TABLES:
             raise Exception(
-                f"Advertising Data has Unsupported Hardware ID {self.HardwareId}"
+                f"Advertising Data has Unsupported Hardware ID {_HARDWARE_IDS.get(data[3], data[3])}"
             )
+        self.HardwareId = HardwareId(data[3])
+        self._raw_hardware_id = data[3]
 
         self._raw_battery = data[4] & 0x7F
 
@@ -154,71 +417,105 @@ class MopekaAdvertisement(object):
         self._raw_mfg_data = data
 
 
+class CompactMopekaAdvertisement(_MopekaReadingMixin):
+    """ Memory compact BLE GAP/Advertisement parser.
+
+    Same validation and properties as MopekaAdvertisement but the packet is
+    not copied or decoded up front.  Only a reference to the packet buffer
+    and the offset of the mfg data are stored and every property decodes
+    from the buffer on access.  Intended for holding long reading histories.
+
+    The buffer must not be modified after the object is created.
+    """
+
+    __slots__ = ("_data", "_mfg_offset")
+
+    _data: bytes
+    _mfg_offset: int
+
+    def __init__(self, data: bytes):
+        """ init from ble advertising data.  See MopekaAdvertisement """
+        status, mfg_offset, _name_offset = _scan_gap(data)
+        if status != ParseStatus.OK:
+            raise _parse_exception(status, data, mfg_offset)
+
+        self._data = data
+        self._mfg_offset = mfg_offset
+
+    @classmethod
+    def FromMfgData(cls, raw_mac: bytes, mfg_data: bytes, rssi_byte: int) -> "CompactMopekaAdvertisement":
+        """ Build from an already validated 13 byte mfg data report, the 6 byte
+        mac as it appears in the hci packet and the raw rssi byte.  No validation """
+        self = cls.__new__(cls)
+        self._data = b"\x00\x00\x00" + raw_mac + b"\x0e\x0d" + mfg_data + bytes((rssi_byte,))
+        self._mfg_offset = _GAP_DATA_OFFSET + 1
+        return self
+
     @property
-    def BatteryVoltage(self) -> float:
-        """Battery reading in volts"""
-        return self._raw_battery / 32.0
+    def rssi(self) -> int:
+        return rssi_from_byte(self._data[-1])
 
     @property
-    def BatteryPercent(self) -> float:
-        """Battery Percentage based on 3 volt CR2032 battery"""
-        percent = ((self.BatteryVoltage - 2.2) / 0.65) * 100
-        if percent > 100.0:
-            return 100.0
-        if percent < 0.0:
-            return 0.0
-        return round(percent, 1)
+    def mac(self) -> "BDAddress":
+        return ToBDAddress(self._data[3:9])
 
     @property
-    def TemperatureInCelsius(self) -> int:
-        """Temperature in Celsius
+    def name(self) -> Optional[str]:
+        data = self._data
+        end = len(data) - 1
+        name = None
+        offset = _GAP_DATA_OFFSET
+        while offset < end:
+            length = data[offset]
+            if length > 0 and data[offset + 1] == GAP_NAME_COMPLETE:
+                name = bytes(data[offset + 2 : offset + 1 + length]).decode("ascii", errors="replace")
+            offset += 1 + length
+        return name
 
-        Note: This temperature has not been characterized against ambient temperature
-        """
-        return self._raw_temp - 40
+    @property
+    def ManufacturerId(self) -> int:
+        return MOPEKA_MANUFACTURE_ID
 
     @property
-    def TemperatureInFahrenheit(self) -> float:
-        """Temperature in Fahrenheit
+    def HardwareId(self) -> HardwareId:
+        return HardwareId(self._data[self._mfg_offset + 3])
 
-        Note: This temperature has not been characterized against ambient temperature
-        """
-        return ((self.TemperatureInCelsius * 9) / 5) + 32
+    @property
+    def _raw_hardware_id(self) -> int:
+        return self._data[self._mfg_offset + 3]
 
     @property
-    def TankLevelInMM(self) -> int:
-        """ The tank level/depth in mm for propane gas"""
-        return int(
-            self._raw_tank_level
-            * (
-                MOPEKA_TANK_LEVEL_COEFFICIENTS_PROPANE[0]
-                + (MOPEKA_TANK_LEVEL_COEFFICIENTS_PROPANE[1] * self._raw_temp)
-                + (
-                    MOPEKA_TANK_LEVEL_COEFFICIENTS_PROPANE[2]
-                    * self._raw_temp
-                    * self._raw_temp
-                )
-            )
-        )
+    def SyncButtonPressed(self) -> bool:
+        """ True if Sync Button is currently pressed """
+        return bool(self._data[self._mfg_offset + 5] & 0x80)
 
     @property
-    def TankLevelInInches(self) -> float:
-        """ The tank level/depth in inches"""
-        return round(self.TankLevelInMM / 25.4, 2)
+    def ReadingQualityStars(self) -> int:
+        """ Confidence or Quality of the reading on a scale of 0-3.  Higher is more confident """
+        return self._data[self._mfg_offset + 7] >> 6
 
-    def __str__(self) -> str:
-        return ("MopekaAdvertisement -  " +
-                f"RSSI: {self.rssi}dBm  " +
-                f"Battery: {self.BatteryVoltage} volts {self.BatteryPercent}%  " +
-                f"Button Pressed: {self.SyncButtonPressed}  " +
-                f"Temperature {self.TemperatureInCelsius}C {self.TemperatureInFahrenheit}F  " +
-                f"Confidence Stars {self.ReadingQualityStars}  " +
-                f"Fluid Height {self.TankLevelInMM} mm")
+    @property
+    def _raw_battery(self) -> int:
+        return self._data[self._mfg_offset + 4] & 0x7F
 
-    def Dump(self):
-        """ Helper routine that prints ad data plus all mfg data"""
-        print(self)
-        print("MfgData: ", end="")
-        for a in self._raw_mfg_data:
-            print("0x%02X" % a, end="  ")
-        print("\n")
+    @property
+    def _raw_temp(self) -> int:
+        return self._data[self._mfg_offset + 5] & 0x7F
+
+    @property
+    def _raw_tank_level(self) -> int:
+        o = self._mfg_offset
+        return ((self._data[o + 7] << 8) + self._data[o + 6]) & 0x3FFF
+
+    @property
+    def _raw_x_accel(self) -> int:
+        return self._data[self._mfg_offset + 11]
+
+    @property
+    def _raw_y_accel(self) -> int:
+        return self._data[self._mfg_offset + 12]
+
+    @property
+    def _raw_mfg_data(self) -> bytes:
+        o = self._mfg_offset
+        return bytes(self._data[o : o + MOPEKA_MFG_DATA_LENGTH])
@@ -0,0 +1,179 @@
+"""Asyncio facade for the Mopeka service
+
+Readings and discoveries are produced on the bleson scanning thread and
+handed to the event loop with call_soon_threadsafe.  Each consumer gets
+its own bounded queue.  The scanning thread never blocks so when a queue
+is full the oldest item is dropped and counted.
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import asyncio
+from typing import AsyncIterator, Dict, List, Optional
+
+from .advertisement import MopekaAdvertisement
+from .sensor import MopekaSensor
+from .service import MopekaService
+
+DEFAULT_QUEUE_SIZE = 32
+""" Default number of items buffered per consumer """
+
+
+class _BoundedQueue(object):
+    """ asyncio queue that drops the oldest item instead of blocking the producer """
+
+    def __init__(self, maxsize: int):
+        self.queue = asyncio.Queue(maxsize)
+
+    def put(self, item) -> bool:
+        """ must be called on the loop thread.  Returns True if an item was dropped """
+        dropped = self.queue.full()
+        if dropped:
+            self.queue.get_nowait()
+        self.queue.put_nowait(item)
+        return dropped
+
+
+class AsyncMopekaService(object):
+    """ Asyncio interface to a MopekaService
+
+    Must be created from a coroutine running in the event loop that will
+    consume readings.  Packets can be fed to the wrapped service from any
+    thread (bleson adapter or MopekaService.ProcessAdvertisementPacket).
+
+    ``` python
+    async with AsyncMopekaService() as service:
+        service.AddSensorToMonitor(sensor)
+        service.Start()
+        async for reading in service.readings(sensor):
+            print(reading.TankLevelInMM)
+    ```
+    """
+
+    Service: MopekaService
+    """ wrapped synchronous service """
+
+    DroppedCount: int
+    """ items dropped because a consumer queue was full """
+
+    _reading_queues: Dict[bytes, List[_BoundedQueue]]
+    _discovery_queues: List[_BoundedQueue]
+
+    def __init__(self, service: Optional[MopekaService] = None, queue_size: int = DEFAULT_QUEUE_SIZE):
+        self.Service = MopekaService() if service is None else service
+        self._loop = asyncio.get_running_loop()
+        self._queue_size = queue_size
+        self.DroppedCount = 0
+        # replaced, never mutated, so the scanning thread can read them without locking
+        self._reading_queues = {}
+        self._discovery_queues = []
+        self.Service.AddReadingCallback(self._on_reading)
+        self.Service.AddDiscoveryCallback(self._on_discovery)
+
+    async def __aenter__(self) -> "AsyncMopekaService":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        self.Close()
+
+    def Close(self) -> None:
+        """ Stop scanning and detach from the wrapped service """
+        self.Service.Stop()
+        self.Service.RemoveReadingCallback(self._on_reading)
+        self.Service.RemoveDiscoveryCallback(self._on_discovery)
+
+    # pass through of the commonly used service functions
+    def AddSensorToMonitor(self, sensor: MopekaSensor) -> None:
+        self.Service.AddSensorToMonitor(sensor)
+
+    def RemoveSensorToMonitor(self, sensor: MopekaSensor) -> None:
+        self.Service.RemoveSensorToMonitor(sensor)
+
+    def DoSensorDiscovery(self) -> None:
+        self.Service.DoSensorDiscovery()
+
+    def Start(self) -> None:
+        self.Service.Start()
+
+    def Stop(self) -> None:
+        self.Service.Stop()
+
+    ##
+    ## Scanning thread side
+    ##
+    def _on_reading(self, sensor: MopekaSensor, reading: MopekaAdvertisement) -> None:
+        if sensor._raw_mac in self._reading_queues:
+            self._loop.call_soon_threadsafe(self._deliver_reading, sensor._raw_mac, reading)
+
+    def _on_discovery(self, sensor: MopekaSensor) -> None:
+        if self._discovery_queues:
+            self._loop.call_soon_threadsafe(self._deliver_discovery, sensor)
+
+    ##
+    ## Event loop side
+    ##
+    def _deliver_reading(self, raw_mac: bytes, reading: MopekaAdvertisement) -> None:
+        for q in self._reading_queues.get(raw_mac, ()):
+            self.DroppedCount += q.put(reading)
+
+    def _deliver_discovery(self, sensor: MopekaSensor) -> None:
+        for q in self._discovery_queues:
+            self.DroppedCount += q.put(sensor)
+
+    def _subscribe_readings(self, raw_mac: bytes) -> _BoundedQueue:
+        q = _BoundedQueue(self._queue_size)
+        queues = dict(self._reading_queues)
+        queues[raw_mac] = queues.get(raw_mac, []) + [q]
+        self._reading_queues = queues
+        return q
+
+    def _unsubscribe_readings(self, raw_mac: bytes, q: _BoundedQueue) -> None:
+        queues = dict(self._reading_queues)
+        remaining = [x for x in queues.get(raw_mac, []) if x is not q]
+        if remaining:
+            queues[raw_mac] = remaining
+        else:
+            queues.pop(raw_mac, None)
+        self._reading_queues = queues
+
+    async def readings(self, sensor: MopekaSensor) -> AsyncIterator[MopekaAdvertisement]:
+        """ Async iterator of every new reading of a monitored sensor.
+
+        Readings received while the consumer is behind are buffered up to
+        queue_size, after that the oldest are dropped.
+        """
+        q = self._subscribe_readings(sensor._raw_mac)
+        try:
+            while True:
+                yield await q.queue.get()
+        finally:
+            self._unsubscribe_readings(sensor._raw_mac, q)
+
+    def _subscribe_discovery(self) -> _BoundedQueue:
+        q = _BoundedQueue(self._queue_size)
+        self._discovery_queues = self._discovery_queues + [q]
+        return q
+
+    def _unsubscribe_discovery(self, q: _BoundedQueue) -> None:
+        self._discovery_queues = [x for x in self._discovery_queues if x is not q]
+
+    async def discoveries(self) -> AsyncIterator[MopekaSensor]:
+        """ Async iterator of sensors found while in discovery mode """
+        q = self._subscribe_discovery()
+        try:
+            while True:
+                yield await q.queue.get()
+        finally:
+            self._unsubscribe_discovery(q)
+
+    async def next_discovery(self, timeout: Optional[float] = None) -> Optional[MopekaSensor]:
+        """ Wait for the next discovered sensor.  None on timeout """
+        q = self._subscribe_discovery()
+        try:
+            return await asyncio.wait_for(q.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._unsubscribe_discovery(q)
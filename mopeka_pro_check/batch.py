@@ -0,0 +1,111 @@
+"""Vectorized decoder for arrays of Mopeka manufacturer payloads
+
+Used for offline reprocessing of stored advertisements.  Requires numpy
+which is an optional dependency (pip install mopeka-pro-check[batch]).
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import numpy as np
+
+from .advertisement import (
+    MOPEKA_MANUFACTURE_ID,
+    MOPEKA_MFG_DATA_LENGTH,
+    BATTERY_PERCENT_TABLE,
+    TEMPERATURE_FAHRENHEIT_TABLE,
+    HARDWARE_LEVEL_FACTOR_TABLES,
+)
+from .hci import GAP_MFG_DATA
+
+# The scalar properties use 128 entry tables indexed by 7 bit raw values.
+# Using the same tables keeps results identical.
+_BATTERY_PERCENT_TABLE = np.array(BATTERY_PERCENT_TABLE, dtype=np.float64)
+_TEMPERATURE_FAHRENHEIT_TABLE = np.array(TEMPERATURE_FAHRENHEIT_TABLE, dtype=np.float64)
+
+
+def _level_factor_matrix() -> np.ndarray:
+    """ 256 x 128 level factors indexed by [hardware id, raw temp].  Rows of
+    unsupported hardware ids are zero.  Built per call so profiles registered
+    as defaults are picked up """
+    factors = np.zeros((256, 128), dtype=np.float64)
+    for hardware_id, table in HARDWARE_LEVEL_FACTOR_TABLES.items():
+        factors[hardware_id] = table
+    return factors
+
+
+class MopekaAdvertisementBatch(object):
+    """ Column oriented decode of N Mopeka manufacturer payloads.
+
+    Each payload is the 13 byte GAP_MFG_DATA report starting with the type
+    byte (same as MopekaAdvertisement._raw_mfg_data).  Columns are numpy
+    arrays of length N and decoded values match the scalar properties of
+    MopekaAdvertisement exactly.
+
+    No validation exceptions are raised.  Use the valid column to select
+    payloads that MopekaAdvertisement would have accepted.
+    """
+
+    def __init__(self, payloads):
+        """ init from a bytes like buffer with a length that is a multiple
+        of 13 or a N x 13 uint8 array"""
+        if isinstance(payloads, np.ndarray):
+            data = np.ascontiguousarray(payloads, dtype=np.uint8)
+        else:
+            data = np.frombuffer(payloads, dtype=np.uint8)
+        if data.size % MOPEKA_MFG_DATA_LENGTH != 0:
+            raise ValueError(f"Buffer size {data.size} is not a multiple of {MOPEKA_MFG_DATA_LENGTH}")
+        data = data.reshape(-1, MOPEKA_MFG_DATA_LENGTH)
+
+        self.ManufacturerId = data[:, 1].astype(np.uint16) | (data[:, 2].astype(np.uint16) << 8)
+        self.HardwareId = data[:, 3].copy()
+        self.valid = (
+            (data[:, 0] == GAP_MFG_DATA)
+            & (self.ManufacturerId == MOPEKA_MANUFACTURE_ID)
+            & np.isin(self.HardwareId, list(HARDWARE_LEVEL_FACTOR_TABLES))
+        )
+        """ True where the payload is a supported Mopeka sensor """
+
+        self.raw_battery = data[:, 4] & 0x7F
+        self.SyncButtonPressed = (data[:, 5] & 0x80) > 0
+        self.raw_temp = data[:, 5] & 0x7F
+        self.raw_tank_level = ((data[:, 7].astype(np.int64) << 8) + data[:, 6]) & 0x3FFF
+        self.ReadingQualityStars = data[:, 7] >> 6
+        self.raw_x_accel = data[:, 11].copy()
+        self.raw_y_accel = data[:, 12].copy()
+
+    def __len__(self) -> int:
+        return len(self.raw_tank_level)
+
+    @property
+    def BatteryVoltage(self) -> np.ndarray:
+        """Battery reading in volts"""
+        return self.raw_battery / 32.0
+
+    @property
+    def BatteryPercent(self) -> np.ndarray:
+        """Battery Percentage based on 3 volt CR2032 battery"""
+        return _BATTERY_PERCENT_TABLE[self.raw_battery]
+
+    @property
+    def TemperatureInCelsius(self) -> np.ndarray:
+        """Temperature in Celsius"""
+        return self.raw_temp.astype(np.int64) - 40
+
+    @property
+    def TemperatureInFahrenheit(self) -> np.ndarray:
+        """Temperature in Fahrenheit"""
+        return _TEMPERATURE_FAHRENHEIT_TABLE[self.raw_temp]
+
+    @property
+    def TankLevelInMM(self) -> np.ndarray:
+        """ The tank level/depth in mm using the default profile of each
+        hardware id.  0 for unsupported hardware """
+        factors = _level_factor_matrix()[self.HardwareId, self.raw_temp]
+        return (self.raw_tank_level * factors).astype(np.int64)
+
+    @property
+    def TankLevelInInches(self) -> np.ndarray:
+        """ The tank level/depth in inches"""
+        return np.round(self.TankLevelInMM / 25.4, 2)
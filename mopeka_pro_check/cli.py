@@ -0,0 +1,223 @@
+"""mopeka-pro-check command line gateway
+
+    mopeka-pro-check run --mac E7:9D:05:C4:3C:76 [--output readings.ndjson] [--http-port 8080]
+    mopeka-pro-check discover [--duration 10]
+    mopeka-pro-check replay capture.btsnoop [--speed 1.0] [--discover]
+
+Readings are streamed as newline delimited JSON or CSV through a
+ReadingWriter so output is written in batches off the scanning thread.
+run keeps going until interrupted (or --duration seconds) and can keep
+its state across restarts with --snapshot and serve the current tank
+state over HTTP with --http-port.  replay feeds a capture file
+through the same service so everything works without hardware.
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import sys
+import threading
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from .advertisement import IsMopekaAdvertisement
+from .output import (
+    OUTPUT_FORMATS,
+    ReadingWriter,
+    DEFAULT_BACKUP_COUNT,
+    DEFAULT_FLUSH_INTERVAL,
+)
+from .replay import CaptureRecord, LoadCapture, Replay
+from .sensor import MopekaSensor
+from .server import StateServer, DEFAULT_HTTP_HOST
+from .service import MopekaService
+from .snapshot import LoadSnapshot, SaveSnapshot
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_DISCOVERY_DURATION = 10.0
+""" Seconds discover scans for """
+
+
+def _add_output_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("-f", "--format", choices=OUTPUT_FORMATS, default="ndjson", help="output format")
+    parser.add_argument("-o", "--output", help="file to append to.  Default is stdout")
+    parser.add_argument("--max-bytes", type=int, default=0, help="rotate the output file at this size.  0 never rotates")
+    parser.add_argument("--backups", type=int, default=DEFAULT_BACKUP_COUNT, help="rotated files kept")
+    parser.add_argument("--flush-interval", type=float, default=DEFAULT_FLUSH_INTERVAL, help="seconds between writes")
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="mopeka-pro-check", description="Stream Mopeka Pro Check sensor readings")
+    parser.add_argument("-v", "--verbose", action="count", default=0, help="log more (repeat for debug)")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    run = commands.add_parser("run", help="scan for monitored sensors and stream their readings")
+    run.add_argument("-m", "--mac", action="append", required=True, help="sensor mac address (repeatable)")
+    run.add_argument("-a", "--adapter", type=int, action="append", help="host controller index (repeatable).  Default 0")
+    run.add_argument("-d", "--duration", type=float, help="seconds to run.  Default is until interrupted")
+    run.add_argument("--snapshot", help="state file loaded at start and saved on exit")
+    run.add_argument("--http-port", type=int, help="serve /state and /metrics on this port")
+    run.add_argument("--http-host", default=DEFAULT_HTTP_HOST, help="address the http server binds to")
+    _add_output_arguments(run)
+
+    discover = commands.add_parser("discover", help="list sensors that have the sync button pressed")
+    discover.add_argument("-a", "--adapter", type=int, action="append", help="host controller index (repeatable).  Default 0")
+    discover.add_argument("-d", "--duration", type=float, default=DEFAULT_DISCOVERY_DURATION, help="seconds to scan")
+    _add_output_arguments(discover)
+
+    replay = commands.add_parser("replay", help="stream readings from a btsnoop or capture file")
+    replay.add_argument("capture", help="capture file")
+    replay.add_argument("-m", "--mac", action="append", help="sensor mac address (repeatable).  Default is every sensor in the capture")
+    replay.add_argument("-s", "--speed", type=float, help="1.0 follows the recorded timing.  Default is as fast as possible")
+    replay.add_argument("--discover", action="store_true", help="discover sensors instead of streaming readings")
+    _add_output_arguments(replay)
+    return parser
+
+
+def _open_writer(args, **kwargs) -> ReadingWriter:
+    return ReadingWriter(
+        args.output,
+        args.format,
+        max_bytes=args.max_bytes,
+        backup_count=args.backups,
+        flush_interval=args.flush_interval,
+        **kwargs,
+    )
+
+
+def _capture_macs(records: Iterable[CaptureRecord]) -> List[str]:
+    """ mac of every Mopeka sensor in records in the order first seen """
+    raw_macs = dict.fromkeys(bytes(data[3:9]) for _, data in records if IsMopekaAdvertisement(data))
+    return [":".join("%02X" % b for b in reversed(raw)) for raw in raw_macs]
+
+
+def _wait(duration: Optional[float]) -> None:
+    """ sleep for duration or until SIGINT / SIGTERM """
+    stop = threading.Event()
+
+    def handler(signum, frame):
+        stop.set()
+    previous = signal.signal(signal.SIGTERM, handler)
+    try:
+        stop.wait(duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+
+
+def _start_http(service: MopekaService, host: str, port: int) -> Callable[[], None]:
+    """ serve a StateServer from its own event loop thread.  Returns a function that stops it """
+    loop = asyncio.new_event_loop()
+    server = StateServer(service, host, port)
+    try:
+        loop.run_until_complete(server.Start())
+    except Exception:
+        loop.close()
+        raise
+    thread = threading.Thread(target=loop.run_forever, name="mopeka-http", daemon=True)
+    thread.start()
+
+    def stop() -> None:
+        asyncio.run_coroutine_threadsafe(server.Close(), loop).result(5)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+    return stop
+
+
+def _run(args) -> int:
+    service = MopekaService()
+    service.SetHostControllerIndexes(args.adapter or [0])
+    if args.snapshot and os.path.exists(args.snapshot):
+        LoadSnapshot(service, args.snapshot)
+    # sensors restored from the snapshot keep their state
+    restored = {sensor._mac.upper() for sensor in service.SensorMonitoredList.values()}
+    service.AddSensorsToMonitor(MopekaSensor(mac) for mac in args.mac if mac.upper() not in restored)
+    stop_http = None if args.http_port is None else _start_http(service, args.http_host, args.http_port)
+    with _open_writer(args) as writer:
+        service.AddReadingCallback(writer.OnReading)
+        service.Start()
+        try:
+            _wait(args.duration)
+        finally:
+            service.Stop()
+            if stop_http is not None:
+                stop_http()
+    if writer.DroppedCount:
+        _LOGGER.warning("%d readings dropped", writer.DroppedCount)
+    if args.snapshot:
+        SaveSnapshot(service, args.snapshot)
+    return 0
+
+
+def _discover(args) -> int:
+    service = MopekaService()
+    service.SetHostControllerIndexes(args.adapter or [0])
+    service.DoSensorDiscovery()
+    with _open_writer(args) as writer:
+        service.AddDiscoveryCallback(lambda sensor: writer.OnReading(sensor, sensor._last_reading))
+        service.Start()
+        try:
+            _wait(args.duration)
+        finally:
+            service.Stop()
+    _LOGGER.info("Found %d sensors", len(service.SensorDiscoveredList))
+    return 0
+
+
+def _replay(args) -> int:
+    records = LoadCapture(args.capture)
+    now = 0.0
+
+    def clock() -> float:
+        return now
+
+    def timed(records: Iterable[CaptureRecord]) -> Iterator[CaptureRecord]:
+        nonlocal now
+        for record in records:
+            now = record[0]
+            yield record
+
+    service = MopekaService()
+    # readings are stamped with the capture time, not the replay time
+    service.Clock = clock
+    if args.discover:
+        service.DoSensorDiscovery()
+    else:
+        service.AddSensorsToMonitor(MopekaSensor(mac) for mac in (args.mac or _capture_macs(records)))
+    # nothing should be dropped when reading a file as fast as possible
+    with _open_writer(args, clock=clock, block=True) as writer:
+        if args.discover:
+            service.AddDiscoveryCallback(lambda sensor: writer.OnReading(sensor, sensor._last_reading))
+        else:
+            service.AddReadingCallback(writer.OnReading)
+        Replay(service, timed(records), args.speed)
+    return 0
+
+
+_COMMANDS = {"run": _run, "discover": _discover, "replay": _replay}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """ Console entry point """
+    args = _build_parser().parse_args(argv)
+    level = (logging.WARNING, logging.INFO, logging.DEBUG)[min(args.verbose, 2)]
+    # logs go to stderr so they never mix with readings on stdout
+    logging.basicConfig(level=level, stream=sys.stderr, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    try:
+        return _COMMANDS[args.command](args)
+    except (OSError, ValueError) as e:
+        _LOGGER.error("%s", e)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
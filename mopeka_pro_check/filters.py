@@ -0,0 +1,223 @@
+"""Tank level noise filtering
+
+A LevelFilter cleans up the level of one sensor in stages:
+
+* readings below min_quality ReadingQualityStars are dropped
+* readings taken while the accelerometer shows the sensor tilted away
+  from its resting position (tank being moved or bumped) are dropped.  A
+  new position that holds for settle_readings readings becomes the resting
+  position
+* the result is a quality weighted median of the last window readings
+  or a quality weighted EWMA.  Before the EWMA a Hampel filter replaces
+  readings further than hampel_sigma robust standard deviations from the
+  window median with the median.  The spread is a running mean absolute
+  deviation so no second sort is needed.  A real change of level moves
+  the median once it fills half the window
+
+The window is a ring buffer plus a sorted list where each reading appears
+once per quality star, so the weighted median is the middle element.
+Memory is fixed per sensor and a reading costs O(log window) comparisons.
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+from bisect import bisect_left
+from enum import Enum
+from typing import List, Optional
+
+DEFAULT_FILTER_WINDOW = 7
+""" Readings in the median window """
+
+DEFAULT_FILTER_ALPHA = 0.3
+""" EWMA smoothing factor for a 3 star reading.  Scaled down for fewer stars """
+
+DEFAULT_TILT_THRESHOLD = 6
+""" Raw accelerometer units either axis may move before a reading is rejected """
+
+DEFAULT_SETTLE_READINGS = 10
+""" Steady readings in a new position before it becomes the resting position """
+
+DEFAULT_HAMPEL_SIGMA = 3.0
+""" Robust standard deviations from the median that make a reading an outlier """
+
+_MIN_SPREAD = 2.0
+""" mm.  Floor of the Hampel spread so a perfectly steady tank still allows small changes """
+
+_SPREAD_ALPHA = 0.1
+""" Smoothing factor of the running absolute deviation """
+
+_MAD_TO_SIGMA = 1.2533
+""" Mean absolute deviation to standard deviation for normal noise """
+
+
+def _signed(value: int) -> int:
+    """ accelerometer bytes are two's complement """
+    return value - 256 if value > 127 else value
+
+
+class FilterMode(Enum):
+    """ How accepted readings are smoothed """
+    MEDIAN = 0
+    """ Quality weighted median of the window """
+
+    EWMA = 1
+    """ Exponentially weighted moving average with a quality weighted alpha """
+
+
+class LevelFilter(object):
+    """ Filtered tank level of one sensor.  Assign to MopekaSensor.Filter.
+    Not thread safe """
+
+    Value: Optional[float]
+    """ Filtered level in mm.  None until a reading is accepted """
+
+    LastRaw: Optional[float]
+    """ Level in mm of the last reading given to Update """
+
+    def __init__(
+        self,
+        mode: FilterMode = FilterMode.MEDIAN,
+        window: int = DEFAULT_FILTER_WINDOW,
+        alpha: float = DEFAULT_FILTER_ALPHA,
+        min_quality: int = 1,
+        tilt_threshold: Optional[int] = DEFAULT_TILT_THRESHOLD,
+        settle_readings: int = DEFAULT_SETTLE_READINGS,
+        hampel_sigma: Optional[float] = DEFAULT_HAMPEL_SIGMA,
+    ):
+        """ tilt_threshold or hampel_sigma of None turn that stage off """
+        if window < 1:
+            raise ValueError(f"Filter window must be at least 1 ({window})")
+        self.Mode = mode
+        self.Alpha = alpha
+        self.MinQuality = min_quality
+        self.TiltThreshold = tilt_threshold
+        self.SettleReadings = settle_readings
+        self.HampelSigma = hampel_sigma
+        self.Value = None
+        self.LastRaw = None
+        self.Accepted = 0
+        self.RejectedQuality = 0
+        self.RejectedTilt = 0
+        self.Outliers = 0
+        """ readings further from the window median than the Hampel limit """
+        self._levels: List[float] = [0.0] * window
+        self._weights: List[int] = [0] * window
+        self._head = 0
+        self._count = 0
+        # each level in the window once per quality star
+        self._sorted: List[float] = []
+        self._spread: Optional[float] = None
+        self._rest: Optional[tuple] = None
+        self._last_accel: Optional[tuple] = None
+        self._settled = 0
+
+    def Reset(self) -> None:
+        """ Forget the window and the resting position """
+        self.Value = None
+        self._head = 0
+        self._count = 0
+        self._sorted = []
+        self._spread = None
+        self._rest = None
+        self._last_accel = None
+        self._settled = 0
+
+    def _clear_window(self) -> None:
+        self._head = 0
+        self._count = 0
+        self._sorted = []
+        self._spread = None
+        self.Value = None
+
+    def _median(self) -> float:
+        s = self._sorted
+        n = len(s)
+        return (s[(n - 1) // 2] + s[n // 2]) / 2
+
+    def _tilted(self, x_accel: int, y_accel: int) -> bool:
+        """ True if the sensor is away from its resting position """
+        threshold = self.TiltThreshold
+        accel = (_signed(x_accel), _signed(y_accel))
+        last = self._last_accel
+        self._last_accel = accel
+        rest = self._rest
+        if rest is None:
+            self._rest = accel
+            return False
+        if abs(accel[0] - rest[0]) <= threshold and abs(accel[1] - rest[1]) <= threshold:
+            self._settled = 0
+            return False
+        if abs(accel[0] - last[0]) <= threshold and abs(accel[1] - last[1]) <= threshold:
+            self._settled += 1
+        else:
+            self._settled = 0
+        if self._settled < self.SettleReadings:
+            return True
+        # moved to a new spot.  levels from the old one don't apply
+        self._rest = accel
+        self._settled = 0
+        self._clear_window()
+        return False
+
+    def Update(self, level: float, quality: int, x_accel: int, y_accel: int) -> bool:
+        """ Add a reading.  Returns False if it was rejected """
+        self.LastRaw = level
+        if self.TiltThreshold is not None and self._tilted(x_accel, y_accel):
+            self.RejectedTilt += 1
+            return False
+        if quality < self.MinQuality:
+            self.RejectedQuality += 1
+            return False
+        weight = max(quality, 1)
+        cleaned = level
+        if self.HampelSigma is not None and self._count >= 3:
+            median = self._median()
+            deviation = abs(level - median)
+            spread = self._spread
+            limit = self.HampelSigma * _MAD_TO_SIGMA * max(spread, _MIN_SPREAD)
+            if deviation > limit:
+                cleaned = median
+                self.Outliers += 1
+            # clip so one outlier can't widen the spread
+            self._spread = spread + (min(deviation, limit) - spread) * _SPREAD_ALPHA
+        elif self.HampelSigma is not None and self._count:
+            # warm up the spread before the window is big enough to judge
+            deviation = abs(level - self._median())
+            self._spread = deviation if self._spread is None else self._spread + (deviation - self._spread) * _SPREAD_ALPHA
+
+        # the window keeps raw levels.  replace the oldest
+        s = self._sorted
+        i = self._head
+        if self._count == len(self._levels):
+            old = self._levels[i]
+            j = bisect_left(s, old)
+            del s[j:j + self._weights[i]]
+        else:
+            self._count += 1
+        self._levels[i] = level
+        self._weights[i] = weight
+        j = bisect_left(s, level)
+        s[j:j] = [level] * weight
+        i += 1
+        self._head = 0 if i == len(self._levels) else i
+
+        if self.Mode == FilterMode.MEDIAN:
+            self.Value = self._median()
+        elif self.Value is None:
+            self.Value = float(cleaned)
+        else:
+            self.Value += (cleaned - self.Value) * self.Alpha * weight / 3
+        self.Accepted += 1
+        return True
+
+    def Snapshot(self) -> dict:
+        return {
+            "value": self.Value,
+            "raw": self.LastRaw,
+            "accepted": self.Accepted,
+            "rejected_quality": self.RejectedQuality,
+            "rejected_tilt": self.RejectedTilt,
+            "outliers": self.Outliers,
+        }
@@ -0,0 +1,276 @@
+"""Consumption rate and time to empty forecasting
+
+Each sensor runs a two state Kalman filter (fluid height and its rate of
+change) over its readings.  An update is a handful of float operations so
+the cost per reading is O(1) and no history is reprocessed.
+
+Liquid propane expands with temperature so the same amount of fuel reads
+higher on a warm day.  Heights are normalized to REFERENCE_TEMPERATURE
+before filtering so a daily temperature swing is not reported as usage.
+
+Readings far from the prediction are held back.  A single one is dropped
+as noise.  When several in a row agree on a new level the filter jumps to
+it and a rise of at least refill_mm is reported as a refill.
+
+ForecastIndex keeps the predicted empty time of many sensors in a heap so
+the tanks that empty soonest are found without looking at every sensor.
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import heapq
+import itertools
+import math
+from typing import Dict, Hashable, List, Optional, Tuple
+
+REFERENCE_TEMPERATURE = 15.0
+""" Celsius.  Heights are compensated to this temperature """
+
+PROPANE_THERMAL_EXPANSION = 0.0027
+""" Relative volume change of liquid propane per degree Celsius """
+
+WATER_THERMAL_EXPANSION = 0.0002
+""" Relative volume change of water per degree Celsius """
+
+DEFAULT_RATE_NOISE = 5.0
+""" How fast usage may change in mm per hour per square root hour """
+
+DEFAULT_REFILL_MM = 30.0
+""" Smallest rise in mm reported as a refill """
+
+DEFAULT_CONFIRM_READINGS = 3
+""" Readings that must agree on a jump before the filter accepts it """
+
+_GATE_SIGMA = 4.0
+""" Readings further than this many standard deviations from the prediction are suspicious """
+
+_MEASUREMENT_SIGMA = (None, 15.0, 6.0, 3.0)
+""" mm of measurement noise by ReadingQualityStars.  Zero stars is not used """
+
+_INITIAL_RATE_SIGMA = 100.0 / 3600
+""" mm per second """
+
+
+class ConsumptionForecast(object):
+    """ Streaming estimate of the fluid height and usage rate of one tank.
+
+    Update with every reading.  Heights are in mm and times in seconds
+    (the service Clock).  Not thread safe.
+    """
+
+    __slots__ = (
+        "ThresholdInMM",
+        "ThermalExpansion",
+        "RefillInMM",
+        "ConfirmReadings",
+        "Count",
+        "Refills",
+        "LastRefill",
+        "LastUpdate",
+        "_q",
+        "_level",
+        "_rate",
+        "_p00",
+        "_p01",
+        "_p11",
+        "_jump_count",
+        "_jump_sum",
+        "_jump_up",
+    )
+
+    def __init__(
+        self,
+        threshold_mm: float = 0.0,
+        thermal_expansion: Optional[float] = None,
+        rate_noise: float = DEFAULT_RATE_NOISE,
+        refill_mm: float = DEFAULT_REFILL_MM,
+        confirm_readings: int = DEFAULT_CONFIRM_READINGS,
+    ):
+        """ threshold_mm is the height EmptyAt predicts.  thermal_expansion is
+        the relative volume change per degree Celsius.  None lets the sensor
+        set it from its profile on the first reading.  0 turns temperature
+        compensation off """
+        self.ThresholdInMM = threshold_mm
+        self.ThermalExpansion = thermal_expansion
+        self.RefillInMM = refill_mm
+        self.ConfirmReadings = confirm_readings
+        self.Count = 0
+        """ readings used """
+        self.Refills = 0
+        """ refills detected """
+        self.LastRefill: Optional[float] = None
+        self.LastUpdate: Optional[float] = None
+        # white noise acceleration density in mm^2/s^3
+        self._q = (rate_noise / 3600) ** 2 / 3600
+        self._level = 0.0
+        self._rate = 0.0  # mm per second
+        self._p00 = 0.0
+        self._p01 = 0.0
+        self._p11 = 0.0
+        self._jump_count = 0
+        self._jump_sum = 0.0
+        self._jump_up = False
+
+    def Compensate(self, height_mm: float, temperature: float) -> float:
+        """ height_mm at REFERENCE_TEMPERATURE """
+        expansion = self.ThermalExpansion
+        if not expansion:
+            return float(height_mm)
+        return height_mm / (1.0 + expansion * (temperature - REFERENCE_TEMPERATURE))
+
+    def _reset(self, level: float, variance: float, rate: float, rate_variance: float) -> None:
+        self._level = level
+        self._rate = rate
+        self._p00 = variance
+        self._p01 = 0.0
+        self._p11 = rate_variance
+        self._jump_count = 0
+
+    def Update(self, height_mm: float, temperature: float, quality: int, timestamp: float) -> bool:
+        """ Add a reading.  Returns True if it completed a refill """
+        if quality <= 0:
+            return False
+        z = self.Compensate(height_mm, temperature)
+        sigma = _MEASUREMENT_SIGMA[quality]
+        r = sigma * sigma
+        last = self.LastUpdate
+        if last is None:
+            self._reset(z, r, 0.0, _INITIAL_RATE_SIGMA ** 2)
+            self.LastUpdate = timestamp
+            self.Count = 1
+            return False
+        dt = timestamp - last
+        if dt <= 0:
+            return False
+        # predict.  nothing is stored until the reading is accepted
+        q = self._q
+        rate = self._rate
+        level = self._level + rate * dt
+        p00 = self._p00 + dt * (2 * self._p01 + dt * self._p11) + q * dt ** 3 / 3
+        p01 = self._p01 + dt * self._p11 + q * dt * dt / 2
+        p11 = self._p11 + q * dt
+        innovation = z - level
+        s = p00 + r
+        if innovation * innovation > _GATE_SIGMA * _GATE_SIGMA * s:
+            return self._jump(z, innovation > 0, r, timestamp)
+        self._jump_count = 0
+        k0 = p00 / s
+        k1 = p01 / s
+        self._level = level + k0 * innovation
+        self._rate = rate + k1 * innovation
+        self._p00 = p00 - k0 * p00
+        self._p01 = p01 - k0 * p01
+        self._p11 = p11 - k1 * p01
+        self.LastUpdate = timestamp
+        self.Count += 1
+        return False
+
+    def _jump(self, z: float, up: bool, r: float, timestamp: float) -> bool:
+        """ a reading far from the prediction.  Accept the new level once
+        ConfirmReadings in a row agree """
+        if self._jump_count and up == self._jump_up:
+            self._jump_count += 1
+            self._jump_sum += z
+        else:
+            self._jump_count = 1
+            self._jump_sum = z
+            self._jump_up = up
+        if self._jump_count < self.ConfirmReadings:
+            return False
+        level = self._jump_sum / self._jump_count
+        refill = up and level - self._level >= self.RefillInMM
+        # a refill starts a new tank.  the usage pattern carries over but is less certain
+        self._reset(level, r, self._rate, self._p11 + _INITIAL_RATE_SIGMA ** 2)
+        self.LastUpdate = timestamp
+        self.Count += 1
+        if refill:
+            self.Refills += 1
+            self.LastRefill = timestamp
+        return refill
+
+    @property
+    def LevelInMM(self) -> Optional[float]:
+        """ filtered height at REFERENCE_TEMPERATURE """
+        return None if self.LastUpdate is None else self._level
+
+    @property
+    def UsageRate(self) -> Optional[float]:
+        """ mm per hour the level is falling.  Negative while filling """
+        return None if self.Count < 2 else -self._rate * 3600
+
+    @property
+    def UsageRateStdDev(self) -> Optional[float]:
+        """ uncertainty of UsageRate in mm per hour """
+        return None if self.Count < 2 else math.sqrt(self._p11) * 3600
+
+    def SecondsToLevel(self, level_mm: float) -> Optional[float]:
+        """ seconds after LastUpdate the level reaches level_mm.  None if it is not falling """
+        if self.Count < 2 or self._rate >= 0:
+            return None
+        return max(self._level - level_mm, 0.0) / -self._rate
+
+    @property
+    def EmptyAt(self) -> Optional[float]:
+        """ time the level reaches ThresholdInMM.  None if it is not falling """
+        seconds = self.SecondsToLevel(self.ThresholdInMM)
+        return None if seconds is None else self.LastUpdate + seconds
+
+    def Snapshot(self) -> dict:
+        return {
+            "count": self.Count,
+            "level": self.LevelInMM,
+            "usage_rate": self.UsageRate,
+            "usage_rate_stddev": self.UsageRateStdDev,
+            "empty_at": self.EmptyAt,
+            "refills": self.Refills,
+            "last_refill": self.LastRefill,
+        }
+
+
+class ForecastIndex(object):
+    """ Keys ordered by predicted empty time.
+
+    Update is O(log n).  Replaced entries stay in the heap until they
+    reach the top or the heap is rebuilt at twice the live size, so
+    Soonest only touches the entries it returns plus stale ones.
+    Not thread safe.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int, Hashable]] = []
+        self._current: Dict[Hashable, Tuple[float, int, Hashable]] = dict()
+        self._sequence = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._current)
+
+    def Update(self, key: Hashable, empty_at: Optional[float]) -> None:
+        """ set the empty time of key.  None removes it """
+        if empty_at is None:
+            self._current.pop(key, None)
+            return
+        # the sequence number keeps keys from ever being compared
+        entry = (empty_at, next(self._sequence), key)
+        self._current[key] = entry
+        heapq.heappush(self._heap, entry)
+        if len(self._heap) > 2 * len(self._current) + 64:
+            self._heap = list(self._current.values())
+            heapq.heapify(self._heap)
+
+    def Remove(self, key: Hashable) -> None:
+        self._current.pop(key, None)
+
+    def Soonest(self, count: int) -> List[Tuple[float, Hashable]]:
+        """ (empty time, key) of the count keys that empty first """
+        heap = self._heap
+        current = self._current
+        found = []
+        while heap and len(found) < count:
+            entry = heapq.heappop(heap)
+            if current.get(entry[2]) is entry:
+                found.append(entry)
+        for entry in found:
+            heapq.heappush(heap, entry)
+        return [(empty_at, key) for empty_at, _, key in found]
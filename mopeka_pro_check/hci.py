@@ -0,0 +1,37 @@
+"""Minimal HCI definitions used by the parser
+
+The parsing core only needs a few constants and the rssi conversion from
+bleson.  They are defined here so importing the parser doesn't import
+bleson and its HCI stack.  bleson's BDAddress is imported on first use.
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+from typing import Optional
+
+GAP_NAME_COMPLETE = 0x09
+GAP_MFG_DATA = 0xFF
+EVT_LE_ADVERTISING_REPORT = 0x02
+
+_BDAddress = None
+
+
+def rssi_from_byte(rssi_unsigned: int) -> Optional[int]:
+    """ Same as bleson.core.hci.type_converters.rssi_from_byte """
+    rssi = rssi_unsigned - 256 if rssi_unsigned > 127 else rssi_unsigned
+    if rssi == 127:
+        return None  # RSSI Not available
+    if rssi >= 20:
+        return None  # Reserved range 20-126
+    return rssi
+
+
+def ToBDAddress(address):
+    """ bleson.BDAddress(address).  Imports bleson on the first call """
+    global _BDAddress
+    if _BDAddress is None:
+        from bleson import BDAddress
+        _BDAddress = BDAddress
+    return _BDAddress(address)
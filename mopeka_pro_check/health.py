@@ -0,0 +1,132 @@
+"""Streaming sensor health statistics
+
+Tracks signal and reading quality per sensor with constant memory and O(1)
+work per advertisement: EWMA RSSI, EWMA advertisement interval and jitter,
+the quality star distribution and an estimate of missed advertisements
+from the expected cadence.
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import heapq
+from typing import Iterable, List, Optional, Tuple
+
+DEFAULT_EXPECTED_INTERVAL = 1.0
+""" Seconds between advertisements a sensor is expected to send """
+
+DEFAULT_HEALTH_ALPHA = 0.1
+""" EWMA smoothing factor.  Larger follows changes faster """
+
+_MIN_INTERVAL_FRACTION = 0.25
+""" Advertisements closer than this fraction of the expected interval are
+the same advertisement heard again (another adapter) and don't count """
+
+_RSSI_FLOOR = -100.0
+_RSSI_GOOD = -60.0
+
+
+class SensorHealth(object):
+    """ Health statistics for one sensor.  Update with every advertisement """
+
+    __slots__ = (
+        "ExpectedInterval",
+        "Alpha",
+        "Count",
+        "RssiEwma",
+        "IntervalEwma",
+        "Jitter",
+        "QualityCounts",
+        "Missed",
+        "LastSeen",
+    )
+
+    def __init__(self, expected_interval: float = DEFAULT_EXPECTED_INTERVAL, alpha: float = DEFAULT_HEALTH_ALPHA):
+        self.ExpectedInterval = expected_interval
+        self.Alpha = alpha
+        self.Count = 0
+        """ advertisements received """
+        self.RssiEwma: Optional[float] = None
+        self.IntervalEwma: Optional[float] = None
+        """ seconds between advertisements """
+        self.Jitter = 0.0
+        """ EWMA of the deviation of the interval from IntervalEwma (seconds) """
+        self.QualityCounts = [0, 0, 0, 0]
+        """ advertisements by ReadingQualityStars (0-3) """
+        self.Missed = 0
+        """ estimated advertisements missed based on ExpectedInterval """
+        self.LastSeen: Optional[float] = None
+
+    def Update(self, rssi: Optional[int], quality: int, timestamp: float) -> None:
+        """ Add an advertisement.  rssi of None (not available) is skipped """
+        alpha = self.Alpha
+        last = self.LastSeen
+        if last is not None:
+            interval = timestamp - last
+            expected = self.ExpectedInterval
+            if interval < expected * _MIN_INTERVAL_FRACTION:
+                # same advertisement from another adapter
+                return
+            if self.IntervalEwma is None:
+                self.IntervalEwma = interval
+            else:
+                self.Jitter += (abs(interval - self.IntervalEwma) - self.Jitter) * alpha
+                self.IntervalEwma += (interval - self.IntervalEwma) * alpha
+            missed = int(interval / expected + 0.5) - 1
+            if missed > 0:
+                self.Missed += missed
+        self.LastSeen = timestamp
+        self.Count += 1
+        self.QualityCounts[quality] += 1
+        if rssi is not None:
+            self.RssiEwma = rssi if self.RssiEwma is None else self.RssiEwma + (rssi - self.RssiEwma) * alpha
+
+    @property
+    def LossRatio(self) -> float:
+        """ fraction of expected advertisements that were missed """
+        total = self.Count + self.Missed
+        return self.Missed / total if total else 0.0
+
+    @property
+    def MeanQuality(self) -> Optional[float]:
+        """ average ReadingQualityStars """
+        if self.Count == 0:
+            return None
+        q = self.QualityCounts
+        return (q[1] + 2 * q[2] + 3 * q[3]) / self.Count
+
+    def Score(self) -> float:
+        """ 0 (bad) to 100 (good) combining delivery, reading quality and signal.
+
+        40% advertisements received, 30% mean quality stars and 30% RSSI
+        scaled between -100 dBm and -60 dBm.
+        """
+        if self.Count == 0:
+            return 0.0
+        rssi = _RSSI_FLOOR if self.RssiEwma is None else self.RssiEwma
+        signal = min(max((rssi - _RSSI_FLOOR) / (_RSSI_GOOD - _RSSI_FLOOR), 0.0), 1.0)
+        return 100.0 * (0.4 * (1.0 - self.LossRatio) + 0.3 * self.MeanQuality / 3 + 0.3 * signal)
+
+    def Snapshot(self) -> dict:
+        return {
+            "count": self.Count,
+            "rssi": self.RssiEwma,
+            "interval": self.IntervalEwma,
+            "jitter": self.Jitter,
+            "quality": list(self.QualityCounts),
+            "missed": self.Missed,
+            "loss_ratio": self.LossRatio,
+            "score": self.Score(),
+        }
+
+
+def WorstSensors(sensors: Iterable, count: int = 10) -> List[Tuple[float, object]]:
+    """ (score, sensor) of the count sensors with the lowest health score.
+
+    sensors are MopekaSensor objects.  Uses the per sensor summaries only so
+    the cost is O(n log count) for n sensors.
+    """
+    return heapq.nsmallest(
+        count, ((s.Health.Score(), s) for s in sensors if s.Health is not None), key=lambda item: item[0]
+    )
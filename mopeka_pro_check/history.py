@@ -0,0 +1,143 @@
+"""Fixed capacity reading history for a Mopeka sensor
+
+Readings are stored as decoded fields in preallocated arrays so memory
+per sensor is bounded and appends are O(1).
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+from array import array
+from typing import List, NamedTuple, Optional, Tuple
+
+DEFAULT_HISTORY_SIZE = 64
+""" Default number of readings kept per sensor """
+
+_RSSI_NOT_AVAILABLE = 127
+""" stored in place of an rssi of None.  Never a valid rssi (reserved range) """
+
+
+class HistoryReading(NamedTuple):
+    """ Decoded reading stored in a ReadingHistory """
+
+    timestamp: float
+    """ time.monotonic() value when the reading was added """
+    rssi: Optional[int]
+    """ None when the advertisement had no rssi """
+    TankLevelInMM: int
+    TemperatureInCelsius: int
+    BatteryVoltage: float
+    ReadingQualityStars: int
+
+
+class ReadingHistory(object):
+    """ Ring buffer of the most recent readings of a single sensor.
+
+    Timestamps must be added in non decreasing order (monotonic clock).
+    Queries never modify the history.
+    """
+
+    _capacity: int
+    _count: int
+    _head: int
+
+    def __init__(self, capacity: int = DEFAULT_HISTORY_SIZE):
+        if capacity < 1:
+            raise ValueError(f"History capacity must be at least 1 ({capacity})")
+        self._capacity = capacity
+        self._count = 0
+        self._head = 0  # next slot to write
+        self._timestamp = array("d", bytes(8 * capacity))
+        self._rssi = array("b", bytes(capacity))
+        self._level = array("l", [0]) * capacity
+        self._temp = array("b", bytes(capacity))
+        self._battery = array("f", [0.0]) * capacity  # multiples of 1/32 are exact
+        self._quality = array("B", bytes(capacity))
+
+    @property
+    def Capacity(self) -> int:
+        return self._capacity
+
+    def __len__(self) -> int:
+        return self._count
+
+    def Append(self, reading, timestamp: float, level: Optional[int] = None) -> None:
+        """ Add an advertisement (MopekaAdvertisement or compatible).
+        level overrides reading.TankLevelInMM (e.g. from a sensor profile) """
+        i = self._head
+        self._timestamp[i] = timestamp
+        rssi = reading.rssi
+        self._rssi[i] = _RSSI_NOT_AVAILABLE if rssi is None else rssi
+        self._level[i] = reading.TankLevelInMM if level is None else level
+        self._temp[i] = reading.TemperatureInCelsius
+        self._battery[i] = reading.BatteryVoltage
+        self._quality[i] = reading.ReadingQualityStars
+        i += 1
+        self._head = 0 if i == self._capacity else i
+        if self._count < self._capacity:
+            self._count += 1
+
+    def Clear(self) -> None:
+        self._count = 0
+        self._head = 0
+
+    def _slot(self, index: int) -> int:
+        """ array slot of logical index (0 is the oldest reading) """
+        return (self._head - self._count + index) % self._capacity
+
+    def _get(self, slot: int) -> HistoryReading:
+        rssi = self._rssi[slot]
+        return HistoryReading(
+            self._timestamp[slot],
+            None if rssi == _RSSI_NOT_AVAILABLE else rssi,
+            self._level[slot],
+            self._temp[slot],
+            self._battery[slot],
+            self._quality[slot],
+        )
+
+    def Latest(self) -> Optional[HistoryReading]:
+        """ most recent reading or None if empty """
+        if self._count == 0:
+            return None
+        return self._get(self._slot(self._count - 1))
+
+    def GetLast(self, n: int) -> List[HistoryReading]:
+        """ up to n most recent readings, oldest first """
+        n = min(max(n, 0), self._count)
+        return [self._get(self._slot(i)) for i in range(self._count - n, self._count)]
+
+    def _index_since(self, timestamp: float) -> int:
+        """ logical index of the first reading at or after timestamp """
+        lo = 0
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._timestamp[self._slot(mid)] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def GetSince(self, timestamp: float) -> List[HistoryReading]:
+        """ readings at or after timestamp, oldest first """
+        start = self._index_since(timestamp)
+        return [self._get(self._slot(i)) for i in range(start, self._count)]
+
+    def LevelStats(self, n: Optional[int] = None, since: Optional[float] = None) -> Optional[Tuple[int, int, float]]:
+        """ (min, max, mean) TankLevelInMM over the last n readings and/or
+        readings since a timestamp.  Whole history if neither is given.
+        Returns None if no readings match.
+        """
+        start = 0
+        if n is not None:
+            start = max(start, self._count - n)
+        if since is not None:
+            start = max(start, self._index_since(since))
+        if start >= self._count:
+            return None
+
+        level = self._level
+        values = [level[self._slot(i)] for i in range(start, self._count)]
+        return (min(values), max(values), sum(values) / len(values))
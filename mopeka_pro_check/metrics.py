@@ -0,0 +1,220 @@
+"""Low overhead metrics for the Mopeka service
+
+Per sensor counters, parse latency histogram, error counters by reason
+and packet rates over sliding windows.  Exported as a dict or in
+Prometheus text format.
+
+Packet totals come from the service ReadStats counters so ignored packets
+cost nothing extra.  Hot path cost is a dict update per reading and two
+clock reads per parsed packet.  Rates are sampled every
+RATE_SAMPLE_INTERVAL readings and whenever a snapshot is taken.
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+RATE_SAMPLE_INTERVAL = 64
+""" Packet rate is sampled every N readings so the clock isn't read per packet.  Power of 2 """
+
+DEFAULT_RATE_WINDOWS = (10.0, 60.0, 300.0)
+""" Sliding windows in seconds that packet rates are reported for """
+
+_HISTOGRAM_BUCKETS = 24
+""" Power of 2 nanosecond buckets.  Last bucket is ~8.4ms and above """
+
+
+class LatencyHistogram(object):
+    """ Histogram with power of 2 nanosecond buckets """
+
+    __slots__ = ("counts", "count", "sum_ns")
+
+    def __init__(self):
+        self.counts = [0] * (_HISTOGRAM_BUCKETS + 1)
+        self.count = 0
+        self.sum_ns = 0
+
+    def Observe(self, ns: int) -> None:
+        index = ns.bit_length()
+        self.counts[index if index < _HISTOGRAM_BUCKETS else _HISTOGRAM_BUCKETS] += 1
+        self.count += 1
+        self.sum_ns += ns
+
+    def Buckets(self) -> List[Tuple[float, int]]:
+        """ cumulative (upper bound in seconds, count) pairs.  Last bound is inf """
+        out = []
+        total = 0
+        for i, c in enumerate(self.counts):
+            total += c
+            bound = float("inf") if i == _HISTOGRAM_BUCKETS else (1 << i) / 1e9
+            out.append((bound, total))
+        return out
+
+    def Percentile(self, p: float) -> Optional[float]:
+        """ approximate percentile in seconds (bucket upper bound) """
+        if self.count == 0:
+            return None
+        target = self.count * p / 100
+        for bound, total in self.Buckets():
+            if total >= target:
+                return bound
+        return None
+
+
+class RateWindow(object):
+    """ Packet rate over sliding windows from periodic (time, total) samples """
+
+    def __init__(self, windows=DEFAULT_RATE_WINDOWS):
+        self.windows = tuple(windows)
+        self._samples: Deque[Tuple[float, int]] = deque()
+
+    def Sample(self, total: int, now: Optional[float] = None) -> None:
+        if now is None:
+            now = time.monotonic()
+        samples = self._samples
+        samples.append((now, total))
+        # keep one sample older than the largest window
+        horizon = now - self.windows[-1]
+        while len(samples) > 2 and samples[1][0] <= horizon:
+            samples.popleft()
+
+    def Rates(self, total: int, now: Optional[float] = None) -> Dict[float, float]:
+        """ packets/sec for each window ending now """
+        if now is None:
+            now = time.monotonic()
+        rates = {}
+        for window in self.windows:
+            start = now - window
+            base = None
+            for t, count in self._samples:
+                if t >= start:
+                    base = (t, count)
+                    break
+            if base is None or now <= base[0]:
+                rates[window] = 0.0
+            else:
+                rates[window] = (total - base[1]) / (now - base[0])
+        return rates
+
+
+class ServiceMetrics(object):
+    """ Metrics collected by MopekaService """
+
+    SensorReadings: Dict[str, int]
+    """ readings per sensor mac """
+
+    SensorErrors: Dict[str, int]
+    """ parse errors per sensor mac """
+
+    Errors: Dict[str, int]
+    """ parse errors per reason (ParseStatus name) """
+
+    ParseLatency: LatencyHistogram
+
+    PacketRate: RateWindow
+
+    def __init__(self, stats, windows=DEFAULT_RATE_WINDOWS):
+        """ stats is the ReadStats of the service that owns these metrics """
+        self.SensorReadings = {}
+        self.SensorErrors = {}
+        self.Errors = {}
+        self.ParseLatency = LatencyHistogram()
+        self.PacketRate = RateWindow(windows)
+        self._stats = stats
+        self._reading_count = 0
+        self.PacketRate.Sample(self.PacketCount)
+
+    @property
+    def PacketCount(self) -> int:
+        """ all advertising reports counted by the service """
+        s = self._stats
+        return (s._ignored_ad_count + s._processed_ad_count + s._error_ad_count
+                + s._zero_length_ad_count + s._duplicate_ad_count)
+
+    def ObserveReading(self, mac: str) -> None:
+        self.SensorReadings[mac] = self.SensorReadings.get(mac, 0) + 1
+        self._reading_count += 1
+        if not (self._reading_count & (RATE_SAMPLE_INTERVAL - 1)):
+            self.PacketRate.Sample(self.PacketCount)
+
+    def ObserveError(self, mac: Optional[str], reason: str) -> None:
+        self.Errors[reason] = self.Errors.get(reason, 0) + 1
+        if mac is not None:
+            self.SensorErrors[mac] = self.SensorErrors.get(mac, 0) + 1
+
+    def _rates(self) -> Dict[float, float]:
+        total = self.PacketCount
+        self.PacketRate.Sample(total)
+        return self.PacketRate.Rates(total)
+
+    def Snapshot(self) -> dict:
+        """ dict of all metrics """
+        latency = self.ParseLatency
+        stats = self._stats
+        snapshot = {
+            "packets": self.PacketCount,
+            "packet_rate": {f"{w:g}s": r for w, r in self._rates().items()},
+            "parse_latency": {
+                "count": latency.count,
+                "sum_seconds": latency.sum_ns / 1e9,
+                "p50_seconds": latency.Percentile(50),
+                "p99_seconds": latency.Percentile(99),
+            },
+            "errors": dict(self.Errors),
+            "sensor_readings": dict(self.SensorReadings),
+            "sensor_errors": dict(self.SensorErrors),
+            "ads": {
+                "ignored": stats._ignored_ad_count,
+                "processed": stats._processed_ad_count,
+                "error": stats._error_ad_count,
+                "zero_length": stats._zero_length_ad_count,
+                "duplicate": stats._duplicate_ad_count,
+            },
+            "suppressed_readings": stats._suppressed_ad_count,
+        }
+        return snapshot
+
+    def ToPrometheus(self, prefix: str = "mopeka") -> str:
+        """ Prometheus text exposition format """
+        stats = self._stats
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP {prefix}_{name} {help}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"{prefix}_{name}{{{label_text}}} {value}" if label_text else f"{prefix}_{name} {value}")
+
+        metric("packets_total", "counter", "HCI advertising reports processed", [((), self.PacketCount)])
+        metric("ads_total", "counter", "Advertisements by result", [
+            ((("result", "ignored"),), stats._ignored_ad_count),
+            ((("result", "processed"),), stats._processed_ad_count),
+            ((("result", "error"),), stats._error_ad_count),
+            ((("result", "zero_length"),), stats._zero_length_ad_count),
+            ((("result", "duplicate"),), stats._duplicate_ad_count),
+        ])
+        metric("suppressed_readings_total", "counter", "Readings not reported because they changed less than the threshold",
+               [((), stats._suppressed_ad_count)])
+        metric("packet_rate", "gauge", "Packets per second over a sliding window",
+               [((("window", f"{w:g}s"),), f"{r:.3f}") for w, r in self._rates().items()])
+        metric("parse_errors_total", "counter", "Parse errors by reason",
+               [((("reason", k),), v) for k, v in sorted(self.Errors.items())])
+        metric("sensor_readings_total", "counter", "Readings per sensor",
+               [((("mac", k),), v) for k, v in sorted(self.SensorReadings.items())])
+        metric("sensor_errors_total", "counter", "Parse errors per sensor",
+               [((("mac", k),), v) for k, v in sorted(self.SensorErrors.items())])
+
+        name = f"{prefix}_parse_latency_seconds"
+        lines.append(f"# HELP {name} Advertisement parse latency")
+        lines.append(f"# TYPE {name} histogram")
+        for bound, total in self.ParseLatency.Buckets():
+            le = "+Inf" if bound == float("inf") else f"{bound:.9g}"
+            lines.append(f'{name}_bucket{{le="{le}"}} {total}')
+        lines.append(f"{name}_sum {self.ParseLatency.sum_ns / 1e9:.9g}")
+        lines.append(f"{name}_count {self.ParseLatency.count}")
+        return "\n".join(lines) + "\n"
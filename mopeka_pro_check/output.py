@@ -0,0 +1,258 @@
+"""Streaming reading output
+
+ReadingWriter turns readings into newline delimited JSON or CSV lines for
+the command line gateway.  Like the ReadingStore, the scanning thread only
+queues (timestamp, sensor, reading) and a background thread formats and
+writes whatever has queued in one write per flush interval, so the cost on
+the scanning thread is an append and the cost per line is one string
+format.
+
+Files can be rotated by size: path is renamed to path.1, path.1 to path.2
+and so on up to backup_count.  CSV files start with a header line.
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+from collections import deque
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Callable, List, Optional, TextIO
+
+_LOGGER = logging.getLogger(__name__)
+
+OUTPUT_FORMATS = ("ndjson", "csv")
+
+CSV_FIELDS = (
+    "timestamp",
+    "mac",
+    "hardware_id",
+    "level_mm",
+    "temperature_c",
+    "battery_v",
+    "battery_percent",
+    "quality",
+    "rssi",
+    "sync_button",
+)
+""" Columns of the csv format.  ndjson uses the same names """
+
+DEFAULT_QUEUE_SIZE = 65536
+""" Readings buffered for the writer thread before new readings are dropped """
+
+DEFAULT_FLUSH_INTERVAL = 1.0
+""" Seconds between writes """
+
+DEFAULT_BACKUP_COUNT = 5
+""" Rotated files kept """
+
+
+def _json_value(value) -> str:
+    if value is None:
+        return "null"
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    return str(value)
+
+
+def FormatNdjson(timestamp: float, sensor, reading) -> str:
+    """ One JSON object line.  Values are numbers so no escaping is needed """
+    return (
+        f'{{"timestamp":{timestamp:.3f},"mac":"{sensor._mac}","hardware_id":{reading._raw_hardware_id},'
+        f'"level_mm":{sensor.TankLevelInMM(reading)},"temperature_c":{reading.TemperatureInCelsius},'
+        f'"battery_v":{reading.BatteryVoltage},"battery_percent":{reading.BatteryPercent:.1f},'
+        f'"quality":{reading.ReadingQualityStars},"rssi":{_json_value(reading.rssi)},'
+        f'"sync_button":{_json_value(reading.SyncButtonPressed)}}}\n'
+    )
+
+
+def FormatCsv(timestamp: float, sensor, reading) -> str:
+    """ One csv line in CSV_FIELDS order """
+    rssi = reading.rssi
+    return (
+        f"{timestamp:.3f},{sensor._mac},{reading._raw_hardware_id},{sensor.TankLevelInMM(reading)},"
+        f"{reading.TemperatureInCelsius},{reading.BatteryVoltage},{reading.BatteryPercent:.1f},"
+        f"{reading.ReadingQualityStars},{'' if rssi is None else rssi},{int(reading.SyncButtonPressed)}\n"
+    )
+
+
+_FORMATTERS = {"ndjson": FormatNdjson, "csv": FormatCsv}
+
+
+class ReadingWriter(object):
+    """ Batched, optionally rotated, reading output
+
+    ``` python
+    with ReadingWriter("readings.ndjson") as writer:
+        service.AddReadingCallback(writer.OnReading)
+        ...
+    ```
+    """
+
+    DroppedCount: int
+    """ readings dropped because the queue was full """
+
+    WrittenCount: int
+    """ lines written """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        fmt: str = "ndjson",
+        max_bytes: int = 0,
+        backup_count: int = DEFAULT_BACKUP_COUNT,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+        clock: Callable[[], float] = time.time,
+        stream: Optional[TextIO] = None,
+        block: bool = False,
+    ):
+        """ path of None writes to stream (default stdout).  max_bytes of 0
+        never rotates.  clock stamps each reading when it is queued.  block
+        makes OnReading wait for the writer instead of dropping when the
+        queue is full (for replays, never for live scanning) """
+        if fmt not in _FORMATTERS:
+            raise ValueError(f"Unknown output format {fmt!r}")
+        self.path = path
+        self.Format = fmt
+        self.MaxBytes = max_bytes
+        self.BackupCount = backup_count
+        self.Clock = clock
+        self.Block = block
+        self.DroppedCount = 0
+        self.WrittenCount = 0
+        self._format = _FORMATTERS[fmt]
+        self._flush_interval = flush_interval
+        self._queue_size = queue_size
+        self._queue = deque()
+        self._size = 0
+        self._header_size = 0
+        if path is None:
+            self._file = sys.stdout if stream is None else stream
+            self._owns_file = False
+            self._write_header()
+        else:
+            self._file = None
+            self._owns_file = True
+            self._open()
+        self._closing = False
+        self._wake = threading.Event()
+        self._drain_cond = threading.Condition()
+        self._drains_started = 0
+        self._drains_completed = 0
+        self._thread = threading.Thread(target=self._writer, name="mopeka-output", daemon=True)
+        self._thread.start()
+
+    def _write_header(self) -> None:
+        if self.Format == "csv":
+            header = ",".join(CSV_FIELDS) + "\n"
+            self._file.write(header)
+            self._size += len(header)
+            self._header_size = len(header)
+
+    def _open(self) -> None:
+        """ open path for append.  A new or empty file gets the csv header """
+        self._file = open(self.path, "a", encoding="ascii", newline="")
+        self._size = self._file.tell()
+        if self._size == 0:
+            self._write_header()
+
+    def _rotate(self) -> None:
+        self._file.close()
+        for i in range(self.BackupCount - 1, 0, -1):
+            source = f"{self.path}.{i}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{i + 1}")
+        if self.BackupCount > 0:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    ##
+    ## Scanning thread side
+    ##
+    def OnReading(self, sensor, reading) -> None:
+        """ MopekaService reading callback.  When the queue is full the reading
+        is dropped and counted, or with Block set waits for the writer """
+        if len(self._queue) >= self._queue_size:
+            if not self.Block:
+                self.DroppedCount += 1
+                return
+            self.Flush()
+        self._queue.append((self.Clock(), sensor, reading))
+
+    ##
+    ## Writer thread
+    ##
+    def _writer(self) -> None:
+        while True:
+            self._wake.wait(self._flush_interval)
+            self._wake.clear()
+            closing = self._closing
+            with self._drain_cond:
+                self._drains_started += 1
+                drain = self._drains_started
+            try:
+                self._drain()
+            except Exception:
+                _LOGGER.exception("Writing readings failed")
+            with self._drain_cond:
+                self._drains_completed = drain
+                self._drain_cond.notify_all()
+            if closing:
+                return
+
+    def _drain(self) -> None:
+        q = self._queue
+        fmt = self._format
+        lines: List[str] = []
+        size = 0
+        max_bytes = self.MaxBytes if self._owns_file else 0
+        while q:
+            line = fmt(*q.popleft())
+            if max_bytes and self._size + size + len(line) > max_bytes and (lines or self._size > self._header_size):
+                if lines:
+                    self._write(lines)
+                self._rotate()
+                lines = []
+                size = 0
+            lines.append(line)
+            size += len(line)
+        if lines:
+            self._write(lines)
+
+    def _write(self, lines: List[str]) -> None:
+        data = "".join(lines)
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+        self.WrittenCount += len(lines)
+
+    def Flush(self, timeout: float = 5.0) -> bool:
+        """ Wait until everything queued so far is written.  False on timeout """
+        with self._drain_cond:
+            # a drain in progress may have missed our readings so wait for the next one
+            target = self._drains_started + 1
+            self._wake.set()
+            return self._drain_cond.wait_for(lambda: self._drains_completed >= target, timeout)
+
+    def Close(self) -> None:
+        """ Write everything queued and close the file """
+        self._closing = True
+        self._wake.set()
+        self._thread.join()
+        if self._owns_file:
+            self._file.close()
+
+    def __enter__(self) -> "ReadingWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.Close()
@@ -0,0 +1,416 @@
+"""Multiprocess parsing pipeline
+
+For sites with so much BLE traffic that parsing on the bleson callback
+thread can't keep up.  The callback only copies hci_packet.data into a
+shared memory ring buffer.  Worker processes validate and deduplicate the
+packets and return compact records (status, mac, rssi and the 13 byte mfg
+data) through a second ring.  A collector thread in the main process turns
+the records into CompactMopekaAdvertisement objects and updates the
+service's sensors and callbacks.
+
+``` python
+service = MopekaService()
+pipeline = ParsingPipeline(service, workers=4)
+pipeline.Start()
+service.Start()
+...
+service.Stop()
+pipeline.Stop()
+```
+
+Each ring is single producer / single consumer with fixed size slots so
+memory is bounded.  Adapters submit from their own threads so Submit
+takes a lock per input ring.  Packets are routed to a worker by mac so a sensor's
+packets stay in order and its duplicate state lives in one worker.  When a
+worker falls behind its input ring fills and new packets are dropped and
+counted in DroppedCount.
+
+Requires Python 3.8 or later (multiprocessing.shared_memory).  The rest
+of the package still runs on 3.7.
+
+Differences from parsing inline:
+ - Readings are CompactMopekaAdvertisement objects.
+ - Repeated payloads are dropped by the workers so polling consumers only
+   get a reading from GetReading when the payload changed.
+ - ParseLatency metrics are not recorded.
+ - SensorHealth only sees advertisements with a new payload.
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from typing import List, Optional
+
+from .advertisement import (
+    CompactMopekaAdvertisement,
+    IsMopekaAdvertisement,
+    MOPEKA_MFG_DATA_LENGTH,
+    ParseStatus,
+    _scan_gap,
+)
+from .service import ServiceScanningMode
+
+try:
+    from multiprocessing import shared_memory
+except ImportError as e:
+    raise ImportError("mopeka_pro_check.pipeline requires Python 3.8 or later") from e
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_RING_SIZE = 8192
+""" Slots in each worker's input and output ring (power of 2) """
+
+DEFAULT_BATCH_SIZE = 256
+""" Most items taken from a ring at once """
+
+DEFAULT_DEDUP_ENTRIES = 4096
+""" Macs a worker remembers for duplicate detection before it starts over """
+
+_IDLE_SLEEP = 0.0005
+
+_PACKET_SLOT_SIZE = 64
+""" legacy advertising reports are at most 43 bytes """
+
+_RECORD_SLOT_SIZE = 2 + 1 + 6 + 1 + MOPEKA_MFG_DATA_LENGTH
+""" slot header + status + raw mac + rssi byte + mfg data """
+
+_NO_ADAPTER = 0xFF
+
+# counters in the ring header
+_MODE = 0
+""" input ring: 1 while the service is in discovery mode """
+_DUPLICATES = 1
+""" output ring: packets dropped as repeated payloads """
+_IGNORED = 2
+""" output ring: packets that were not Mopeka readings in discovery mode """
+_COUNTERS = 8
+
+_HEAD = 0
+_TAIL = 8  # separate cache line from head
+_HEADER_SIZE = 256
+
+
+class SharedRing(object):
+    """ Single producer single consumer ring buffer in shared memory.
+
+    Each slot holds a length byte, a tag byte and up to slot_size - 2 bytes
+    of payload.  The producer publishes the head after writing the slot and
+    the consumer publishes the tail after copying items out.  head and tail
+    are free running 64 bit counters.
+    """
+
+    def __init__(self, capacity: int = DEFAULT_RING_SIZE, slot_size: int = _PACKET_SLOT_SIZE, name: Optional[str] = None):
+        """ create a new ring or attach to an existing one by name """
+        if capacity & (capacity - 1):
+            raise ValueError("capacity must be a power of 2")
+        self.Capacity = capacity
+        self.SlotSize = slot_size
+        size = _HEADER_SIZE + capacity * slot_size
+        self._owner = name is None
+        self._shm = shared_memory.SharedMemory(name=name, create=self._owner, size=size)
+        self.Name = self._shm.name
+        self._buf = self._shm.buf
+        self._index = self._buf[:_HEADER_SIZE].cast("Q")
+        self.Counters = self._buf[128 : 128 + 8 * _COUNTERS].cast("Q")
+        self._mask = capacity - 1
+        # cached values of the counters owned by this side and last seen of the other
+        self._head = self._index[_HEAD]
+        self._tail = self._index[_TAIL]
+        self._tail_seen = self._tail
+
+    def Put(self, data: bytes, tag: int = 0) -> bool:
+        """ producer: add an item.  False if the ring is full or the item too big """
+        head = self._head
+        if head - self._tail_seen >= self.Capacity:
+            self._tail_seen = self._index[_TAIL]
+            if head - self._tail_seen >= self.Capacity:
+                return False
+        length = len(data)
+        if length > self.SlotSize - 2:
+            return False
+        offset = _HEADER_SIZE + (head & self._mask) * self.SlotSize
+        self._buf[offset] = length
+        self._buf[offset + 1] = tag
+        self._buf[offset + 2 : offset + 2 + length] = data
+        self._head = head + 1
+        self._index[_HEAD] = head + 1
+        return True
+
+    def GetMany(self, limit: int = DEFAULT_BATCH_SIZE) -> List[tuple]:
+        """ consumer: remove up to limit (tag, data) items """
+        tail = self._tail
+        available = self._index[_HEAD] - tail
+        if available <= 0:
+            return []
+        if available > limit:
+            available = limit
+        buf = self._buf
+        mask = self._mask
+        slot_size = self.SlotSize
+        items = []
+        for i in range(tail, tail + available):
+            offset = _HEADER_SIZE + (i & mask) * slot_size
+            items.append((buf[offset + 1], bytes(buf[offset + 2 : offset + 2 + buf[offset]])))
+        self._tail = tail + available
+        self._index[_TAIL] = tail + available
+        return items
+
+    def __len__(self) -> int:
+        return self._index[_HEAD] - self._index[_TAIL]
+
+    def Close(self) -> None:
+        """ detach.  The creating side also frees the shared memory """
+        if self._shm is None:
+            return
+        self._index.release()
+        self.Counters.release()
+        self._buf = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+        self._shm = None
+
+
+def _worker(in_name: str, out_name: str, capacity: int, dedup_entries: int, stop) -> None:
+    """ worker process: parse and deduplicate packets from one input ring """
+    packets = SharedRing(capacity, _PACKET_SLOT_SIZE, in_name)
+    records = SharedRing(capacity, _RECORD_SLOT_SIZE, out_name)
+    last_mfg = dict()
+    try:
+        while True:
+            items = packets.GetMany()
+            if not items:
+                if stop.is_set() and len(packets) == 0:
+                    # input is drained.  Nothing is submitted after stop
+                    break
+                time.sleep(_IDLE_SLEEP)
+                continue
+
+            discovery = packets.Counters[_MODE]
+            for tag, data in items:
+                if discovery and not IsMopekaAdvertisement(data):
+                    records.Counters[_IGNORED] += 1
+                    continue
+                status, offset, _name_offset = _scan_gap(data)
+                raw_mac = data[3:9]
+                if status == ParseStatus.OK:
+                    mfg = data[offset : offset + MOPEKA_MFG_DATA_LENGTH]
+                    if last_mfg.get(raw_mac) == mfg:
+                        records.Counters[_DUPLICATES] += 1
+                        continue
+                    if len(last_mfg) >= dedup_entries:
+                        last_mfg.clear()
+                    last_mfg[raw_mac] = mfg
+                    record = bytes((ParseStatus.OK,)) + raw_mac + data[-1:] + mfg
+                elif discovery:
+                    records.Counters[_IGNORED] += 1
+                    continue
+                else:
+                    record = bytes((status,)) + raw_mac
+                # back pressure: wait for the main process to catch up
+                while not records.Put(record, tag):
+                    if not multiprocessing.parent_process().is_alive():
+                        return
+                    time.sleep(_IDLE_SLEEP)
+    finally:
+        packets.Close()
+        records.Close()
+
+
+class ParsingPipeline(object):
+    """ Parse advertisements for a MopekaService in worker processes """
+
+    def __init__(
+        self,
+        service,
+        workers: Optional[int] = None,
+        ring_size: int = DEFAULT_RING_SIZE,
+        dedup_entries: int = DEFAULT_DEDUP_ENTRIES,
+        start_method: str = "spawn",
+    ):
+        """ workers defaults to the cpu count.  start_method is passed to
+        multiprocessing.get_context.  spawn is safe with bleson's threads """
+        self.Service = service
+        self.Workers = workers or os.cpu_count() or 1
+        self.RingSize = ring_size
+        self.DedupEntries = dedup_entries
+        self._context = multiprocessing.get_context(start_method)
+        self._packets: List[SharedRing] = []
+        self._records: List[SharedRing] = []
+        self._processes = []
+        self._stop = None
+        self._collector = None
+        self._running = False
+        self._counted = []
+        # per input ring, guarded by its submit lock.  Each adapter thread
+        # is a producer so the ring and its counters need one at a time
+        self._submit_locks = [threading.Lock() for _ in range(self.Workers)]
+        self._submitted = [0] * self.Workers
+        self._dropped = [0] * self.Workers
+        # packets the workers finished with.  Collector thread only.  Used by Flush
+        self._completed = 0
+
+    def Start(self) -> None:
+        """ start the workers and route the service's packets through them """
+        if self._running:
+            return
+        self._stop = self._context.Event()
+        self._packets = [SharedRing(self.RingSize, _PACKET_SLOT_SIZE) for _ in range(self.Workers)]
+        self._records = [SharedRing(self.RingSize, _RECORD_SLOT_SIZE) for _ in range(self.Workers)]
+        self._counted = [[0, 0] for _ in range(self.Workers)]
+        self._processes = []
+        for packets, records in zip(self._packets, self._records):
+            p = self._context.Process(
+                target=_worker,
+                args=(packets.Name, records.Name, self.RingSize, self.DedupEntries, self._stop),
+                daemon=True,
+            )
+            p.start()
+            self._processes.append(p)
+        self._running = True
+        self._sync_mode()
+        self._collector = threading.Thread(target=self._collect, name="MopekaPipelineCollector", daemon=True)
+        self._collector.start()
+        self.Service.Pipeline = self
+
+    def Stop(self, timeout: float = 5.0) -> None:
+        """ stop routing packets, let the workers drain their rings and
+        deliver the remaining readings, then free the shared memory """
+        if not self._running:
+            return
+        self.Service.Pipeline = None
+        # adapter threads that read Service.Pipeline before it was cleared may
+        # still be in Submit.  With every submit lock held once no new
+        # packets can be queued and the rings are only ours to close
+        packets = self._packets
+        for lock in self._submit_locks:
+            lock.acquire()
+        self._packets = []
+        for lock in self._submit_locks:
+            lock.release()
+        self._stop.set()
+        for p in self._processes:
+            p.join(timeout)
+            if p.is_alive():
+                _LOGGER.warning("Pipeline worker %d did not stop.  Terminating", p.pid)
+                p.terminate()
+                p.join()
+        self._running = False
+        self._collector.join()
+        for ring in packets + self._records:
+            ring.Close()
+        self._records = []
+
+    def __enter__(self) -> "ParsingPipeline":
+        self.Start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.Stop()
+
+    @property
+    def DroppedCount(self) -> int:
+        """ packets dropped because a worker's input ring was full """
+        return sum(self._dropped)
+
+    def Submit(self, data: bytes, adapter_index: Optional[int] = None) -> None:
+        """ Queue hci packet data for the workers.  Called on the adapter threads.
+
+        Packets from macs the service would ignore are dropped here with a
+        dictionary lookup, same as parsing inline.
+        """
+        service = self.Service
+        raw_mac = bytes(data[3:9])
+        if service._scanning_mode == ServiceScanningMode.DISCOVERY_MODE:
+            if raw_mac in service._discovered_by_raw_mac:
+                return
+        elif raw_mac not in service._monitored_by_raw_mac:
+            service.ServiceStats._ignored_ad_count += 1
+            return
+        tag = _NO_ADAPTER if adapter_index is None else adapter_index
+        worker = raw_mac[0] % self.Workers
+        with self._submit_locks[worker]:
+            packets = self._packets
+            if not packets:
+                # stopped
+                return
+            if packets[worker].Put(data, tag):
+                self._submitted[worker] += 1
+            else:
+                self._dropped[worker] += 1
+
+    def Flush(self, timeout: float = 5.0) -> bool:
+        """ wait until everything submitted so far is delivered.
+        Repeated payloads are not delivered.  False on timeout """
+        end = time.monotonic() + timeout
+        target = sum(self._submitted)
+        while self._completed < target:
+            if time.monotonic() > end:
+                return False
+            time.sleep(_IDLE_SLEEP)
+        return True
+
+    def _sync_mode(self) -> None:
+        discovery = 1 if self.Service._scanning_mode == ServiceScanningMode.DISCOVERY_MODE else 0
+        for ring in self._packets:
+            if ring.Counters[_MODE] != discovery:
+                ring.Counters[_MODE] = discovery
+
+    def _sync_counters(self) -> None:
+        stats = self.Service.ServiceStats
+        for ring, counted in zip(self._records, self._counted):
+            duplicates = ring.Counters[_DUPLICATES]
+            ignored = ring.Counters[_IGNORED]
+            stats._duplicate_ad_count += duplicates - counted[0]
+            stats._ignored_ad_count += ignored - counted[1]
+            self._completed += duplicates - counted[0] + ignored - counted[1]
+            counted[0] = duplicates
+            counted[1] = ignored
+
+    def _collect(self) -> None:
+        """ main process thread applying worker records to the service """
+        while True:
+            workers_done = not any(p.is_alive() for p in self._processes)
+            delivered = 0
+            for ring in self._records:
+                items = ring.GetMany()
+                delivered += len(items)
+                for tag, record in items:
+                    try:
+                        self._apply(tag, record)
+                    except Exception:
+                        _LOGGER.exception("Failed to apply pipeline record")
+                self._completed += len(items)
+            self._sync_counters()
+            if not delivered:
+                if workers_done:
+                    return
+                self._sync_mode()
+                time.sleep(_IDLE_SLEEP)
+
+    def _apply(self, tag: int, record: bytes) -> None:
+        service = self.Service
+        status = ParseStatus(record[0])
+        raw_mac = record[1:7]
+        adapter_index = None if tag == _NO_ADAPTER else tag
+        if service._scanning_mode == ServiceScanningMode.DISCOVERY_MODE:
+            if raw_mac not in service._discovered_by_raw_mac:
+                ma = CompactMopekaAdvertisement.FromMfgData(raw_mac, record[8:], record[7])
+                service._apply_discovery(raw_mac, ma)
+            return
+
+        sensor = service._monitored_by_raw_mac.get(raw_mac)
+        if sensor is None:
+            # removed while the packet was in flight
+            service.ServiceStats._ignored_ad_count += 1
+        elif status == ParseStatus.OK:
+            ma = CompactMopekaAdvertisement.FromMfgData(raw_mac, record[8:], record[7])
+            service._apply_reading(sensor, ma, None, adapter_index)
+        else:
+            service._apply_parse_failure(sensor, status)
@@ -0,0 +1,106 @@
+"""Fluid and hardware profiles.
+
+A profile turns the raw tank level of a reading into mm using a set of
+calibration coefficients.  Each profile precomputes a 128 entry table
+indexed by the raw temperature so conversion is one multiply.
+
+The built in profiles match the default tables used by the advertisement
+classes.  Registering a profile with default=True replaces the table used
+for its hardware id everywhere (MopekaAdvertisement.TankLevelInMM, the
+service and the batch decoder).
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+from typing import Dict, Optional, Tuple
+
+from .forecast import PROPANE_THERMAL_EXPANSION, WATER_THERMAL_EXPANSION
+from .advertisement import (
+    BuildLevelFactorTable,
+    HARDWARE_LEVEL_FACTOR_TABLES,
+    HardwareId,
+    MOPEKA_TANK_LEVEL_COEFFICIENTS_AIR,
+    MOPEKA_TANK_LEVEL_COEFFICIENTS_PROPANE,
+    MOPEKA_TANK_LEVEL_COEFFICIENTS_WATER,
+)
+
+
+class SensorProfile(object):
+    """ Calibration for one fluid measured by one kind of sensor hardware """
+
+    __slots__ = ("Name", "HardwareId", "Coefficients", "MeasuresAirSpace", "ThermalExpansion", "LevelFactors")
+
+    def __init__(
+        self,
+        name: str,
+        hardware_id: HardwareId,
+        coefficients: Tuple[float, float, float],
+        measures_air_space: bool = False,
+        thermal_expansion: float = 0.0,
+    ):
+        """ measures_air_space is True for top down sensors that report the
+        distance from the sensor to the fluid instead of the fluid depth.
+        thermal_expansion is the relative volume change of the fluid per
+        degree Celsius (used by the consumption forecast) """
+        self.Name = name
+        self.HardwareId = hardware_id
+        self.Coefficients = tuple(coefficients)
+        self.MeasuresAirSpace = measures_air_space
+        self.ThermalExpansion = thermal_expansion
+        self.LevelFactors = BuildLevelFactorTable(self.Coefficients)
+
+    def TankLevelInMM(self, reading) -> int:
+        """ level in mm of a reading (MopekaAdvertisement or compatible) """
+        return int(reading._raw_tank_level * self.LevelFactors[reading._raw_temp])
+
+    def __repr__(self) -> str:
+        return f"SensorProfile({self.Name!r}, {self.HardwareId}, {self.Coefficients})"
+
+
+PROPANE = SensorProfile(
+    "propane",
+    HardwareId.STD_BOTTOM_UP_PROPANE,
+    MOPEKA_TANK_LEVEL_COEFFICIENTS_PROPANE,
+    thermal_expansion=PROPANE_THERMAL_EXPANSION,
+)
+AIR_SPACE = SensorProfile(
+    "air_space",
+    HardwareId.TOP_DOWN_AIR_SPACE,
+    MOPEKA_TANK_LEVEL_COEFFICIENTS_AIR,
+    True,
+    thermal_expansion=PROPANE_THERMAL_EXPANSION,
+)
+WATER = SensorProfile(
+    "water",
+    HardwareId.BOTTOM_UP_WATER,
+    MOPEKA_TANK_LEVEL_COEFFICIENTS_WATER,
+    thermal_expansion=WATER_THERMAL_EXPANSION,
+)
+
+_profiles: Dict[str, SensorProfile] = {p.Name: p for p in (PROPANE, AIR_SPACE, WATER)}
+_default_profiles: Dict[HardwareId, SensorProfile] = {p.HardwareId: p for p in (PROPANE, AIR_SPACE, WATER)}
+
+
+def RegisterProfile(profile: SensorProfile, default: bool = False) -> None:
+    """ Make a profile available by name.  default=True also makes it the
+    profile used for readings from its hardware id """
+    _profiles[profile.Name] = profile
+    if default:
+        _default_profiles[profile.HardwareId] = profile
+        HARDWARE_LEVEL_FACTOR_TABLES[profile.HardwareId.value] = profile.LevelFactors
+
+
+def GetProfile(name: str) -> SensorProfile:
+    """ Registered profile by name.  Raises KeyError if unknown """
+    return _profiles[name]
+
+
+def GetDefaultProfile(hardware_id: HardwareId) -> Optional[SensorProfile]:
+    """ Profile used for readings from hardware_id or None if unsupported """
+    return _default_profiles.get(hardware_id)
+
+
+def ProfileNames() -> Tuple[str, ...]:
+    return tuple(_profiles)
@@ -0,0 +1,232 @@
+"""Offline HCI capture replay
+
+Reads recorded LE advertising reports and feeds them through a
+MopekaService without a BLE adapter.  Two capture formats are supported:
+
+* btsnoop (as written by hcidump / btmon / Android) with H4 or HCI
+  monitor style records.  Only LE advertising report events are used.
+* A simple capture format written by CaptureWriter.  Header is
+  CAPTURE_MAGIC followed by records of (timestamp: float64 seconds,
+  length: uint16, data: length bytes) all little endian.  data is the
+  same buffer bleson provides as hci_packet.data.
+
+Also includes a synthetic traffic generator for tests and benchmarks.
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import random
+import struct
+import time
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from .advertisement import MacToRaw
+from .hci import EVT_LE_ADVERTISING_REPORT
+
+CAPTURE_MAGIC = b"MPKCAP\x01\x00"
+""" Header of the simple capture format (version 1) """
+
+BTSNOOP_MAGIC = b"btsnoop\x00"
+
+_RECORD = struct.Struct("<dH")
+_BTSNOOP_HEADER = struct.Struct(">II")  # version, datalink
+_BTSNOOP_RECORD = struct.Struct(">IIIIq")  # orig len, incl len, flags, drops, timestamp us
+_BTSNOOP_DATALINK_H4 = 1002
+_BTSNOOP_DATALINK_MONITOR = 2001
+_HCI_EVENT_PACKET = 0x04
+_HCI_EVT_LE_META = 0x3E
+
+# btsnoop timestamps are microseconds since 0 AD
+_BTSNOOP_EPOCH_DELTA_US = 0x00DCDDB30F2F8000
+
+CaptureRecord = Tuple[float, bytes]
+""" (timestamp in seconds, hci_packet.data) """
+
+
+class ReplayPacket(object):
+    """ Minimal stand in for a bleson HCIPacket """
+
+    __slots__ = ("subevent_code", "data")
+
+    def __init__(self, data: bytes):
+        self.subevent_code = EVT_LE_ADVERTISING_REPORT
+        self.data = data
+
+
+class CaptureWriter(object):
+    """ Writes hci_packet.data buffers to the simple capture format """
+
+    def __init__(self, stream: BinaryIO):
+        self._stream = stream
+        self._stream.write(CAPTURE_MAGIC)
+
+    def Write(self, data: bytes, timestamp: Optional[float] = None) -> None:
+        if timestamp is None:
+            timestamp = time.time()
+        self._stream.write(_RECORD.pack(timestamp, len(data)))
+        self._stream.write(data)
+
+    def WriteAll(self, records: Iterable[CaptureRecord]) -> None:
+        for timestamp, data in records:
+            self.Write(data, timestamp)
+
+
+def _read_simple(stream: BinaryIO) -> Iterator[CaptureRecord]:
+    while True:
+        header = stream.read(_RECORD.size)
+        if len(header) < _RECORD.size:
+            return
+        timestamp, length = _RECORD.unpack(header)
+        data = stream.read(length)
+        if len(data) < length:
+            return
+        yield (timestamp, data)
+
+
+def _read_btsnoop(stream: BinaryIO) -> Iterator[CaptureRecord]:
+    _version, datalink = _BTSNOOP_HEADER.unpack(stream.read(_BTSNOOP_HEADER.size))
+    while True:
+        header = stream.read(_BTSNOOP_RECORD.size)
+        if len(header) < _BTSNOOP_RECORD.size:
+            return
+        _orig_len, incl_len, flags, _drops, timestamp = _BTSNOOP_RECORD.unpack(header)
+        packet = stream.read(incl_len)
+        if len(packet) < incl_len:
+            return
+
+        if datalink == _BTSNOOP_DATALINK_H4:
+            # H4: packet type byte then the hci event
+            if len(packet) < 1 or packet[0] != _HCI_EVENT_PACKET:
+                continue
+            event = packet[1:]
+        elif datalink == _BTSNOOP_DATALINK_MONITOR:
+            # monitor: flags is (adapter index << 16) | opcode, 3 == event packet
+            if (flags & 0xFFFF) != 3:
+                continue
+            event = packet
+        else:
+            raise ValueError(f"Unsupported btsnoop datalink type {datalink}")
+
+        # event code, parameter length, subevent code, reports
+        if len(event) < 4 or event[0] != _HCI_EVT_LE_META or event[2] != EVT_LE_ADVERTISING_REPORT:
+            continue
+        yield ((timestamp - _BTSNOOP_EPOCH_DELTA_US) / 1e6, event[3:])
+
+
+def ReadCapture(stream: BinaryIO) -> Iterator[CaptureRecord]:
+    """ Read LE advertising reports from a btsnoop or simple capture stream """
+    magic = stream.read(8)
+    if magic == CAPTURE_MAGIC:
+        return _read_simple(stream)
+    if magic == BTSNOOP_MAGIC:
+        return _read_btsnoop(stream)
+    raise ValueError(f"Unknown capture format {magic!r}")
+
+
+def LoadCapture(path: str) -> List[CaptureRecord]:
+    """ Read a whole capture file into memory """
+    with open(path, "rb") as f:
+        return list(ReadCapture(f))
+
+
+def Replay(service, records: Iterable[CaptureRecord], speed: Optional[float] = None) -> int:
+    """ Feed capture records through a MopekaService.
+
+    speed None replays as fast as possible.  Otherwise the recorded timing is
+    followed, scaled by speed (1.0 is real time, 2.0 twice as fast).
+
+    Returns the number of packets replayed.
+    """
+    handler = service.HandleMetaEvent
+    count = 0
+    if speed is None:
+        for _timestamp, data in records:
+            handler(ReplayPacket(data))
+            count += 1
+        return count
+
+    start = None
+    for timestamp, data in records:
+        now = time.monotonic()
+        if start is None:
+            start = (timestamp, now)
+        delay = (timestamp - start[0]) / speed - (now - start[1])
+        if delay > 0:
+            time.sleep(delay)
+        handler(ReplayPacket(data))
+        count += 1
+    return count
+
+
+##
+## Synthetic traffic
+##
+_MOPEKA_TEMPLATE = bytes.fromhex(
+    "01 00 01 76 3C C4 05 9D E7 12 0D FF 59 00 03 5D 31 2C C1 C4 3C 76 3B F9 03 02 E5 FE A0")
+_FOREIGN_TEMPLATE = bytes.fromhex(
+    "01 00 01 3b 69 19 46 88 c0 19 02 01 02 11 09 44 56 33 33 30 30 53 2d 34 2e 30 2d 30 39 33 42 03 03 32 a0 a2")
+
+
+def MakeMopekaPacket(
+    mac: str,
+    raw_level: int = 0x012C,
+    raw_temp: int = 0x31,
+    raw_battery: int = 0x5D,
+    quality: int = 3,
+    button: bool = False,
+    rssi: int = -96,
+    x_accel: Optional[int] = None,
+    y_accel: Optional[int] = None,
+) -> bytes:
+    """ Build a Mopeka advertising report for the given mac and raw values.
+    Accelerometer values are signed.  None keeps the sample packet's """
+    b = bytearray(_MOPEKA_TEMPLATE)
+    b[3:9] = MacToRaw(mac)
+    b[15] = raw_battery & 0x7F
+    b[16] = (raw_temp & 0x7F) | (0x80 if button else 0)
+    b[17] = raw_level & 0xFF
+    b[18] = ((raw_level >> 8) & 0x3F) | ((quality & 0x3) << 6)
+    if x_accel is not None:
+        b[22] = x_accel & 0xFF
+    if y_accel is not None:
+        b[23] = y_accel & 0xFF
+    b[-1] = rssi & 0xFF
+    return bytes(b)
+
+
+def GenerateTraffic(
+    count: int,
+    mopeka_macs: Sequence[str],
+    mopeka_ratio: float = 0.1,
+    foreign_devices: int = 50,
+    interval: float = 0.001,
+    seed: Optional[int] = 0,
+) -> List[CaptureRecord]:
+    """ Generate a mix of Mopeka and non Mopeka advertising reports.
+
+    mopeka_ratio is the fraction of packets from mopeka_macs.  The rest come
+    from foreign_devices random non Mopeka devices.  Records are spaced
+    interval seconds apart.
+    """
+    rng = random.Random(seed)
+    foreign = []
+    for _ in range(foreign_devices):
+        b = bytearray(_FOREIGN_TEMPLATE)
+        b[3:9] = bytes(rng.getrandbits(8) for _ in range(6))
+        foreign.append(bytes(b))
+
+    records = []
+    for i in range(count):
+        if mopeka_macs and rng.random() < mopeka_ratio:
+            data = MakeMopekaPacket(
+                rng.choice(mopeka_macs),
+                raw_level=rng.randrange(0x3FFF),
+                raw_temp=rng.randrange(0x7F),
+                rssi=-rng.randrange(40, 100),
+            )
+        else:
+            data = rng.choice(foreign)
+        records.append((i * interval, data))
+    return records
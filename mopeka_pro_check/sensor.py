@@ -1,34 +1,159 @@
 """Module that represents a Mopeka Pro Check sensor.
 
-Sensor object stores meta info and the last reading.
-It also could support an idea of holding more than one
-reading.
+Sensor object stores meta info, the last reading and
+a bounded history of decoded readings.
 
 Copyright (c) 2021 Sean Brogan
 
 SPDX-License-Identifier: MIT
 
 """
-from typing import Optional
+import time
+from typing import Optional, TYPE_CHECKING
 
-from bleson import BDAddress
+from .hci import ToBDAddress
+from .advertisement import MopekaAdvertisement, MacToRaw
+from .history import ReadingHistory, DEFAULT_HISTORY_SIZE
+from .health import SensorHealth
+from .forecast import ConsumptionForecast
+from .filters import LevelFilter
+from .profiles import SensorProfile, GetDefaultProfile
+from .tank import TankGeometry
 
-from .advertisement import MopekaAdvertisement
+if TYPE_CHECKING:
+  from bleson import BDAddress
 
 class MopekaSensor(object):
   """ Sensor Object """
 
   _mac: str
-  _bdaddress: BDAddress
+  _bdaddress_cache: Optional["BDAddress"]
+  _raw_mac: bytes
   _last_packet: MopekaAdvertisement
+  _last_reading: Optional[MopekaAdvertisement]
+  _last_gap: Optional[bytes]
+  _reported_values: Optional[tuple]
 
-  def __init__(self, mac_address:str ):
+  History: Optional[ReadingHistory]
+  """ Recent decoded readings.  None if history is disabled """
+
+  Profile: Optional[SensorProfile]
+  """ Calibration used for the tank level.  None uses the default for the hardware id """
+
+  Tank: Optional[TankGeometry]
+  """ Tank the sensor is mounted on.  Needed for percent full and volume """
+
+  LastSeen: Optional[float]
+  """ service Clock() time of the last advertisement.  None if never heard """
+
+  Offline: bool
+  """ True after stale detection found the sensor silent.  See MopekaService.EnableStaleDetection """
+
+  StaleTimeout: Optional[float]
+  """ Seconds of silence before the sensor is offline.  None uses the service timeout """
+
+  Health: Optional[SensorHealth]
+  """ Signal and reading quality statistics updated by the service for every
+  advertisement.  Set to None to disable """
+
+  Forecast: Optional[ConsumptionForecast]
+  """ Usage rate and time to empty updated by the service for every
+  reading.  Set to None to disable """
+
+  Filter: Optional[LevelFilter]
+  """ Noise filter for the tank level updated by the service for every
+  reading.  None (default) disables filtering """
+
+  def __init__(self, mac_address:str, history_size: int = DEFAULT_HISTORY_SIZE,
+               profile: Optional[SensorProfile] = None, tank: Optional[TankGeometry] = None):
+    """ Create a sensor.  history_size of 0 disables the reading history """
     self._mac = mac_address
-    self._bdaddress = BDAddress(mac_address)
+    # BDAddress is built on first use so sensors can be used without bleson
+    self._bdaddress_cache = None
+    # mac as it appears in the hci packet (little endian) for fast lookups
+    self._raw_mac = MacToRaw(mac_address)
     self._last_packet = None
+    # most recent reading even after GetReading.  Used with _last_gap by the
+    # service to skip parsing repeated payloads
+    self._last_reading = None
+    self._last_gap = None
+    # values last reported to callbacks when the service uses a change threshold
+    self._reported_values = None
+    self.History = ReadingHistory(history_size) if history_size > 0 else None
+    self.Profile = profile
+    self.Tank = tank
+    self.Health = SensorHealth()
+    self.Forecast = ConsumptionForecast()
+    self.Filter = None
+    self.LastSeen = None
+    self.Offline = False
+    self.StaleTimeout = None
 
-  def AddReading(self, reading_data: MopekaAdvertisement):
+  @property
+  def _bdaddress(self) -> "BDAddress":
+    address = self._bdaddress_cache
+    if address is None:
+      address = self._bdaddress_cache = ToBDAddress(self._mac)
+    return address
+
+  def AddReading(self, reading_data: MopekaAdvertisement, timestamp: Optional[float] = None):
+    """ Set the most recent packet and add it to the history.
+    timestamp defaults to time.monotonic()"""
     self._last_packet = reading_data
+    self._last_reading = reading_data
+    if self.History is not None:
+      self.History.Append(
+        reading_data,
+        time.monotonic() if timestamp is None else timestamp,
+        None if self.Profile is None else self.Profile.TankLevelInMM(reading_data))
+
+  def _update_forecast(self, reading: MopekaAdvertisement, timestamp: float) -> bool:
+    """ Add a reading to Forecast.  Returns True if it completed a refill """
+    forecast = self.Forecast
+    profile = self.Profile or GetDefaultProfile(reading.HardwareId)
+    if profile.MeasuresAirSpace:
+      if self.Tank is None:
+        # fluid height is unknown without the tank
+        return False
+      height = self.Tank.FluidHeightFromAirSpace(profile.TankLevelInMM(reading))
+    else:
+      height = profile.TankLevelInMM(reading)
+    if forecast.ThermalExpansion is None:
+      forecast.ThermalExpansion = profile.ThermalExpansion
+    return forecast.Update(height, reading.TemperatureInCelsius, reading.ReadingQualityStars, timestamp)
+
+  @property
+  def FilteredLevelInMM(self) -> Optional[float]:
+    """ level in mm after the Filter.  None without a filter or accepted reading """
+    return None if self.Filter is None else self.Filter.Value
+
+  def TankLevelInMM(self, reading: MopekaAdvertisement) -> int:
+    """ level of a reading using the sensor profile """
+    if self.Profile is None:
+      return reading.TankLevelInMM
+    return self.Profile.TankLevelInMM(reading)
+
+  def FluidHeightInMM(self, reading: MopekaAdvertisement) -> float:
+    """ height of the fluid.  Top down profiles need a Tank to convert the air space """
+    profile = self.Profile or GetDefaultProfile(reading.HardwareId)
+    level = profile.TankLevelInMM(reading)
+    if profile.MeasuresAirSpace:
+      if self.Tank is None:
+        raise ValueError("Air space profile requires a tank geometry")
+      return self.Tank.FluidHeightFromAirSpace(level)
+    return level
+
+  def PercentFull(self, reading: MopekaAdvertisement) -> float:
+    """ percent full of the sensor Tank.  Requires Tank """
+    if self.Tank is None:
+      raise ValueError("Sensor has no tank geometry")
+    return self.Tank.PercentFull(self.FluidHeightInMM(reading))
+
+  def VolumeInLiters(self, reading: MopekaAdvertisement) -> float:
+    """ volume of fluid in the sensor Tank.  Requires Tank """
+    if self.Tank is None:
+      raise ValueError("Sensor has no tank geometry")
+    return self.Tank.VolumeInLiters(self.FluidHeightInMM(reading))
 
   def GetReading(self) -> Optional[MopekaAdvertisement]:
     """ return the most recent packet and clear it """
@@ -0,0 +1,412 @@
+"""Embedded HTTP endpoint for tank state and Prometheus metrics
+
+    GET /state     JSON list of monitored sensors and their last reading
+    GET /metrics   tank gauges plus the service metrics in Prometheus text format
+
+The scanning thread only sets a flag from the reading, offline and online
+callbacks.  Responses are rendered on the event loop the first time they
+are requested after a change and the complete response is kept as bytes,
+so a poll with nothing new is a dictionary lookup and a single write.
+Sensors whose reading did not change reuse their rendered JSON and
+Prometheus lines.  While readings keep arriving a response is rebuilt at
+most once per render_interval so polling can't compete with scanning for
+the interpreter.
+
+Every body has an ETag.  A request with a matching If-None-Match gets a
+304 with no body.  The service metrics section of /metrics changes with
+every packet so it is re-rendered at most once per metrics_max_age.
+
+Only GET and HEAD are supported.  Connections are kept alive.
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .sensor import MopekaSensor
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_HTTP_HOST = "127.0.0.1"
+""" Only local clients by default """
+
+DEFAULT_HTTP_PORT = 8080
+
+DEFAULT_METRICS_MAX_AGE = 1.0
+""" Seconds a rendered service metrics section is served before it is rebuilt """
+
+DEFAULT_RENDER_INTERVAL = 0.1
+""" Seconds between rebuilds of a response while readings keep changing """
+
+DEFAULT_IDLE_TIMEOUT = 30.0
+""" Seconds a kept alive connection may wait for its next request """
+
+_MAX_HEADER_SIZE = 8192
+
+_JSON_TYPE = "application/json"
+_PROMETHEUS_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_SENSOR_METRICS = (
+    ("level_mm", "Tank level of the last reading"),
+    ("temperature_celsius", "Sensor temperature"),
+    ("battery_volts", "Battery voltage"),
+    ("battery_percent", "Battery charge"),
+    ("quality_stars", "Reading quality 0 to 3"),
+    ("rssi_dbm", "Signal strength of the last reading"),
+    ("usage_rate_mm_per_hour", "Forecast usage rate.  Negative while filling"),
+    ("offline", "1 if the sensor is stale"),
+)
+""" (name, help) of the per sensor gauges in /metrics """
+
+_REASONS = {
+    200: "OK",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+}
+
+
+class _Response(object):
+    """ A rendered body with its ready to send headers """
+
+    __slots__ = ("etag", "full", "head", "not_modified")
+
+    def __init__(self, body: bytes, content_type: str, etag: str):
+        self.etag = etag
+        self.head = (
+            f"HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+            f"ETag: {etag}\r\nCache-Control: no-cache\r\n\r\n"
+        ).encode("ascii")
+        self.full = self.head + body
+        self.not_modified = f"HTTP/1.1 304 Not Modified\r\nETag: {etag}\r\nCache-Control: no-cache\r\n\r\n".encode("ascii")
+
+
+def _json(value) -> str:
+    if value is None:
+        return "null"
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    return str(value)
+
+
+def _error(status: int, extra: str = "") -> bytes:
+    body = _REASONS[status].encode("ascii") + b"\n"
+    return (
+        f"HTTP/1.1 {status} {_REASONS[status]}\r\nContent-Type: text/plain\r\n"
+        f"Content-Length: {len(body)}\r\n{extra}\r\n"
+    ).encode("ascii") + body
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+class StateServer(object):
+    """ asyncio HTTP server for the state of a MopekaService
+
+    ``` python
+    async with StateServer(service, port=8080) as server:
+        await server.ServeForever()
+    ```
+
+    Must be started from a coroutine on the loop that will serve it.
+    Packets can be fed to the service from any thread.
+    """
+
+    RequestCount: int
+    """ requests answered """
+
+    NotModifiedCount: int
+    """ requests answered with 304 """
+
+    RenderCount: int
+    """ times a response body was rebuilt """
+
+    def __init__(
+        self,
+        service,
+        host: str = DEFAULT_HTTP_HOST,
+        port: int = DEFAULT_HTTP_PORT,
+        prefix: str = "mopeka",
+        metrics_max_age: float = DEFAULT_METRICS_MAX_AGE,
+        render_interval: float = DEFAULT_RENDER_INTERVAL,
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+    ):
+        """ port 0 picks a free port (see Port).  prefix is the Prometheus metric
+        name prefix.  With readings arriving constantly a response is rebuilt
+        at most once per render_interval; 0 rebuilds on every change """
+        self.Service = service
+        self.Host = host
+        self.Prefix = prefix
+        self.MetricsMaxAge = metrics_max_age
+        self.RenderInterval = render_interval
+        self.IdleTimeout = idle_timeout
+        self.RequestCount = 0
+        self.NotModifiedCount = 0
+        self.RenderCount = 0
+        self._port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Dict[asyncio.StreamWriter, asyncio.Task] = {}
+        # set by the scanning thread, cleared by the renderer
+        self._dirty = True
+        # etags must not repeat across restarts of the gateway
+        self._instance = os.urandom(4).hex()
+        self._generation = 0
+        self._monitored_version = None
+        self._refreshed_at = 0.0
+        self._responses: Dict[str, _Response] = {}
+        self._metrics_rendered_at = None
+        self._metrics_text = ""
+        # raw mac -> (reading, offline, json object, prometheus sample per _SENSOR_METRICS)
+        self._fragments: Dict[bytes, Tuple[object, bool, str, Tuple[str, ...]]] = {}
+
+    ##
+    ## Scanning thread side
+    ##
+    def _on_change(self, sensor: MopekaSensor, reading=None) -> None:
+        self._dirty = True
+
+    ##
+    ## Lifetime
+    ##
+    @property
+    def Port(self) -> int:
+        """ bound port once started """
+        if self._server is not None and self._server.sockets:
+            return self._server.sockets[0].getsockname()[1]
+        return self._port
+
+    async def Start(self) -> None:
+        """ Attach to the service and start listening """
+        service = self.Service
+        service.AddReadingCallback(self._on_change)
+        service.AddOfflineCallback(self._on_change)
+        service.AddOnlineCallback(self._on_change)
+        self._dirty = True
+        self._server = await asyncio.start_server(
+            self._handle, self.Host, self._port, limit=_MAX_HEADER_SIZE)
+
+    async def ServeForever(self) -> None:
+        await self._server.serve_forever()
+
+    async def Close(self) -> None:
+        """ Stop listening and detach from the service """
+        service = self.Service
+        service.RemoveReadingCallback(self._on_change)
+        service.RemoveOfflineCallback(self._on_change)
+        service.RemoveOnlineCallback(self._on_change)
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        # closing the transport ends the read each kept alive connection is waiting in
+        connections = self._connections
+        for writer in connections:
+            writer.close()
+        await asyncio.gather(*connections.values(), return_exceptions=True)
+
+    async def __aenter__(self) -> "StateServer":
+        await self.Start()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.Close()
+
+    ##
+    ## Rendering.  Event loop only
+    ##
+    def _refresh(self) -> None:
+        """ drop cached responses if a reading or the sensor list changed """
+        version = self.Service.MonitoredListVersion
+        if version == self._monitored_version:
+            if not self._dirty:
+                return
+            now = time.monotonic()
+            if now - self._refreshed_at < self.RenderInterval:
+                # readings arriving faster than RenderInterval are picked up together
+                return
+        else:
+            now = time.monotonic()
+        # clear first so a reading that lands while rendering marks it dirty again
+        self._dirty = False
+        self._refreshed_at = now
+        self._monitored_version = version
+        fragments = self._fragments
+        current = {}
+        changed = False
+        for sensor in list(self.Service.SensorMonitoredList.values()):
+            reading = sensor._last_reading
+            offline = sensor.Offline
+            cached = fragments.get(sensor._raw_mac)
+            if cached is None or cached[0] is not reading or cached[1] != offline:
+                cached = (reading, offline) + self._render_sensor(sensor, reading, offline)
+                changed = True
+            current[sensor._raw_mac] = cached
+        self._fragments = current
+        if changed or len(current) != len(fragments):
+            self._generation += 1
+            self._responses.pop("/state", None)
+            self._responses.pop("/metrics", None)
+
+    def _render_sensor(self, sensor: MopekaSensor, reading, offline: bool) -> Tuple[str, Tuple[Optional[str], ...]]:
+        """ JSON object and the Prometheus sample line for each of _SENSOR_METRICS.
+        Values are numbers and macs are hex so nothing needs escaping """
+        mac = sensor._mac
+        labels = f'{{mac="{mac}"}}'
+        prefix = f"{self.Prefix}_sensor_"
+        offline_sample = f"{prefix}offline{labels} {int(offline)}"
+        if reading is None:
+            return f'{{"mac":"{mac}","offline":{_json(offline)}}}', (None,) * 7 + (offline_sample,)
+        level = sensor.TankLevelInMM(reading)
+        temperature = reading.TemperatureInCelsius
+        battery = reading.BatteryVoltage
+        percent = reading.BatteryPercent
+        quality = reading.ReadingQualityStars
+        rssi = reading.rssi
+        forecast = sensor.Forecast
+        usage = None if forecast is None else forecast.UsageRate
+        state = (
+            f'{{"mac":"{mac}","offline":{_json(offline)},"hardware_id":{reading._raw_hardware_id},'
+            f'"level_mm":{level},"filtered_level_mm":{_json(sensor.FilteredLevelInMM)},'
+            f'"temperature_c":{temperature},"battery_v":{battery},"battery_percent":{percent:.1f},'
+            f'"quality":{quality},"rssi":{_json(rssi)},"sync_button":{_json(reading.SyncButtonPressed)},'
+            f'"usage_rate_mm_per_hour":{_json(usage)}}}'
+        )
+        samples = (
+            f"{prefix}level_mm{labels} {level}",
+            f"{prefix}temperature_celsius{labels} {temperature}",
+            f"{prefix}battery_volts{labels} {battery}",
+            f"{prefix}battery_percent{labels} {percent:.1f}",
+            f"{prefix}quality_stars{labels} {quality}",
+            None if rssi is None else f"{prefix}rssi_dbm{labels} {rssi}",
+            None if usage is None else f"{prefix}usage_rate_mm_per_hour{labels} {usage:.6g}",
+            offline_sample,
+        )
+        return state, samples
+
+    def _state(self) -> _Response:
+        response = self._responses.get("/state")
+        if response is None:
+            body = "[" + ",".join(f[2] for f in self._fragments.values()) + "]\n"
+            response = self._responses["/state"] = _Response(
+                body.encode("utf-8"), _JSON_TYPE, f'"{self._instance}-{self._generation}"')
+            self.RenderCount += 1
+        return response
+
+    def _service_metrics(self) -> str:
+        """ service metrics text.  Rebuilt at most every MetricsMaxAge seconds """
+        now = time.monotonic()
+        rendered_at = self._metrics_rendered_at
+        if rendered_at is None or now - rendered_at >= self.MetricsMaxAge:
+            text = self.Service.GetMetricsPrometheus()
+            self._metrics_rendered_at = now
+            if text != self._metrics_text:
+                self._metrics_text = text
+                self._responses.pop("/metrics", None)
+        return self._metrics_text
+
+    def _metrics(self) -> _Response:
+        service_metrics = self._service_metrics()
+        response = self._responses.get("/metrics")
+        if response is None:
+            prefix = self.Prefix
+            lines: List[str] = []
+            samples = [f[3] for f in self._fragments.values()]
+            # the text format wants every sample of a metric together
+            for i, (name, help) in enumerate(_SENSOR_METRICS):
+                metric = [s[i] for s in samples if s[i] is not None]
+                if metric:
+                    lines.append(f"# HELP {prefix}_sensor_{name} {help}")
+                    lines.append(f"# TYPE {prefix}_sensor_{name} gauge")
+                    lines.extend(metric)
+            body = "\n".join(lines) + ("\n" if lines else "") + service_metrics
+            # service metrics change on their own so they get their own part of the etag
+            response = self._responses["/metrics"] = _Response(
+                body.encode("utf-8"), _PROMETHEUS_TYPE,
+                f'"{self._instance}-{self._generation}-{hash(service_metrics) & 0xFFFFFFFF:x}"')
+            self.RenderCount += 1
+        return response
+
+    _ROUTES = {"/": _state, "/state": _state, "/metrics": _metrics}
+
+    def Render(self, path: str) -> Optional[_Response]:
+        """ current response for path.  None if the path is unknown """
+        route = self._ROUTES.get(path)
+        if route is None:
+            return None
+        self._refresh()
+        return route(self)
+
+    ##
+    ## Connections
+    ##
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.IdleTimeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    return
+                except (asyncio.LimitOverrunError, ValueError):
+                    writer.write(_error(400, "Connection: close\r\n"))
+                    return
+                keep_alive = self._respond(request, writer)
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            del self._connections[writer]
+            writer.close()
+
+    def _respond(self, request: bytes, writer: asyncio.StreamWriter) -> bool:
+        """ write the response to one request.  Returns False to close the connection """
+        lines = request.decode("latin-1").split("\r\n")
+        parts = lines[0].split(" ")
+        if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+            writer.write(_error(400, "Connection: close\r\n"))
+            return False
+        method, target, version = parts
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        # HTTP/1.0 clients get one response per connection
+        keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        self.RequestCount += 1
+        if method not in ("GET", "HEAD"):
+            writer.write(_error(405, "Allow: GET, HEAD\r\n"))
+            return keep_alive
+        response = self.Render(target.partition("?")[0])
+        if response is None:
+            writer.write(_error(404))
+            return keep_alive
+        if_none_match = headers.get("if-none-match")
+        if if_none_match is not None and _etag_matches(if_none_match, response.etag):
+            self.NotModifiedCount += 1
+            writer.write(response.not_modified)
+        elif method == "HEAD":
+            writer.write(response.head)
+        else:
+            writer.write(response.full)
+        return keep_alive
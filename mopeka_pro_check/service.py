@@ -12,18 +12,55 @@ SPDX-License-Identifier: MIT
 
 """
 import logging
+from collections import OrderedDict
 from enum import Enum
-from typing import List, Optional, Dict
-
-from bleson.core.hci.constants import EVT_LE_ADVERTISING_REPORT  # type: ignore
-from bleson import get_provider, BDAddress
-
-from .advertisement import MopekaAdvertisement, NoGapDataException
+import threading
+import time
+from typing import Callable, Iterable, List, NamedTuple, Optional, Dict, Tuple, TYPE_CHECKING
+
+from .hci import EVT_LE_ADVERTISING_REPORT, rssi_from_byte
+from .advertisement import (
+  HardwareId,
+  MopekaAdvertisement,
+  ParseStatus,
+  MOPEKA_MANUFACTURE_ID,
+  _scan_gap,
+)
 from .sensor import MopekaSensor
+from .metrics import ServiceMetrics
+from .health import WorstSensors
+from .timerwheel import TimerWheel
+from .forecast import ForecastIndex
+from .subscriptions import (
+  BatchCallback,
+  ReadingDispatcher,
+  Subscription,
+  DEFAULT_BATCH_SIZE,
+  DEFAULT_FLUSH_INTERVAL,
+  DEFAULT_SUBSCRIBER_QUEUE_SIZE,
+)
+
+if TYPE_CHECKING:
+  from bleson import BDAddress
 
 _LOGGER = logging.getLogger(__name__)
 GlobalService = None
 
+ReadingCallback = Callable[[MopekaSensor, MopekaAdvertisement], None]
+""" Called with the sensor and the new advertisement for each reading """
+
+DiscoveryCallback = Callable[[MopekaSensor], None]
+""" Called with the sensor when a new sensor is discovered """
+
+SensorStateCallback = Callable[[MopekaSensor], None]
+""" Called with the sensor when a monitored sensor goes offline or comes back online """
+
+RefillCallback = Callable[[MopekaSensor], None]
+""" Called with the sensor when its forecast detects a refill """
+
+DEFAULT_STALE_TICK = 1.0
+""" Resolution in seconds of stale sensor detection """
+
 class ReadStats(object):
   """ Simple object to store different statistics related
   to service operations"""
@@ -32,15 +69,107 @@ class ReadStats(object):
   _processed_ad_count: int
   _error_ad_count: int
   _zero_length_ad_count: int
+  _duplicate_ad_count: int
+  _suppressed_ad_count: int
 
   def __init__(self):
     self._ignored_ad_count = 0
     self._processed_ad_count = 0
     self._error_ad_count = 0
     self._zero_length_ad_count = 0
+    self._duplicate_ad_count = 0
+    self._suppressed_ad_count = 0
+
+  def __str__(self):
+    return f"ReadStats ( Ignored Ad Count: {self._ignored_ad_count}, Processed Ad Count: {self._processed_ad_count}, Error Ad Count: {self._error_ad_count}), Zero Data Ad Count: {self._zero_length_ad_count}, Duplicate Ad Count: {self._duplicate_ad_count}, Suppressed Ad Count: {self._suppressed_ad_count})"
+
+class ChangeThreshold(NamedTuple):
+  """ Minimum change that makes a reading worth reporting to callbacks.
+  A field of None is not compared """
+
+  TankLevelInMM: Optional[float] = 5
+  TemperatureInCelsius: Optional[float] = 1
+  BatteryPercent: Optional[float] = 1
+
+class AdapterStats(object):
+  """ Statistics for a single host controller when scanning
+  with more than one adapter"""
+
+  _packet_count: int
+  _reading_count: int
+  _duplicate_count: int
+
+  def __init__(self):
+    self._packet_count = 0
+    self._reading_count = 0
+    self._duplicate_count = 0
+
+  def __str__(self):
+    return f"AdapterStats ( Packet Count: {self._packet_count}, Reading Count: {self._reading_count}, Duplicate Count: {self._duplicate_count})"
+
+class DiscoveryCacheStats(object):
+  """ Hit counts of the discovery mode caches """
+
+  _negative_hits: int
+  _pending_hits: int
+  _misses: int
+  _evictions: int
+
+  def __init__(self):
+    self._negative_hits = 0
+    self._pending_hits = 0
+    self._misses = 0
+    self._evictions = 0
+
+  @property
+  def HitRate(self) -> float:
+    """ fraction of discovery packets answered from a cache """
+    hits = self._negative_hits + self._pending_hits
+    total = hits + self._misses
+    return hits / total if total else 0.0
 
   def __str__(self):
-    return f"ReadStats ( Ignored Ad Count: {self._ignored_ad_count}, Processed Ad Count: {self._processed_ad_count}, Error Ad Count: {self._error_ad_count}), Zero Data Ad Count: {self._zero_length_ad_count})"
+    return f"DiscoveryCacheStats ( Negative Hits: {self._negative_hits}, Pending Hits: {self._pending_hits}, Misses: {self._misses}, Evictions: {self._evictions}, Hit Rate: {self.HitRate:.3f})"
+
+DEFAULT_DISCOVERY_CACHE_SIZE = 4096
+""" Entries in each discovery mode cache """
+
+DEFAULT_DISCOVERY_CACHE_TTL = 60.0
+""" Seconds a device known not to be a Mopeka sensor is skipped """
+
+class AdapterMergePolicy(Enum):
+  """ How a reading seen by more than one adapter is merged """
+  FRESHEST = 0
+  """ Keep the first copy received """
+
+  BEST_RSSI = 1
+  """ Replace the unread reading with a copy that has a stronger RSSI """
+
+DEFAULT_ADAPTER_DEDUP_WINDOW = 1.0
+""" Seconds in which an identical payload from another adapter is a duplicate """
+
+def _stronger_rssi(rssi: Optional[int], than: Optional[int]) -> bool:
+  """ True if rssi is stronger.  None (not available) is weaker than any value """
+  return rssi is not None and (than is None or rssi > than)
+
+class _AdapterHandler(object):
+  """ bleson meta event handler for one adapter.  Called on that adapter's thread """
+
+  __slots__ = ("service", "index", "stats")
+
+  def __init__(self, service: "MopekaService", index: int):
+    self.service = service
+    self.index = index
+    self.stats = AdapterStats()
+
+  def __call__(self, hci_packet) -> None:
+    if hci_packet.subevent_code == EVT_LE_ADVERTISING_REPORT:
+      self.stats._packet_count += 1
+      pipeline = self.service.Pipeline
+      if pipeline is None:
+        self.service.ProcessAdvertisementPacket(hci_packet, self.index)
+      else:
+        pipeline.Submit(hci_packet.data, self.index)
 
 class ServiceScanningMode(Enum):
   """ Enum to define different supported scanning modes for the service"""
@@ -56,46 +185,350 @@ class MopekaService(object):
   """ Class uses ble stack to listen for advertisements and update data
   This service uses bleson which as of 0.1.8 only actually works on Linux"""
 
-  SensorMonitoredList: Dict[BDAddress, MopekaSensor]
+  SensorMonitoredList: Dict["BDAddress", MopekaSensor]
   """ Sensor data received while in Filtered mode per sensor """
 
-  SensorDiscoveredList: Dict[BDAddress, MopekaSensor]
+  SensorDiscoveredList: Dict["BDAddress", MopekaSensor]
   """ New Sensors discovered while scanning in Discovery mode """
 
   ServiceStats: ReadStats
   """ Stats for the latest scanning session"""
 
-  _hci_index: int
-  _adapter: Optional[object]
+  MonitoredListVersion: int
+  """ Incremented every time the monitored sensor list is updated """
+
+  Metrics: Optional[ServiceMetrics]
+  """ Detailed metrics for the latest scanning session.  None if disabled """
+
+  _monitored_by_raw_mac: Dict[bytes, MopekaSensor]
+  _discovered_by_raw_mac: Dict[bytes, MopekaSensor]
+  _reading_callbacks: List[ReadingCallback]
+  _discovery_callbacks: List[DiscoveryCallback]
+  AdapterStatsList: Dict[int, AdapterStats]
+  """ Per host controller stats """
+
+  DeduplicateReadings: bool
+  """ Skip parsing a packet whose GAP data matches the sensor's last reading """
+
+  ReadingChangeThreshold: Optional[ChangeThreshold]
+  """ When set, reading callbacks only get readings that moved past the threshold """
+
+  DiscoveryCacheSize: int
+  """ Entries in the discovery mode caches.  0 disables them """
+
+  DiscoveryCacheTtl: float
+  """ Seconds a non Mopeka device is skipped in discovery mode """
+
+  DiscoveryCacheStats: DiscoveryCacheStats
+  """ Cache hit counts for the latest discovery session """
+
+  Clock: Callable[[], float]
+  """ Monotonic time source in seconds.  Tests can replace it """
+
+  StaleTimeout: Optional[float]
+  """ Seconds without an advertisement before a monitored sensor is offline.
+  None when stale detection is off.  See EnableStaleDetection """
+
+  Pipeline: Optional[object]
+  """ ParsingPipeline the adapters hand packets to.  None parses on the adapter thread.
+  Set by ParsingPipeline.Start """
+
+  _hci_indexes: List[int]
+  _adapters: Dict[int, object]
+  _adapter_last: Dict[bytes, Tuple[bytes, float, int]]
   _started: bool
   _should_start: bool
 
-  def __init__(self):
+  def __init__(self, provider=None):
     """ Create a MopekaService instance
 
     Service is not started upon creation
 
+    provider is the bleson provider used to get adapters.  Defaults to
+    bleson.get_provider().  Tests can pass a fake.
     """
-    self._hci_index = 0
+    self._provider = provider
+    self._hci_indexes = [0]
     self._started = False
     self._should_start = False
-    self._adapter = None
+    self._adapters = dict()
+    self.AdapterStatsList = dict()
+    self.MergePolicy = AdapterMergePolicy.FRESHEST
+    self.AdapterDedupWindow = DEFAULT_ADAPTER_DEDUP_WINDOW
+    # last (mfg data, time, adapter) per sensor raw mac.  Only used with more than one adapter
+    self._adapter_last = dict()
+    self.DeduplicateReadings = True
+    self.ReadingChangeThreshold = None
+    self.Pipeline = None
+    self.DiscoveryCacheSize = DEFAULT_DISCOVERY_CACHE_SIZE
+    self.DiscoveryCacheTtl = DEFAULT_DISCOVERY_CACHE_TTL
+    self.DiscoveryCacheStats = DiscoveryCacheStats()
+    # discovery mode caches by raw mac.  LRU order, oldest first.
+    # devices that are not Mopeka sensors: expiry time
+    self._negative_cache = OrderedDict()
+    # Mopeka sensors seen without the sync button: (packet length, flag byte index)
+    self._pending_cache = OrderedDict()
+    # shared by the adapter threads.  Guards both caches and their stats
+    self._discovery_cache_lock = threading.Lock()
+    self.Clock = time.monotonic
+    self.StaleTimeout = None
+    self._stale_wheel = None
+    # guards the wheel.  Taken inside _reading_lock, never the other way
+    # round, so callbacks can add and remove monitored sensors
+    self._stale_lock = threading.Lock()
+    self._stale_thread = None
+    self._stale_stop = threading.Event()
+    # serializes sensor updates when several adapter threads deliver readings
+    self._reading_lock = threading.Lock()
     self._scanning_mode = ServiceScanningMode.FILTERED_MODE
 
     self.SensorMonitoredList = dict()
     self.SensorDiscoveredList = dict()
     self.ServiceStats = ReadStats()
+    self.Metrics = ServiceMetrics(self.ServiceStats)
+
+    # index of sensors by the raw 6 byte mac from the hci packet so
+    # packets can be matched without building a BDAddress
+    self._monitored_by_raw_mac = dict()
+    self._discovered_by_raw_mac = dict()
+
+    # monitored lists are copy-on-write.  Lock serializes writers only.
+    self._monitored_lock = threading.Lock()
+    self.MonitoredListVersion = 0
+
+    # callback lists are replaced, never mutated, so the scanning thread
+    # can iterate them without locking
+    self._reading_callbacks = []
+    self._discovery_callbacks = []
+    self._offline_callbacks = []
+    self._online_callbacks = []
+    self._refill_callbacks = []
+    # monitored sensors by predicted empty time.  Has its own lock so it can
+    # be queried from callbacks that run while _reading_lock is held
+    self._forecast_lock = threading.Lock()
+    self._forecast_index = ForecastIndex()
+    self._dispatcher = ReadingDispatcher()
+    self._reading_dispatch = False
+
+  def AddReadingCallback(self, callback: ReadingCallback) -> None:
+    """ Register a callback for every reading of a monitored sensor.
+
+    Note: callbacks run on the scanning thread and must return quickly
+    """
+    self._reading_callbacks = self._reading_callbacks + [callback]
+
+  def RemoveReadingCallback(self, callback: ReadingCallback) -> None:
+    self._reading_callbacks = [c for c in self._reading_callbacks if c != callback]
+
+  def AddDiscoveryCallback(self, callback: DiscoveryCallback) -> None:
+    """ Register a callback for every sensor discovered in discovery mode.
+
+    Note: callbacks run on the scanning thread and must return quickly
+    """
+    self._discovery_callbacks = self._discovery_callbacks + [callback]
+
+  def RemoveDiscoveryCallback(self, callback: DiscoveryCallback) -> None:
+    self._discovery_callbacks = [c for c in self._discovery_callbacks if c != callback]
+
+  def Subscribe(
+    self,
+    callback: BatchCallback,
+    macs: Optional[Iterable[str]] = None,
+    hardware_ids: Optional[Iterable[HardwareId]] = None,
+    change_threshold: Optional[ChangeThreshold] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+    queue_size: int = DEFAULT_SUBSCRIBER_QUEUE_SIZE,
+  ) -> Subscription:
+    """ Deliver readings of monitored sensors in batches on a dispatcher thread.
+
+    callback gets a list of (sensor, reading) when batch_size readings are
+    queued or the oldest has waited flush_interval seconds.  macs,
+    hardware_ids and change_threshold filter readings.  Each subscriber
+    has a queue_size queue that drops the oldest reading when full
+    (Subscription.DroppedCount).  Not affected by ReadingChangeThreshold.
+    """
+    subscription = Subscription(
+      callback, macs, hardware_ids, change_threshold, batch_size, flush_interval, queue_size)
+    if len(self._dispatcher) == 0:
+      self._reading_dispatch = True
+    self._dispatcher.Add(subscription)
+    return subscription
+
+  def Unsubscribe(self, subscription: Subscription, flush: bool = True) -> None:
+    """ Stop a subscription.  flush delivers queued readings on the calling thread first """
+    self._dispatcher.Remove(subscription, flush)
+    if len(self._dispatcher) == 0:
+      self._reading_dispatch = False
+
+  def AddOfflineCallback(self, callback: SensorStateCallback) -> None:
+    """ Register a callback for a monitored sensor that stopped advertising.
+    Requires EnableStaleDetection.  Runs on the stale detection thread or the
+    caller of CheckStaleSensors """
+    self._offline_callbacks = self._offline_callbacks + [callback]
+
+  def RemoveOfflineCallback(self, callback: SensorStateCallback) -> None:
+    self._offline_callbacks = [c for c in self._offline_callbacks if c != callback]
+
+  def AddOnlineCallback(self, callback: SensorStateCallback) -> None:
+    """ Register a callback for an offline sensor that advertised again.
+    Runs on the scanning thread """
+    self._online_callbacks = self._online_callbacks + [callback]
+
+  def RemoveOnlineCallback(self, callback: SensorStateCallback) -> None:
+    self._online_callbacks = [c for c in self._online_callbacks if c != callback]
+
+  def AddRefillCallback(self, callback: RefillCallback) -> None:
+    """ Register a callback for a monitored sensor whose level jumped up to a
+    new steady level (see MopekaSensor.Forecast).  Runs on the scanning thread """
+    self._refill_callbacks = self._refill_callbacks + [callback]
+
+  def RemoveRefillCallback(self, callback: RefillCallback) -> None:
+    self._refill_callbacks = [c for c in self._refill_callbacks if c != callback]
+
+  def EnableStaleDetection(self, timeout: Optional[float], tick: float = DEFAULT_STALE_TICK) -> None:
+    """ Report monitored sensors that go silent for timeout seconds.
+
+    MopekaSensor.StaleTimeout overrides timeout per sensor.  Packets only
+    record MopekaSensor.LastSeen.  A timer wheel with tick resolution holds
+    one entry per sensor and is advanced by a single thread while scanning
+    or by calling CheckStaleSensors.  None turns detection off.
+    """
+    with self._reading_lock, self._stale_lock:
+      self.StaleTimeout = timeout
+      self._stale_wheel = None
+      if timeout is not None:
+        now = self.Clock()
+        self._stale_wheel = TimerWheel(tick, now=now)
+        for sensor in self.SensorMonitoredList.values():
+          self._schedule_stale(sensor, now)
+    if timeout is None:
+      self._stop_stale_thread()
+    elif self._started:
+      self._start_stale_thread()
+
+  def _schedule_stale(self, sensor: MopekaSensor, now: float) -> None:
+    """ Caller must hold _stale_lock """
+    timeout = sensor.StaleTimeout if sensor.StaleTimeout is not None else self.StaleTimeout
+    last = sensor.LastSeen
+    # sensors never heard get a full timeout from when monitoring starts
+    start = now if last is None or last < now - timeout else last
+    self._stale_wheel.Schedule(sensor, start + timeout)
+
+  def CheckStaleSensors(self, now: Optional[float] = None) -> List[MopekaSensor]:
+    """ Advance stale detection to now (default Clock()) and fire offline
+    callbacks.  Returns the sensors that went offline.
+
+    Callbacks run after the lock is released so they may add or remove
+    monitored sensors.
+    """
+    offline = []
+    with self._reading_lock, self._stale_lock:
+      wheel = self._stale_wheel
+      if wheel is None:
+        return offline
+      if now is None:
+        now = self.Clock()
+      for sensor in wheel.Advance(now):
+        if self._monitored_by_raw_mac.get(sensor._raw_mac) is not sensor:
+          continue
+        timeout = sensor.StaleTimeout if sensor.StaleTimeout is not None else self.StaleTimeout
+        last = sensor.LastSeen
+        if last is not None and now - last < timeout:
+          # heard since the timer was set
+          wheel.Schedule(sensor, last + timeout)
+          continue
+        sensor.Offline = True
+        offline.append(sensor)
+    for sensor in offline:
+      for callback in self._offline_callbacks:
+        callback(sensor)
+    return offline
+
+  def _sensor_online(self, sensor: MopekaSensor, now: float) -> None:
+    """ An offline sensor advertised again """
+    with self._reading_lock:
+      if not sensor.Offline:
+        return
+      sensor.Offline = False
+      with self._stale_lock:
+        if self._stale_wheel is not None:
+          self._schedule_stale(sensor, now)
+    for callback in self._online_callbacks:
+      callback(sensor)
+
+  def _stale_loop(self) -> None:
+    stop = self._stale_stop
+    while not stop.wait(self._stale_wheel.Tick if self._stale_wheel is not None else DEFAULT_STALE_TICK):
+      try:
+        self.CheckStaleSensors()
+      except Exception:
+        _LOGGER.exception("Stale sensor check failed")
+
+  def _start_stale_thread(self) -> None:
+    if self._stale_thread is not None or self.StaleTimeout is None:
+      return
+    self._stale_stop.clear()
+    self._stale_thread = threading.Thread(target=self._stale_loop, name="MopekaStaleSensors", daemon=True)
+    self._stale_thread.start()
+
+  def _stop_stale_thread(self) -> None:
+    thread = self._stale_thread
+    if thread is None:
+      return
+    self._stale_stop.set()
+    if thread is not threading.current_thread():
+      thread.join()
+    self._stale_thread = None
+
+  def EnableMetrics(self, enable: bool = True) -> None:
+    """ Turn detailed metrics on or off.  Enabling resets the metrics """
+    self.Metrics = ServiceMetrics(self.ServiceStats) if enable else None
+
+  def GetMetricsSnapshot(self) -> dict:
+    """ Metrics and stats as a dict.  Empty if metrics are disabled """
+    if self.Metrics is None:
+      return {}
+    return self.Metrics.Snapshot()
+
+  def GetMetricsPrometheus(self) -> str:
+    """ Metrics and stats in Prometheus text format.  Empty if metrics are disabled """
+    if self.Metrics is None:
+      return ""
+    return self.Metrics.ToPrometheus()
+
+  def GetWorstSensors(self, count: int = 10) -> List[Tuple[float, MopekaSensor]]:
+    """ (health score, sensor) for the count monitored sensors with the worst
+    SensorHealth.Score, lowest first.  Sensors never heard score 0 """
+    return WorstSensors(self.SensorMonitoredList.values(), count)
+
+  def GetSoonestEmpty(self, count: int = 10) -> List[Tuple[float, MopekaSensor]]:
+    """ (seconds until empty, sensor) for the count monitored sensors whose
+    forecast reaches its threshold first, soonest first.  Sensors whose level
+    is not falling are left out.  Cost is O(count log n), not a scan """
+    with self._forecast_lock:
+      soonest = self._forecast_index.Soonest(count)
+      now = self.Clock()
+    return [(max(empty_at - now, 0.0), sensor) for empty_at, sensor in soonest]
 
   def SetHostControllerIndex(self, index:int) -> bool:
     """ Set the host controller index to bind to.
     This can only be called prior to starting any scanning
     """
+    return self.SetHostControllerIndexes([index])
 
-    if self._adapter is not None:
+  def SetHostControllerIndexes(self, indexes: List[int]) -> bool:
+    """ Set several host controllers to scan with at the same time.
+    Each adapter delivers events on its own bleson thread.  Readings of the
+    same sensor seen by more than one adapter are merged using MergePolicy.
+
+    This can only be called prior to starting any scanning
+    """
+    if len(self._adapters) > 0 or len(indexes) == 0:
       #already started
       return False
 
-    self._hci_index = index
+    self._hci_indexes = list(dict.fromkeys(indexes))
     return True
 
   def DoSensorDiscovery(self):
@@ -110,40 +543,87 @@ class MopekaService(object):
     """
     self.Stop()
     self.SensorDiscoveredList.clear()
+    self._discovered_by_raw_mac.clear()
+    self._negative_cache = OrderedDict()
+    self._pending_cache = OrderedDict()
+    self.DiscoveryCacheStats = DiscoveryCacheStats()
     self._scanning_mode = ServiceScanningMode.DISCOVERY_MODE
     self.ServiceStats = ReadStats()
+    if self.Metrics is not None:
+      self.Metrics = ServiceMetrics(self.ServiceStats, self.Metrics.PacketRate.windows)
 
   def AddSensorToMonitor(self, sensor: MopekaSensor) -> None:
     """ Add a sensor that should be monitored when scanning in filtered mode.
     If the sensor mac address is already listed the sensor will be replaced with
     new sensor.
 
-    Note: Scanning will be stopped while the sensor is added
+    Scanning is not interrupted.  See AddSensorsToMonitor
     """
-    if self._scanning_mode == ServiceScanningMode.FILTERED_MODE:
-      self._stop()  # stop processing so that we can safely update the shared list
+    self.AddSensorsToMonitor([sensor])
 
-    self.SensorMonitoredList[sensor._bdaddress] = sensor
+  def AddSensorsToMonitor(self, sensors: Iterable[MopekaSensor]) -> None:
+    """ Add many sensors to be monitored as a single atomic update.
 
-    # restart scanning if it was previously scanning in filtered mode
+    The sensor lists are copy-on-write.  The scanning thread always sees
+    either none or all of the sensors so scanning does not need to stop.
+    """
+    with self._monitored_lock:
+      monitored = dict(self.SensorMonitoredList)
+      by_raw_mac = dict(self._monitored_by_raw_mac)
+      added = list(sensors)
+      for sensor in added:
+        monitored[sensor._bdaddress] = sensor
+        by_raw_mac[sensor._raw_mac] = sensor
+      self._publish_monitored(monitored, by_raw_mac)
+
+    if self._stale_wheel is not None:
+      with self._stale_lock:
+        if self._stale_wheel is not None:
+          now = self.Clock()
+          for sensor in added:
+            self._schedule_stale(sensor, now)
+
+    # scanning doesn't start until there is a sensor to filter for
     if self._scanning_mode == ServiceScanningMode.FILTERED_MODE and self._should_start:
       self._start()
-    return
 
   def RemoveSensorToMonitor(self, sensor: MopekaSensor) -> None:
     """ Remove a sensor from the list to be monitored.  If the sensor isn't
     found in the list just return.
 
-    Note: Scanning will be stopped while the sensor is removed
-
+    Scanning is not interrupted.  See RemoveSensorsToMonitor
     """
-    if sensor._bdaddress in self.SensorMonitoredList:
-      if self._scanning_mode == ServiceScanningMode.FILTERED_MODE:
-        self._stop()
-      self.SensorMonitoredList.pop(self.SensorMonitoredList[sensor._bdaddress], None)
+    self.RemoveSensorsToMonitor([sensor])
 
-      if self._scanning_mode == ServiceScanningMode.FILTERED_MODE and self._should_start:
-        self._start()
+  def RemoveSensorsToMonitor(self, sensors: Iterable[MopekaSensor]) -> None:
+    """ Remove many sensors from the list to be monitored as a single
+    atomic update.  Sensors not in the list are ignored.
+    """
+    with self._monitored_lock:
+      monitored = dict(self.SensorMonitoredList)
+      by_raw_mac = dict(self._monitored_by_raw_mac)
+      removed = list(sensors)
+      for sensor in removed:
+        monitored.pop(sensor._bdaddress, None)
+        by_raw_mac.pop(sensor._raw_mac, None)
+      self._publish_monitored(monitored, by_raw_mac)
+
+    if self._stale_wheel is not None:
+      with self._stale_lock:
+        if self._stale_wheel is not None:
+          for sensor in removed:
+            self._stale_wheel.Cancel(sensor)
+    with self._forecast_lock:
+      for sensor in removed:
+        self._forecast_index.Remove(sensor)
+
+  def _publish_monitored(self, monitored: Dict["BDAddress", MopekaSensor], by_raw_mac: Dict[bytes, MopekaSensor]) -> None:
+    """ Swap in new monitored lists.  Caller must hold _monitored_lock.
+    The raw mac index is what the scanning thread reads so it is swapped last.
+    """
+    self.SensorMonitoredList = monitored
+    self._monitored_by_raw_mac = by_raw_mac
+    self.MonitoredListVersion += 1
 
   def Start(self) -> None:
     """ Start scanning """
@@ -160,13 +640,24 @@ class MopekaService(object):
     if self._scanning_mode == ServiceScanningMode.FILTERED_MODE and len(self.SensorMonitoredList) == 0:
       return
 
-    # if adapter is none do initial setup before starting.
-    if self._adapter is None:
-      self._adapter = get_provider().get_adapter(self._hci_index)
-      self._adapter._handle_meta_event = handle_meta_event_override
-
-    self._adapter.start_scanning()
+    # if adapters are not created do initial setup before starting.
+    if len(self._adapters) == 0:
+      provider = self._provider
+      if provider is None:
+        # bleson and its HCI stack are only loaded when scanning really starts
+        from bleson import get_provider
+        provider = get_provider()
+      for index in self._hci_indexes:
+        adapter = provider.get_adapter(index)
+        handler = _AdapterHandler(self, index)
+        adapter._handle_meta_event = handler
+        self._adapters[index] = adapter
+        self.AdapterStatsList[index] = handler.stats
+
+    for adapter in self._adapters.values():
+      adapter.start_scanning()
     self._started = True
+    self._start_stale_thread()
 
 
   def Stop(self) -> None:
@@ -177,54 +668,256 @@ class MopekaService(object):
   def _stop(self) -> None:
     """ Internal function to stop but doesn't change state for users desire"""
     if self._started:
-      self._adapter.stop_scanning()
+      for adapter in self._adapters.values():
+        adapter.stop_scanning()
       self._started = False
+      self._stop_stale_thread()
 
-  def ProcessAdvertisementPacket(self, hci_packet) -> None:
-    """ Function to parse and handle HCI packet data"""
+  def HandleMetaEvent(self, hci_packet) -> None:
+    """ bleson meta event handler bound to this service instance """
+    if hci_packet.subevent_code == EVT_LE_ADVERTISING_REPORT:
+      if self.Pipeline is None:
+        self.ProcessAdvertisementPacket(hci_packet)
+      else:
+        self.Pipeline.Submit(hci_packet.data)
+
+  def _is_adapter_duplicate(self, sensor: MopekaSensor, ma: MopekaAdvertisement, adapter_index: int, now: float) -> bool:
+    """ True if another adapter already delivered this reading.
+    Caller must hold _reading_lock.
+    """
+    stats = self.AdapterStatsList[adapter_index]
+    if len(self._adapters) < 2:
+      stats._reading_count += 1
+      return False
+
+    mfg = ma._raw_mfg_data
+    last = self._adapter_last.get(sensor._raw_mac)
+    if last is not None and last[2] != adapter_index and last[0] == mfg and now - last[1] < self.AdapterDedupWindow:
+      stats._duplicate_count += 1
+      if self.MergePolicy == AdapterMergePolicy.BEST_RSSI:
+        # only replace the reading if the consumer hasn't taken it yet
+        unread = sensor._last_packet
+        if unread is not None and unread._raw_mfg_data == mfg and _stronger_rssi(ma.rssi, unread.rssi):
+          sensor._last_packet = ma
+      return True
+
+    self._adapter_last[sensor._raw_mac] = (mfg, now, adapter_index)
+    stats._reading_count += 1
+    return False
+
+  def _passes_change_threshold(self, sensor: MopekaSensor, ma: MopekaAdvertisement) -> bool:
+    """ True if the reading moved past ReadingChangeThreshold since the last one
+    reported.  Caller must hold _reading_lock.
+    """
+    threshold = self.ReadingChangeThreshold
+    values = (ma.TankLevelInMM, ma.TemperatureInCelsius, ma.BatteryPercent)
+    last = sensor._reported_values
+    if last is not None:
+      for value, previous, limit in zip(values, last, threshold):
+        if limit is not None and abs(value - previous) >= limit:
+          break
+      else:
+        return False
+    sensor._reported_values = values
+    return True
+
+  def ProcessAdvertisementPacket(self, hci_packet, adapter_index: Optional[int] = None) -> None:
+    """ Function to parse and handle HCI packet data
+
+    adapter_index is the host controller the packet came from.  None when
+    packets are fed directly (replay, tests).
+    """
+    data = hci_packet.data
+    metrics = self.Metrics
 
     if self._scanning_mode == ServiceScanningMode.FILTERED_MODE:
       # Filtered Mode is scanning and only processing known sensors
-      packet_mac = BDAddress(hci_packet.data[3:9])
-      sensor = self.SensorMonitoredList.get(packet_mac)
+      sensor = self._monitored_by_raw_mac.get(bytes(data[3:9]))
       if sensor is not None:
-        try:
-          sensor.AddReading(MopekaAdvertisement(hci_packet.data))
-          self.ServiceStats._processed_ad_count += 1
-
-        except NoGapDataException:
-          # This is not an error.  Sensor sends advertisements with zero data
-          # just ignore them.
-          self.ServiceStats._zero_length_ad_count += 1
-
-        except Exception as e:
-          _LOGGER.error("Failed to process advertisement from defined sensor.  Exception: %s" % e)
-          self.ServiceStats._ignored_ad_count += 1
+        gap = data[9:-1]
+        if self.DeduplicateReadings and gap == sensor._last_gap:
+          # Sensors repeat the same payload many times.  Nothing changed so don't parse
+          self.ServiceStats._duplicate_ad_count += 1
+          now = self.Clock()
+          if sensor.Offline:
+            self._sensor_online(sensor, now)
+          rssi = rssi_from_byte(data[-1])
+          with self._reading_lock:
+            sensor.LastSeen = now
+            health = sensor.Health
+            if health is not None:
+              health.Update(rssi, sensor._last_reading.ReadingQualityStars, now)
+            unread = sensor._last_packet
+            if unread is None:
+              # keep the latest reading available to polling consumers
+              sensor._last_packet = sensor._last_reading
+              return
+            if (adapter_index is None or self.MergePolicy != AdapterMergePolicy.BEST_RSSI
+                or not _stronger_rssi(rssi, unread.rssi)):
+              return
+          # a stronger copy of the unread reading.  Parsed outside the lock
+          status, ma = MopekaAdvertisement.TryParse(data)
+          if ma is not None:
+            with self._reading_lock:
+              sensor._last_packet = ma
+          return
+
+        if metrics is not None:
+          start = time.perf_counter_ns()
+        status, ma = MopekaAdvertisement.TryParse(data)
+
+        if ma is not None:
+          if metrics is not None:
+            metrics.ParseLatency.Observe(time.perf_counter_ns() - start)
+          self._apply_reading(sensor, ma, gap, adapter_index)
+        else:
+          self._apply_parse_failure(sensor, status)
       else:
         self.ServiceStats._ignored_ad_count += 1
 
     elif self._scanning_mode == ServiceScanningMode.DISCOVERY_MODE:
       # Discovery mode is looking for all Mopeka Sensors and reporting
       # them if their sync button is pressed
-      packet_mac = BDAddress(hci_packet.data[3:9])
-      sensor = self.SensorDiscoveredList.get(packet_mac)
-      if sensor == None:
-        # packet from untracked device
-        try:
-          ma = MopekaAdvertisement(hci_packet.data)
-          self.ServiceStats._processed_ad_count += 1
-
-          if(ma.SyncButtonPressed):
-            # Only sensors with button pressed should be discovered
-            # Recommendation by Mopeka
-            sensor = MopekaSensor(packet_mac.address)
-            sensor.AddReading(ma)
-            self.SensorDiscoveredList[packet_mac] = sensor
-
-        except:
-          self.ServiceStats._ignored_ad_count += 1
-          # Not a Mopeka Sensor or supported sensor
-          pass
+      raw_mac = bytes(data[3:9])
+      if raw_mac in self._discovered_by_raw_mac:
+        return
+
+      use_cache = self.DiscoveryCacheSize > 0
+      if use_cache:
+        cache_stats = self.DiscoveryCacheStats
+        now = self.Clock()
+        with self._discovery_cache_lock:
+          expiry = self._negative_cache.get(raw_mac)
+          if expiry is not None:
+            if now < expiry:
+              # known not to be a Mopeka sensor
+              self._negative_cache.move_to_end(raw_mac)
+              cache_stats._negative_hits += 1
+              self.ServiceStats._ignored_ad_count += 1
+              return
+            self._negative_cache.pop(raw_mac, None)
+          pending = self._pending_cache.get(raw_mac)
+          if pending is not None and len(data) == pending[0] and not data[pending[1]] & 0x80:
+            # same sensor, button still not pressed.  Only the flag byte is checked
+            self._pending_cache.move_to_end(raw_mac)
+            cache_stats._pending_hits += 1
+            self.ServiceStats._processed_ad_count += 1
+            return
+          cache_stats._misses += 1
+
+      if metrics is not None:
+        start = time.perf_counter_ns()
+      status, offset, _name_offset = _scan_gap(data)
+      if status != ParseStatus.OK:
+        # Not a supported sensor
+        self.ServiceStats._ignored_ad_count += 1
+        if metrics is not None and status == ParseStatus.UNSUPPORTED_HARDWARE:
+          metrics.ObserveError(None, status.name)
+        if use_cache and self._is_foreign(status, data, offset):
+          self._cache_put(self._negative_cache, raw_mac, now + self.DiscoveryCacheTtl)
+        return
+
+      if not data[offset + 5] & 0x80:
+        # Only sensors with button pressed should be discovered
+        self.ServiceStats._processed_ad_count += 1
+        if use_cache:
+          self._cache_put(self._pending_cache, raw_mac, (len(data), offset + 5))
+        if metrics is not None:
+          metrics.ParseLatency.Observe(time.perf_counter_ns() - start)
+        return
+
+      status, ma = MopekaAdvertisement.TryParse(data)
+      if metrics is not None:
+        metrics.ParseLatency.Observe(time.perf_counter_ns() - start)
+      with self._discovery_cache_lock:
+        self._pending_cache.pop(raw_mac, None)
+      self._apply_discovery(raw_mac, ma)
+
+  @staticmethod
+  def _is_foreign(status: ParseStatus, data: bytes, offset: int) -> bool:
+    """ True if a failed packet can't be from a supported Mopeka sensor.
+    Packets without mfg data are not cached since sensors send empty packets """
+    if status in (ParseStatus.UNSUPPORTED_MANUFACTURER, ParseStatus.UNSUPPORTED_HARDWARE):
+      return True
+    if status == ParseStatus.UNSUPPORTED_LENGTH and offset + 2 < len(data) - 1:
+      return data[offset + 1] + (data[offset + 2] << 8) != MOPEKA_MANUFACTURE_ID
+    return False
+
+  def _cache_put(self, cache: OrderedDict, raw_mac: bytes, value) -> None:
+    """ add to a discovery cache evicting the least recently used entry """
+    with self._discovery_cache_lock:
+      cache[raw_mac] = value
+      cache.move_to_end(raw_mac)
+      if len(cache) > self.DiscoveryCacheSize:
+        cache.popitem(last=False)
+        self.DiscoveryCacheStats._evictions += 1
+
+  def _apply_reading(self, sensor: MopekaSensor, ma: MopekaAdvertisement, gap: Optional[bytes], adapter_index: Optional[int]) -> None:
+    """ Record a parsed reading from a monitored sensor and notify callbacks """
+    metrics = self.Metrics
+    now = self.Clock()
+    if sensor.Offline:
+      self._sensor_online(sensor, now)
+    with self._reading_lock:
+      if adapter_index is not None and self._is_adapter_duplicate(sensor, ma, adapter_index, now):
+        return
+      if metrics is not None:
+        metrics.ObserveReading(sensor._mac)
+      sensor.LastSeen = now
+      health = sensor.Health
+      if health is not None:
+        health.Update(ma.rssi, ma.ReadingQualityStars, now)
+      sensor.AddReading(ma, now)
+      sensor._last_gap = gap
+      level_filter = sensor.Filter
+      accepted = level_filter is None or level_filter.Update(
+        sensor.TankLevelInMM(ma), ma.ReadingQualityStars, ma._raw_x_accel, ma._raw_y_accel)
+      forecast = sensor.Forecast
+      # readings the filter rejected (tilted, poor quality) don't reach the forecast
+      if forecast is not None and accepted:
+        if sensor._update_forecast(ma, now):
+          for callback in self._refill_callbacks:
+            callback(sensor)
+        with self._forecast_lock:
+          self._forecast_index.Update(sensor, forecast.EmptyAt)
+      self.ServiceStats._processed_ad_count += 1
+      if self._reading_dispatch:
+        self._dispatcher.OnReading(sensor, ma)
+      if self.ReadingChangeThreshold is not None and not self._passes_change_threshold(sensor, ma):
+        self.ServiceStats._suppressed_ad_count += 1
+        return
+      for callback in self._reading_callbacks:
+        callback(sensor, ma)
+
+  def _apply_parse_failure(self, sensor: MopekaSensor, status: ParseStatus) -> None:
+    """ Count a packet from a monitored sensor that could not be parsed """
+    if status == ParseStatus.NO_GAP_DATA:
+      # This is not an error.  Sensor sends advertisements with zero data
+      # just ignore them.
+      self.ServiceStats._zero_length_ad_count += 1
+      return
+
+    _LOGGER.error("Failed to process advertisement from defined sensor %s.  Status: %s" % (sensor._mac, status.name))
+    self.ServiceStats._error_ad_count += 1
+    if self.Metrics is not None:
+      self.Metrics.ObserveError(sensor._mac, status.name)
+
+  def _apply_discovery(self, raw_mac: bytes, ma: MopekaAdvertisement) -> None:
+    """ Handle a parsed reading from a sensor that is not yet discovered """
+    self.ServiceStats._processed_ad_count += 1
+    if(ma.SyncButtonPressed):
+      # Only sensors with button pressed should be discovered
+      # Recommendation by Mopeka
+      with self._reading_lock:
+        if raw_mac in self._discovered_by_raw_mac:
+          # another adapter thread got here first
+          return
+        sensor = MopekaSensor(ma.mac.address)
+        sensor.AddReading(ma, self.Clock())
+        self.SensorDiscoveredList[ma.mac] = sensor
+        self._discovered_by_raw_mac[raw_mac] = sensor
+        for callback in self._discovery_callbacks:
+          callback(sensor)
 
 ######################################################################################
 ## Global Functions
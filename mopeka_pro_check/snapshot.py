@@ -0,0 +1,445 @@
+"""Snapshot and restore of the service state
+
+A snapshot is a versioned binary image of the monitored and discovered
+sensors (last reading, reading history, health, forecast, profile, tank
+and stale timeout) and the service statistics.  Restoring one brings a
+restarted gateway back to where it was without rescanning: all monitored
+sensors are added in one atomic update and the history arrays are copied
+back as whole buffers.
+
+Sensor times are service Clock() (monotonic) values which don't survive a
+restart.  They are stored with the clock and wall time of the snapshot
+and shifted on restore so the time spent down still counts.
+
+Level filters, subscriptions and callbacks are configuration and are not
+part of a snapshot.
+
+File layout (little endian):
+
+    header:   SNAPSHOT_MAGIC (8 bytes), version u16, reserved u16,
+              clock float64, wall time float64
+    stats:    count u16, then name (u8 length + ascii) and int64 value
+    profiles: count u16, then name, hardware id u8, coefficients 3 float64,
+              air space u8, thermal expansion float64
+    tanks:    count u16, then name, orientation u8, height u32,
+              capacity float64, empty u32, full u32
+    sensors:  count u32, then per sensor a fixed record followed by the
+              optional health, forecast and history header blocks its
+              flags name
+    history:  level item size u8, slots u32, then each ReadingHistory
+              array of every sensor with a history back to back, one
+              column at a time, so a restore reads each column with one
+              copy and shifts all timestamps in one pass
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+from array import array
+import math
+import os
+import struct
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .advertisement import CompactMopekaAdvertisement, HardwareId
+from .forecast import ConsumptionForecast
+from .health import SensorHealth
+from .history import ReadingHistory
+from .profiles import GetProfile, SensorProfile
+from .sensor import MopekaSensor
+from .storage import _raw_to_mac
+from .tank import TANK_GEOMETRIES, TankGeometry, TankOrientation
+
+SNAPSHOT_MAGIC = b"MPKSNAP\x00"
+SNAPSHOT_VERSION = 1
+""" Version written.  Snapshots from newer versions are rejected """
+
+_HEADER = struct.Struct("<8sHHdd")
+_U8 = struct.Struct("<B")
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+_STAT = struct.Struct("<q")
+_PROFILE = struct.Struct("<BdddBd")
+_TANK = struct.Struct("<BIdII")
+# raw mac, list, flags, rssi byte, profile index + 1, tank index + 1, mfg data, last seen, stale timeout
+_SENSOR = struct.Struct("<6sBBBHH13sdd")
+_HEALTH = struct.Struct("<ddQddd4QQd")
+_FORECAST = struct.Struct("<dddIQQddddddddIdB")
+_HISTORY = struct.Struct("<III")
+_COLUMNS = struct.Struct("<BI")
+_HISTORY_COLUMNS = ("_timestamp", "_rssi", "_level", "_temp", "_battery", "_quality")
+
+_MONITORED = 0
+_DISCOVERED = 1
+
+_HAS_READING = 0x01
+_OFFLINE = 0x02
+_HAS_HEALTH = 0x04
+_HAS_FORECAST = 0x08
+_HAS_HISTORY = 0x10
+
+_RSSI_NOT_AVAILABLE = 127
+
+# "l" last so it is used when its size matches
+_LEVEL_TYPECODES = {array(code).itemsize: code for code in ("i", "q", "l")}
+_SWAP = sys.byteorder != "little"
+
+_NONE = float("nan")
+
+
+def _opt(value: Optional[float]) -> float:
+    return _NONE if value is None else value
+
+
+def _none(value: float) -> Optional[float]:
+    return None if math.isnan(value) else value
+
+
+def _pack_name(out: List[bytes], name: str) -> None:
+    raw = name.encode("utf-8")[:255]
+    out.append(_U8.pack(len(raw)))
+    out.append(raw)
+
+
+def _unpack_name(data, offset: int) -> Tuple[str, int]:
+    length = data[offset]
+    offset += 1
+    return bytes(data[offset:offset + length]).decode("utf-8"), offset + length
+
+
+def _array_bytes(values: array) -> bytes:
+    if _SWAP:
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _array_from(typecode: str, data, offset: int, count: int) -> Tuple[array, int]:
+    values = array(typecode)
+    end = offset + values.itemsize * count
+    if end > len(data):
+        raise ValueError("Snapshot is truncated")
+    values.frombytes(data[offset:end])
+    if _SWAP:
+        values.byteswap()
+    return values, end
+
+
+class _Writer(object):
+
+    def __init__(self):
+        self.out: List[bytes] = []
+        self.profiles: Dict[int, int] = dict()
+        self.profile_list: List[SensorProfile] = []
+        self.tanks: Dict[int, int] = dict()
+        self.tank_list: List[TankGeometry] = []
+        self.histories: List[ReadingHistory] = []
+
+    def index(self, item, table: Dict[int, int], items: list) -> int:
+        """ 1 based index of a shared profile or tank.  0 for None """
+        if item is None:
+            return 0
+        i = table.get(id(item))
+        if i is None:
+            items.append(item)
+            i = table[id(item)] = len(items)
+        return i
+
+    def sensor(self, sensor: MopekaSensor, which: int) -> None:
+        out = self.out
+        flags = 0
+        reading = sensor._last_reading
+        mfg = b"\x00" * 13
+        rssi = _RSSI_NOT_AVAILABLE
+        if reading is not None:
+            flags |= _HAS_READING
+            mfg = bytes(reading._raw_mfg_data)
+            if reading.rssi is not None:
+                rssi = reading.rssi & 0xFF
+        if sensor.Offline:
+            flags |= _OFFLINE
+        health = sensor.Health
+        forecast = sensor.Forecast
+        history = sensor.History
+        if health is not None:
+            flags |= _HAS_HEALTH
+        if forecast is not None:
+            flags |= _HAS_FORECAST
+        if history is not None:
+            flags |= _HAS_HISTORY
+        out.append(_SENSOR.pack(
+            sensor._raw_mac,
+            which,
+            flags,
+            rssi,
+            self.index(sensor.Profile, self.profiles, self.profile_list),
+            self.index(sensor.Tank, self.tanks, self.tank_list),
+            mfg,
+            _opt(sensor.LastSeen),
+            _opt(sensor.StaleTimeout),
+        ))
+        if health is not None:
+            out.append(_HEALTH.pack(
+                health.ExpectedInterval,
+                health.Alpha,
+                health.Count,
+                _opt(health.RssiEwma),
+                _opt(health.IntervalEwma),
+                health.Jitter,
+                *health.QualityCounts,
+                health.Missed,
+                _opt(health.LastSeen),
+            ))
+        if forecast is not None:
+            out.append(_FORECAST.pack(
+                forecast.ThresholdInMM,
+                _opt(forecast.ThermalExpansion),
+                forecast.RefillInMM,
+                forecast.ConfirmReadings,
+                forecast.Count,
+                forecast.Refills,
+                _opt(forecast.LastRefill),
+                _opt(forecast.LastUpdate),
+                forecast._q,
+                forecast._level,
+                forecast._rate,
+                forecast._p00,
+                forecast._p01,
+                forecast._p11,
+                forecast._jump_count,
+                forecast._jump_sum,
+                forecast._jump_up,
+            ))
+        if history is not None:
+            out.append(_HISTORY.pack(history._capacity, history._count, history._head))
+            self.histories.append(history)
+
+    def columns(self) -> None:
+        histories = self.histories
+        self.out.append(_COLUMNS.pack(array("l").itemsize, sum(h._capacity for h in histories)))
+        for name in _HISTORY_COLUMNS:
+            column = array(getattr(histories[0], name).typecode) if histories else array("b")
+            for history in histories:
+                column.extend(getattr(history, name))
+            self.out.append(_array_bytes(column))
+
+
+def SnapshotService(service) -> bytes:
+    """ Binary snapshot of the state of a MopekaService """
+    w = _Writer()
+    with service._reading_lock:
+        clock = service.Clock()
+        wall = time.time()
+        monitored = list(service._monitored_by_raw_mac.values())
+        discovered = list(service._discovered_by_raw_mac.values())
+        for sensor in monitored:
+            w.sensor(sensor, _MONITORED)
+        for sensor in discovered:
+            w.sensor(sensor, _DISCOVERED)
+        w.columns()
+        stats = [(k, v) for k, v in vars(service.ServiceStats).items() if isinstance(v, int)]
+
+    head = [_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, clock, wall), _U16.pack(len(stats))]
+    for name, value in stats:
+        _pack_name(head, name)
+        head.append(_STAT.pack(value))
+    head.append(_U16.pack(len(w.profile_list)))
+    for profile in w.profile_list:
+        _pack_name(head, profile.Name)
+        head.append(_PROFILE.pack(
+            profile.HardwareId.value, *profile.Coefficients, profile.MeasuresAirSpace, profile.ThermalExpansion))
+    head.append(_U16.pack(len(w.tank_list)))
+    for tank in w.tank_list:
+        _pack_name(head, tank.Name)
+        head.append(_TANK.pack(
+            tank.Orientation.value, tank.HeightInMM, tank.CapacityInLiters, tank.EmptyInMM, tank.FullInMM))
+    head.append(_U32.pack(len(monitored) + len(discovered)))
+    return b"".join(head + w.out)
+
+
+def _restore_profile(name: str, hardware_id: int, coefficients: tuple, air_space: bool, expansion: float) -> SensorProfile:
+    """ the registered profile if it matches, otherwise a new one """
+    try:
+        profile = GetProfile(name)
+        if (profile.HardwareId.value == hardware_id and profile.Coefficients == coefficients
+                and profile.MeasuresAirSpace == air_space and profile.ThermalExpansion == expansion):
+            return profile
+    except KeyError:
+        pass
+    return SensorProfile(name, HardwareId(hardware_id), coefficients, air_space, expansion)
+
+
+def _restore_tank(name: str, orientation: int, height: int, capacity: float, empty: int, full: int) -> TankGeometry:
+    """ the built in tank if it matches, otherwise a new one """
+    tank = TANK_GEOMETRIES.get(name)
+    if (tank is not None and tank.Orientation.value == orientation and tank.HeightInMM == height
+            and tank.CapacityInLiters == capacity and tank.EmptyInMM == empty and tank.FullInMM == full):
+        return tank
+    return TankGeometry(name, TankOrientation(orientation), height, capacity, empty, full)
+
+
+def _shift(value: Optional[float], shift: float) -> Optional[float]:
+    return None if value is None else value + shift
+
+
+def RestoreService(service, data: bytes) -> int:
+    """ Load a snapshot into a MopekaService.  Returns the number of sensors.
+
+    Monitored sensors are added with one AddSensorsToMonitor call (sensors
+    with the same mac are replaced), discovered sensors are added to the
+    discovered list and the statistics are replaced.  Raises ValueError if
+    data is not a snapshot or is from a newer version.
+    """
+    data = memoryview(data)
+    if len(data) < _HEADER.size:
+        raise ValueError("Snapshot is truncated")
+    magic, version, _, clock, wall = _HEADER.unpack_from(data, 0)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError("Not a service snapshot")
+    if version > SNAPSHOT_VERSION:
+        raise ValueError(f"Snapshot version {version} is newer than supported {SNAPSHOT_VERSION}")
+    # maps a snapshot Clock() time to this process' clock.  Downtime counts
+    shift = service.Clock() - (time.time() - wall) - clock
+    try:
+        return _restore(service, data, _HEADER.size, shift)
+    except (struct.error, IndexError) as e:
+        raise ValueError(f"Snapshot is truncated or corrupt ({e})") from e
+
+
+def _restore(service, data: memoryview, offset: int, shift: float) -> int:
+    stats = dict()
+    (count,) = _U16.unpack_from(data, offset)
+    offset += _U16.size
+    for _ in range(count):
+        name, offset = _unpack_name(data, offset)
+        (stats[name],) = _STAT.unpack_from(data, offset)
+        offset += _STAT.size
+
+    profiles = [None]
+    (count,) = _U16.unpack_from(data, offset)
+    offset += _U16.size
+    for _ in range(count):
+        name, offset = _unpack_name(data, offset)
+        hardware_id, c0, c1, c2, air_space, expansion = _PROFILE.unpack_from(data, offset)
+        offset += _PROFILE.size
+        profiles.append(_restore_profile(name, hardware_id, (c0, c1, c2), bool(air_space), expansion))
+
+    tanks = [None]
+    (count,) = _U16.unpack_from(data, offset)
+    offset += _U16.size
+    for _ in range(count):
+        name, offset = _unpack_name(data, offset)
+        tanks.append(_restore_tank(name, *_TANK.unpack_from(data, offset)))
+        offset += _TANK.size
+
+    monitored = []
+    discovered = []
+    histories = []
+    (count,) = _U32.unpack_from(data, offset)
+    offset += _U32.size
+    for _ in range(count):
+        raw_mac, which, flags, rssi, profile, tank, mfg, last_seen, stale_timeout = _SENSOR.unpack_from(data, offset)
+        offset += _SENSOR.size
+        sensor = MopekaSensor(_raw_to_mac(raw_mac), 0, profiles[profile], tanks[tank])
+        if flags & _HAS_READING:
+            reading = CompactMopekaAdvertisement.FromMfgData(raw_mac, mfg, rssi)
+            sensor._last_reading = reading
+            sensor._last_packet = reading
+        sensor.Offline = bool(flags & _OFFLINE)
+        sensor.LastSeen = _shift(_none(last_seen), shift)
+        sensor.StaleTimeout = _none(stale_timeout)
+
+        if flags & _HAS_HEALTH:
+            values = _HEALTH.unpack_from(data, offset)
+            offset += _HEALTH.size
+            health = SensorHealth(values[0], values[1])
+            health.Count = values[2]
+            health.RssiEwma = _none(values[3])
+            health.IntervalEwma = _none(values[4])
+            health.Jitter = values[5]
+            health.QualityCounts = list(values[6:10])
+            health.Missed = values[10]
+            health.LastSeen = _shift(_none(values[11]), shift)
+            sensor.Health = health
+        else:
+            sensor.Health = None
+
+        if flags & _HAS_FORECAST:
+            values = _FORECAST.unpack_from(data, offset)
+            offset += _FORECAST.size
+            forecast = ConsumptionForecast(values[0], _none(values[1]), refill_mm=values[2], confirm_readings=values[3])
+            forecast.Count = values[4]
+            forecast.Refills = values[5]
+            forecast.LastRefill = _shift(_none(values[6]), shift)
+            forecast.LastUpdate = _shift(_none(values[7]), shift)
+            (forecast._q, forecast._level, forecast._rate, forecast._p00, forecast._p01, forecast._p11,
+             forecast._jump_count, forecast._jump_sum) = values[8:16]
+            forecast._jump_up = bool(values[16])
+            sensor.Forecast = forecast
+        else:
+            sensor.Forecast = None
+
+        if flags & _HAS_HISTORY:
+            capacity, used, head = _HISTORY.unpack_from(data, offset)
+            offset += _HISTORY.size
+            history = ReadingHistory.__new__(ReadingHistory)
+            history._capacity = capacity
+            history._count = used
+            history._head = head
+            histories.append(history)
+            sensor.History = history
+
+        (monitored if which == _MONITORED else discovered).append(sensor)
+
+    level_size, slots = _COLUMNS.unpack_from(data, offset)
+    offset += _COLUMNS.size
+    columns = []
+    for name, typecode in zip(_HISTORY_COLUMNS, ("d", "b", _LEVEL_TYPECODES[level_size], "b", "f", "B")):
+        column, offset = _array_from(typecode, data, offset, slots)
+        columns.append(column)
+    if slots:
+        columns[0] = array("d", [t + shift for t in columns[0]])
+        if columns[2].typecode != "l":
+            columns[2] = array("l", columns[2])
+    start = 0
+    for history in histories:
+        end = start + history._capacity
+        (history._timestamp, history._rssi, history._level,
+         history._temp, history._battery, history._quality) = [c[start:end] for c in columns]
+        start = end
+
+    with service._reading_lock:
+        for sensor in discovered:
+            service.SensorDiscoveredList[sensor._bdaddress] = sensor
+            service._discovered_by_raw_mac[sensor._raw_mac] = sensor
+        for name, value in stats.items():
+            if hasattr(service.ServiceStats, name):
+                setattr(service.ServiceStats, name, value)
+    service.AddSensorsToMonitor(monitored)
+    # same lock order as MopekaService._apply_reading
+    with service._reading_lock, service._forecast_lock:
+        for sensor in monitored:
+            if sensor.Forecast is not None:
+                service._forecast_index.Update(sensor, sensor.Forecast.EmptyAt)
+    return len(monitored) + len(discovered)
+
+
+def SaveSnapshot(service, path: str) -> None:
+    """ Write a snapshot to path.  The file is replaced atomically """
+    data = SnapshotService(service)
+    temp = path + ".tmp"
+    with open(temp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, path)
+
+
+def LoadSnapshot(service, path: str) -> int:
+    """ Restore a snapshot written by SaveSnapshot.  Returns the number of sensors """
+    with open(path, "rb") as f:
+        data = f.read()
+    return RestoreService(service, data)
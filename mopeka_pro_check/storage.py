@@ -0,0 +1,274 @@
+"""Persistent reading store
+
+Readings are appended to a compact fixed width binary log.  Writes are
+queued by the scanning thread and written in batches by a background
+thread so the scanning thread never blocks on disk.  Reads memory map the
+file and use binary search on time since records are appended in order.
+The wall clock can step backwards (NTP, a board without a real time clock
+booting with an old time) so the writer clamps each timestamp to at least
+the one before it, which keeps the file sorted.
+
+File layout (little endian):
+
+    header:  STORE_MAGIC (8 bytes)
+    record:  timestamp float64 (time.time(), never decreasing), mac 6 bytes (as in the hci
+             packet), rssi int8 (127 when not available), mfg data 13 bytes    = 28 bytes
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import logging
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+from typing import BinaryIO, Iterator, List, NamedTuple, Optional, Tuple
+
+from .advertisement import MacToRaw
+
+STORE_MAGIC = b"MPKLOG\x01\x00"
+""" Header of the reading log (version 1) """
+
+_RECORD = struct.Struct("<d6sb13s")
+RECORD_SIZE = _RECORD.size
+
+_RSSI_NOT_AVAILABLE = 127
+""" stored rssi for None.  Never a valid rssi (reserved range) """
+
+DEFAULT_QUEUE_SIZE = 65536
+""" Readings buffered for the writer thread before new readings are dropped """
+
+DEFAULT_FLUSH_INTERVAL = 1.0
+""" Seconds between writes to disk """
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class StoredReading(NamedTuple):
+    """ Reading read back from a ReadingStore """
+
+    timestamp: float
+    mac: str
+    rssi: Optional[int]
+    mfg_data: bytes
+    """ 13 byte GAP_MFG_DATA report, same as MopekaAdvertisement._raw_mfg_data """
+
+
+def _raw_to_mac(raw: bytes) -> str:
+    return "%02X:%02X:%02X:%02X:%02X:%02X" % tuple(raw[::-1])
+
+
+class ReadingStore(object):
+    """ Append only reading log with a background batching writer
+
+    ``` python
+    store = ReadingStore("readings.bin")
+    service.AddReadingCallback(store.OnReading)
+    ...
+    store.Close()
+    ```
+    """
+
+    DroppedCount: int
+    """ readings dropped because the write queue was full """
+
+    def __init__(
+        self,
+        path: str,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+    ):
+        self.path = path
+        self.DroppedCount = 0
+        self._flush_interval = flush_interval
+        self._queue = queue.Queue(queue_size)
+        self._file, self._last_timestamp = self._open(path)
+        self._closing = False
+        self._wake = threading.Event()
+        self._drain_cond = threading.Condition()
+        self._drains_started = 0
+        self._drains_completed = 0
+        self._thread = threading.Thread(target=self._writer, name="mopeka-store", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _open(path: str) -> Tuple[BinaryIO, float]:
+        """ open for append, creating the header or dropping a partial last
+        record.  Returns the file and the timestamp of its last record """
+        f = open(path, "a+b")
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size == 0:
+            f.write(STORE_MAGIC)
+            f.flush()
+            return f, float("-inf")
+
+        f.seek(0)
+        if f.read(len(STORE_MAGIC)) != STORE_MAGIC:
+            f.close()
+            raise ValueError(f"{path} is not a reading store")
+        partial = (size - len(STORE_MAGIC)) % RECORD_SIZE
+        if partial:
+            # unclean shutdown in the middle of a write
+            _LOGGER.warning("Dropping %d byte partial record from %s" % (partial, path))
+            f.truncate(size - partial)
+            size -= partial
+        if size == len(STORE_MAGIC):
+            return f, float("-inf")
+        f.seek(size - RECORD_SIZE)
+        return f, _RECORD.unpack(f.read(RECORD_SIZE))[0]
+
+    ##
+    ## Scanning thread side
+    ##
+    def Append(self, raw_mac: bytes, mfg_data: bytes, rssi: Optional[int], timestamp: Optional[float] = None) -> None:
+        """ Queue a reading.  Never blocks; drops and counts when the queue is full.
+        timestamp is raised to the previous record's if it is earlier """
+        if timestamp is None:
+            timestamp = time.time()
+        try:
+            self._queue.put_nowait((timestamp, raw_mac, rssi, mfg_data))
+        except queue.Full:
+            self.DroppedCount += 1
+
+    def OnReading(self, sensor, reading) -> None:
+        """ MopekaService reading callback """
+        self.Append(sensor._raw_mac, reading._raw_mfg_data, reading.rssi)
+
+    ##
+    ## Writer thread
+    ##
+    def _writer(self) -> None:
+        while True:
+            self._wake.wait(self._flush_interval)
+            self._wake.clear()
+            closing = self._closing
+            with self._drain_cond:
+                self._drains_started += 1
+                drain = self._drains_started
+            try:
+                self._drain()
+            except Exception:
+                _LOGGER.exception("Writing readings failed")
+            with self._drain_cond:
+                self._drains_completed = drain
+                self._drain_cond.notify_all()
+            if closing:
+                return
+
+    def _drain(self) -> None:
+        batch = []
+        try:
+            while True:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        if batch:
+            pack = _RECORD.pack
+            records = []
+            last = self._last_timestamp
+            for timestamp, raw_mac, rssi, mfg_data in batch:
+                if timestamp < last:
+                    timestamp = last
+                if rssi is None:
+                    rssi = _RSSI_NOT_AVAILABLE
+                try:
+                    records.append(pack(timestamp, raw_mac, rssi, mfg_data))
+                except struct.error as e:
+                    _LOGGER.error("Skipping reading that can't be stored: %s" % e)
+                    continue
+                last = timestamp
+            self._last_timestamp = last
+            self._file.write(b"".join(records))
+            self._file.flush()
+
+    def Flush(self, timeout: float = 5.0) -> bool:
+        """ Wait until everything queued so far is on disk.  False on timeout """
+        with self._drain_cond:
+            # a drain in progress may have missed our readings so wait for the next one
+            target = self._drains_started + 1
+            self._wake.set()
+            return self._drain_cond.wait_for(lambda: self._drains_completed >= target, timeout)
+
+    def Close(self) -> None:
+        """ Write everything queued and close the file """
+        self._closing = True
+        self._wake.set()
+        self._thread.join()
+        self._file.close()
+
+    def __enter__(self) -> "ReadingStore":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.Close()
+
+    ##
+    ## Reading
+    ##
+    @staticmethod
+    def Query(
+        path: str,
+        mac: Optional[str] = None,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+    ) -> List[StoredReading]:
+        """ Readings with start <= timestamp < end, optionally for one mac """
+        return [
+            StoredReading(t, _raw_to_mac(m), None if r == _RSSI_NOT_AVAILABLE else r, d)
+            for t, m, r, d in ReadingStore._iter_raw(path, mac, start, end)
+        ]
+
+    @staticmethod
+    def QueryPayloads(
+        path: str,
+        mac: Optional[str] = None,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+    ) -> Tuple[List[float], bytes]:
+        """ (timestamps, concatenated 13 byte mfg payloads) for batch decoding
+        with mopeka_pro_check.batch.MopekaAdvertisementBatch """
+        timestamps = []
+        payloads = []
+        for t, _m, _r, d in ReadingStore._iter_raw(path, mac, start, end):
+            timestamps.append(t)
+            payloads.append(d)
+        return (timestamps, b"".join(payloads))
+
+    @staticmethod
+    def _iter_raw(path, mac, start, end) -> Iterator[Tuple[float, bytes, int, bytes]]:
+        raw_mac = MacToRaw(mac) if mac is not None else None
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            count = (size - len(STORE_MAGIC)) // RECORD_SIZE
+            if count <= 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if m[: len(STORE_MAGIC)] != STORE_MAGIC:
+                    raise ValueError(f"{path} is not a reading store")
+                base = len(STORE_MAGIC)
+
+                def timestamp(i):
+                    return struct.unpack_from("<d", m, base + i * RECORD_SIZE)[0]
+
+                def lower_bound(t):
+                    lo, hi = 0, count
+                    while lo < hi:
+                        mid = (lo + hi) // 2
+                        if timestamp(mid) < t:
+                            lo = mid + 1
+                        else:
+                            hi = mid
+                    return lo
+
+                first = 0 if start is None else lower_bound(start)
+                last = count if end is None else lower_bound(end)
+                unpack = _RECORD.unpack_from
+                for i in range(first, last):
+                    record = unpack(m, base + i * RECORD_SIZE)
+                    if raw_mac is None or record[1] == raw_mac:
+                        yield record
@@ -0,0 +1,204 @@
+"""Batched reading subscriptions
+
+Subscribers register a callback with optional filters (mac, hardware id,
+change threshold).  Matching readings are copied into a bounded per
+subscriber queue on the scanning thread and delivered in micro batches by
+a single dispatcher thread, flushed when a batch is full or the oldest
+queued reading has waited flush_interval seconds.  A slow subscriber only
+delays the dispatcher; the scanning thread never blocks.  When a queue is
+full the oldest reading is dropped and counted.
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+from collections import deque
+import logging
+import threading
+import time
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from .advertisement import MacToRaw, HardwareId
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 32
+""" Readings delivered per call """
+
+DEFAULT_FLUSH_INTERVAL = 0.5
+""" Seconds a reading waits for a batch to fill """
+
+DEFAULT_SUBSCRIBER_QUEUE_SIZE = 1024
+""" Readings buffered per subscriber before the oldest is dropped """
+
+BatchCallback = Callable[[List[Tuple[object, object]]], None]
+""" Called on the dispatcher thread with a list of (sensor, reading) """
+
+
+class Subscription(object):
+    """ One subscriber.  Created by MopekaService.Subscribe """
+
+    DroppedCount: int
+    """ readings dropped because the queue was full """
+
+    DeliveredCount: int
+    """ readings passed to the callback """
+
+    def __init__(
+        self,
+        callback: BatchCallback,
+        macs: Optional[Iterable[str]] = None,
+        hardware_ids: Optional[Iterable[HardwareId]] = None,
+        change_threshold=None,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        queue_size: int = DEFAULT_SUBSCRIBER_QUEUE_SIZE,
+    ):
+        """ macs and hardware_ids of None match everything.  change_threshold
+        (service.ChangeThreshold) only passes readings that moved past it
+        since the last reading this subscriber got for the sensor """
+        self.Callback = callback
+        self.BatchSize = batch_size
+        self.FlushInterval = flush_interval
+        self.DroppedCount = 0
+        self.DeliveredCount = 0
+        self._raw_macs = None if macs is None else frozenset(MacToRaw(m) for m in macs)
+        self._hardware_ids = None if hardware_ids is None else frozenset(HardwareId(h).value for h in hardware_ids)
+        self._threshold = change_threshold
+        self._reported = dict()
+        self._queue = deque(maxlen=queue_size)
+        # monotonic time the oldest queued reading arrived.  None when empty.
+        # Changed together with the queue under _queue_lock so a reading
+        # offered while Flush drains the queue is never left without one
+        self._pending_since = None
+        self._queue_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def _matches(self, sensor, reading) -> bool:
+        if self._raw_macs is not None and sensor._raw_mac not in self._raw_macs:
+            return False
+        if self._hardware_ids is not None and reading._raw_hardware_id not in self._hardware_ids:
+            return False
+        threshold = self._threshold
+        if threshold is None:
+            return True
+        values = (reading.TankLevelInMM, reading.TemperatureInCelsius, reading.BatteryPercent)
+        last = self._reported.get(sensor._raw_mac)
+        if last is not None:
+            for value, previous, limit in zip(values, last, threshold):
+                if limit is not None and abs(value - previous) >= limit:
+                    break
+            else:
+                return False
+        self._reported[sensor._raw_mac] = values
+        return True
+
+    def _offer(self, item, now: float) -> bool:
+        """ queue a reading.  True if the dispatcher should look at this subscriber """
+        queue = self._queue
+        with self._queue_lock:
+            if len(queue) == queue.maxlen:
+                self.DroppedCount += 1
+            queue.append(item)
+            if self._pending_since is None:
+                self._pending_since = now
+                return True
+            return len(queue) >= self.BatchSize
+
+    def __len__(self) -> int:
+        """ readings waiting for delivery """
+        return len(self._queue)
+
+    def _due(self, now: float) -> Optional[float]:
+        """ seconds until this subscriber must be flushed.  None if empty """
+        since = self._pending_since
+        if since is None:
+            return None
+        if len(self._queue) >= self.BatchSize:
+            return 0.0
+        return since + self.FlushInterval - now
+
+    def Flush(self) -> None:
+        """ deliver everything queued now on the calling thread """
+        with self._flush_lock:
+            queue = self._queue
+            while True:
+                with self._queue_lock:
+                    batch = []
+                    while queue and len(batch) < self.BatchSize:
+                        batch.append(queue.popleft())
+                    if not queue:
+                        self._pending_since = None
+                if not batch:
+                    break
+                try:
+                    self.Callback(batch)
+                except Exception:
+                    _LOGGER.exception("Subscriber callback failed")
+                self.DeliveredCount += len(batch)
+
+
+class ReadingDispatcher(object):
+    """ Delivers readings to subscriptions on one thread.  Register OnReading
+    as a service reading callback """
+
+    def __init__(self):
+        self._subscriptions: List[Subscription] = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def Add(self, subscription: Subscription) -> None:
+        with self._lock:
+            self._subscriptions = self._subscriptions + [subscription]
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="MopekaDispatcher", daemon=True)
+                self._thread.start()
+
+    def Remove(self, subscription: Subscription, flush: bool = True) -> None:
+        """ stop delivering to subscription.  flush delivers what is queued first """
+        with self._lock:
+            self._subscriptions = [s for s in self._subscriptions if s is not subscription]
+            thread = self._thread if not self._subscriptions else None
+            if thread is not None:
+                self._thread = None
+        self._wake.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        if flush:
+            subscription.Flush()
+
+    def __len__(self) -> int:
+        return len(self._subscriptions)
+
+    def OnReading(self, sensor, reading) -> None:
+        """ service reading callback.  Runs on the scanning thread """
+        now = time.monotonic()
+        wake = False
+        item = (sensor, reading)
+        for subscription in self._subscriptions:
+            if subscription._matches(sensor, reading) and subscription._offer(item, now):
+                wake = True
+        if wake:
+            self._wake.set()
+
+    def _run(self) -> None:
+        me = threading.current_thread()
+        wake = self._wake
+        while self._thread is me:
+            now = time.monotonic()
+            timeout = None
+            for subscription in self._subscriptions:
+                due = subscription._due(now)
+                if due is None:
+                    continue
+                if due <= 0:
+                    subscription.Flush()
+                    due = subscription._due(time.monotonic())
+                    if due is None:
+                        continue
+                if timeout is None or due < timeout:
+                    timeout = due
+            wake.wait(None if timeout is None else max(timeout, 0.0))
+            wake.clear()
@@ -0,0 +1,113 @@
+"""Tank geometry models.
+
+Converts a fluid height in mm into percent full and volume.  The fill
+fraction for every whole mm of height is computed once when the geometry
+is created so conversions are a table lookup and a linear interpolation.
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+from enum import Enum
+import math
+from typing import Dict, Optional, Tuple
+
+
+class TankOrientation(Enum):
+    """ how the cylinder sits.  Sensors are mounted on the bottom (or top) """
+    VERTICAL = 0
+    HORIZONTAL = 1
+
+
+def _vertical_fraction(height: float, diameter: float) -> float:
+    return height
+
+
+def _horizontal_fraction(height: float, diameter: float) -> float:
+    """ cross section area of a circular segment of the given height """
+    r = diameter / 2.0
+    h = min(max(height, 0.0), diameter)
+    return r * r * math.acos((r - h) / r) - (r - h) * math.sqrt(max(2 * r * h - h * h, 0.0))
+
+
+class TankGeometry(object):
+    """ Cylindrical tank with a usable range between EmptyInMM and FullInMM
+
+    For vertical tanks the volume is linear between empty and full.  For
+    horizontal tanks it follows the area of the circular segment below the
+    fluid surface with HeightInMM as the internal diameter.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        orientation: TankOrientation,
+        height_mm: int,
+        capacity_liters: float,
+        empty_mm: int = 0,
+        full_mm: Optional[int] = None,
+    ):
+        """ height_mm is the internal height seen by the sensor.
+        capacity_liters is the volume at full_mm (defaults to height_mm) """
+        if full_mm is None:
+            full_mm = height_mm
+        if not 0 <= empty_mm < full_mm <= height_mm:
+            raise ValueError("Tank requires 0 <= empty_mm < full_mm <= height_mm")
+        self.Name = name
+        self.Orientation = orientation
+        self.HeightInMM = height_mm
+        self.CapacityInLiters = capacity_liters
+        self.EmptyInMM = empty_mm
+        self.FullInMM = full_mm
+
+        shape = _vertical_fraction if orientation == TankOrientation.VERTICAL else _horizontal_fraction
+        low = shape(empty_mm, height_mm)
+        span = shape(full_mm, height_mm) - low
+        table = []
+        for h in range(height_mm + 1):
+            if h <= empty_mm:
+                table.append(0.0)
+            elif h >= full_mm:
+                table.append(100.0)
+            else:
+                table.append((shape(h, height_mm) - low) * 100.0 / span)
+        self._percent: Tuple[float, ...] = tuple(table)
+
+    def PercentFull(self, level_mm: float) -> float:
+        """ percent (0-100) of capacity at a fluid height in mm """
+        if level_mm <= 0:
+            return 0.0
+        if level_mm >= self.HeightInMM:
+            return self._percent[-1]
+        i = int(level_mm)
+        low = self._percent[i]
+        frac = level_mm - i
+        if frac:
+            return low + (self._percent[i + 1] - low) * frac
+        return low
+
+    def VolumeInLiters(self, level_mm: float) -> float:
+        """ volume of fluid in liters at a fluid height in mm """
+        return self.PercentFull(level_mm) * self.CapacityInLiters / 100.0
+
+    def FluidHeightFromAirSpace(self, air_space_mm: float) -> float:
+        """ fluid height for a top down sensor reporting the distance to the surface """
+        return max(self.HeightInMM - air_space_mm, 0)
+
+    def __repr__(self) -> str:
+        return f"TankGeometry({self.Name!r}, {self.Orientation.name}, {self.HeightInMM}mm, {self.CapacityInLiters}L)"
+
+
+# Typical US propane tanks.  Usable range for vertical tanks follows the
+# common 1.5 inch empty offset of the bottom weld ring and capacity is the
+# propane volume at the 80% fill limit.  The horizontal tank uses its full
+# diameter and nominal water capacity.
+TANK_20LB_VERTICAL = TankGeometry("20lb", TankOrientation.VERTICAL, 305, 17.8, 38, 254)
+TANK_100LB_VERTICAL = TankGeometry("100lb", TankOrientation.VERTICAL, 1000, 89.3, 38, 876)
+TANK_500GAL_HORIZONTAL = TankGeometry("500gal", TankOrientation.HORIZONTAL, 953, 1892.7)
+
+TANK_GEOMETRIES: Dict[str, TankGeometry] = {
+    t.Name: t for t in (TANK_20LB_VERTICAL, TANK_100LB_VERTICAL, TANK_500GAL_HORIZONTAL)
+}
+""" Built in tanks by name """
@@ -0,0 +1,82 @@
+"""Hashed timer wheel
+
+Deadlines are hashed into a fixed number of slots by tick.  Schedule and
+Cancel are O(1).  Advance walks only the slots for the ticks that passed.
+Deadlines further out than one rotation stay in their slot and are
+skipped until their rotation comes around.
+
+Used by the service for stale sensor detection: each monitored sensor has
+at most one entry and packets only record the time they arrived.  When an
+entry expires the service checks the sensor's last seen time and either
+reports it offline or schedules it again.
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import math
+from typing import Dict, Hashable, List, Optional
+
+DEFAULT_WHEEL_SLOTS = 256
+
+
+class TimerWheel(object):
+    """ Timer wheel keyed by any hashable.  Not thread safe """
+
+    def __init__(self, tick: float = 1.0, slots: int = DEFAULT_WHEEL_SLOTS, now: float = 0.0):
+        """ tick is the resolution in seconds.  Timers fire up to one tick late """
+        if tick <= 0:
+            raise ValueError("tick must be positive")
+        self.Tick = tick
+        self._slots: List[Dict[Hashable, float]] = [dict() for _ in range(slots)]
+        self._slot_of: Dict[Hashable, int] = dict()
+        # last tick that has completely passed
+        self._current = self._tick_of(now) - 1
+
+    def _tick_of(self, t: float) -> int:
+        return math.floor(t / self.Tick)
+
+    def __len__(self) -> int:
+        return len(self._slot_of)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._slot_of
+
+    def Schedule(self, key: Hashable, deadline: float) -> None:
+        """ add or move the timer for key """
+        self.Cancel(key)
+        # never schedule into a tick that was already processed
+        index = max(self._tick_of(deadline), self._current + 1) % len(self._slots)
+        self._slots[index][key] = deadline
+        self._slot_of[key] = index
+
+    def Cancel(self, key: Hashable) -> Optional[float]:
+        """ remove the timer for key.  Returns its deadline or None """
+        index = self._slot_of.pop(key, None)
+        if index is None:
+            return None
+        return self._slots[index].pop(key)
+
+    def Advance(self, now: float) -> List[Hashable]:
+        """ process the ticks completed by now.  Returns keys whose deadline passed """
+        target = self._tick_of(now) - 1
+        if target <= self._current:
+            return []
+        count = len(self._slots)
+        # a jump of more than one rotation visits every slot once
+        first = max(self._current + 1, target - count + 1)
+        expired = []
+        for tick in range(first, target + 1):
+            slot = self._slots[tick % count]
+            if not slot:
+                continue
+            # later rotations stay in the slot
+            end = (tick + 1) * self.Tick
+            due = [key for key, deadline in slot.items() if deadline < end]
+            for key in due:
+                del slot[key]
+                del self._slot_of[key]
+            expired.extend(due)
+        self._current = target
+        return expired
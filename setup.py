@@ -26,6 +26,14 @@ setuptools.setup(
     install_requires=[
         'bleson>=0.1.6'
     ],
+    extras_require={
+        'batch': ['numpy'],
+    },
+    entry_points={
+        'console_scripts': [
+            'mopeka-pro-check=mopeka_pro_check.cli:main',
+        ],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
@@ -8,7 +8,14 @@ SPDX-License-Identifier: MIT
 import unittest
 import logging
 import copy
-from mopeka_pro_check.advertisement import MopekaAdvertisement, NoGapDataException
+from mopeka_pro_check.advertisement import (
+    MopekaAdvertisement,
+    CompactMopekaAdvertisement,
+    NoGapDataException,
+    IsMopekaAdvertisement,
+    ParseStatus,
+    MOPEKA_TANK_LEVEL_COEFFICIENTS_PROPANE,
+)
 
 
 BLE_NOT_MOPEKA = bytes.fromhex(
@@ -76,7 +83,7 @@ class MopekaManufacturingDataPacketTest(unittest.TestCase):
     def test_mfg_packet_hardwareid_not_mopeka(self):
         """ hardware id is not supported value """
         b = bytearray(BLE_MOPEKA_MFG[:])
-        b[14] = 4  # not HardwareId.STD_BOTTOM_UP_PROPANE
+        b[14] = 0x7F  # not a supported hardware id
         with self.assertRaises(Exception):
             MopekaAdvertisement(b)
 
@@ -150,3 +157,204 @@ class MopekaManufacturingDataPacketTest(unittest.TestCase):
         """ Make sure dump routine works"""
         ma = MopekaAdvertisement(BLE_MOPEKA_MFG)
         ma.Dump()
+
+
+class IsMopekaAdvertisementTest(unittest.TestCase):
+    """ tests for the cheap prefilter used before parsing """
+
+    def test_mopeka_packet(self):
+        self.assertTrue(IsMopekaAdvertisement(BLE_MOPEKA_MFG))
+
+    def test_not_mopeka_packet(self):
+        self.assertFalse(IsMopekaAdvertisement(BLE_NOT_MOPEKA))
+
+    def test_zero_length_gap(self):
+        self.assertFalse(IsMopekaAdvertisement(BLE_ZERO_LEN_NO_GAP))
+
+    def test_mfgid_not_mopeka(self):
+        b = bytearray(BLE_MOPEKA_MFG[:])
+        b[12] = 4  # change from 0059 to 0004
+        self.assertFalse(IsMopekaAdvertisement(b))
+
+    def test_mfg_length_not_mopeka(self):
+        b = bytearray(BLE_MOPEKA_MFG[:])
+        b[10] = 4  # change size of mfg data packet
+        self.assertFalse(IsMopekaAdvertisement(b))
+
+
+class CompactMopekaAdvertisementTest(unittest.TestCase):
+    """ compact variant must match MopekaAdvertisement """
+
+    FIELDS = (
+        "rssi", "mac", "name", "HardwareId", "SyncButtonPressed",
+        "ReadingQualityStars", "BatteryVoltage", "BatteryPercent",
+        "TemperatureInCelsius", "TemperatureInFahrenheit", "TankLevelInMM",
+        "TankLevelInInches", "_raw_x_accel", "_raw_y_accel", "_raw_mfg_data",
+    )
+
+    def _assert_same(self, data):
+        ma = MopekaAdvertisement(data)
+        cma = CompactMopekaAdvertisement(data)
+        for field in self.FIELDS:
+            self.assertEqual(getattr(ma, field), getattr(cma, field), field)
+        self.assertEqual(str(ma), str(cma))
+
+    def test_known_good_packet(self):
+        self._assert_same(BLE_MOPEKA_MFG)
+
+    def test_all_temperatures_and_batteries(self):
+        b = bytearray(BLE_MOPEKA_MFG[:])
+        for value in range(256):
+            b[15] = value
+            b[16] = value
+            self._assert_same(bytes(b))
+
+    def test_has_no_instance_dict(self):
+        cma = CompactMopekaAdvertisement(BLE_MOPEKA_MFG)
+        self.assertFalse(hasattr(cma, "__dict__"))
+
+    def test_zero_length_gap(self):
+        with self.assertRaises(NoGapDataException):
+            CompactMopekaAdvertisement(BLE_ZERO_LEN_NO_GAP)
+
+    def test_not_mopeka(self):
+        with self.assertRaises(Exception):
+            CompactMopekaAdvertisement(BLE_NOT_MOPEKA)
+
+    def test_hardwareid_not_mopeka(self):
+        b = bytearray(BLE_MOPEKA_MFG[:])
+        b[14] = 0x7F  # not a supported hardware id
+        with self.assertRaises(Exception):
+            CompactMopekaAdvertisement(b)
+
+
+class TryParseTest(unittest.TestCase):
+    """ exception free parse path """
+
+    def _status(self, data):
+        status, ma = MopekaAdvertisement.TryParse(data)
+        if status == ParseStatus.OK:
+            self.assertIsNotNone(ma)
+        else:
+            self.assertIsNone(ma)
+        return status
+
+    def test_known_good_packet(self):
+        status, ma = MopekaAdvertisement.TryParse(BLE_MOPEKA_MFG)
+        self.assertEqual(status, ParseStatus.OK)
+        expected = MopekaAdvertisement(BLE_MOPEKA_MFG)
+        self.assertEqual(str(ma), str(expected))
+        self.assertEqual(ma.mac, expected.mac)
+        self.assertEqual(ma.HardwareId, expected.HardwareId)
+        self.assertEqual(ma._raw_mfg_data, expected._raw_mfg_data)
+
+    def test_zero_length_gap(self):
+        self.assertEqual(self._status(BLE_ZERO_LEN_NO_GAP), ParseStatus.NO_GAP_DATA)
+
+    def test_not_mopeka(self):
+        self.assertEqual(self._status(BLE_NOT_MOPEKA), ParseStatus.NO_MFG_DATA)
+
+    def test_unsupported_length(self):
+        b = bytearray(BLE_MOPEKA_MFG[:])
+        b[10] = 4  # change size of mfg data packet
+        self.assertEqual(self._status(b), ParseStatus.UNSUPPORTED_LENGTH)
+
+    def test_unsupported_manufacturer(self):
+        b = bytearray(BLE_MOPEKA_MFG[:])
+        b[12] = 4  # change from 0059 to 0004
+        self.assertEqual(self._status(b), ParseStatus.UNSUPPORTED_MANUFACTURER)
+
+    def test_unsupported_hardware(self):
+        b = bytearray(BLE_MOPEKA_MFG[:])
+        b[14] = 0x7F  # not a known hardware id
+        self.assertEqual(self._status(b), ParseStatus.UNSUPPORTED_HARDWARE)
+
+    def test_name_report(self):
+        name = b"Mopeka"
+        gap = bytes([len(name) + 1, 0x09]) + name
+        b = bytearray(BLE_MOPEKA_MFG[:-1]) + gap + BLE_MOPEKA_MFG[-1:]
+        b[9] += len(gap)
+        status, ma = MopekaAdvertisement.TryParse(bytes(b))
+        self.assertEqual(ma.name, "Mopeka")
+        self.assertEqual(MopekaAdvertisement(bytes(b)).name, "Mopeka")
+
+    def test_non_ascii_name(self):
+        name = b"Mop\xe9ka"
+        gap = bytes([len(name) + 1, 0x09]) + name
+        b = bytearray(BLE_MOPEKA_MFG[:-1]) + gap + BLE_MOPEKA_MFG[-1:]
+        b[9] += len(gap)
+        status, ma = MopekaAdvertisement.TryParse(bytes(b))
+        self.assertEqual(status, ParseStatus.OK)
+        self.assertEqual(ma.name, "Mop\ufffdka")
+        self.assertEqual(MopekaAdvertisement(bytes(b)).name, "Mop\ufffdka")
+        self.assertEqual(CompactMopekaAdvertisement(bytes(b)).name, "Mop\ufffdka")
+
+
+class ConversionTableTest(unittest.TestCase):
+    """ table based properties must match the original formulas exactly """
+
+    @staticmethod
+    def _tank_level_formula(raw_tank_level, raw_temp):
+        return int(
+            raw_tank_level
+            * (
+                MOPEKA_TANK_LEVEL_COEFFICIENTS_PROPANE[0]
+                + (MOPEKA_TANK_LEVEL_COEFFICIENTS_PROPANE[1] * raw_temp)
+                + (
+                    MOPEKA_TANK_LEVEL_COEFFICIENTS_PROPANE[2]
+                    * raw_temp
+                    * raw_temp
+                )
+            )
+        )
+
+    @staticmethod
+    def _battery_percent_formula(raw_battery):
+        percent = (((raw_battery / 32.0) - 2.2) / 0.65) * 100
+        if percent > 100.0:
+            return 100.0
+        if percent < 0.0:
+            return 0.0
+        return round(percent, 1)
+
+    def test_tank_level_all_inputs(self):
+        b = bytearray(BLE_MOPEKA_MFG[:])
+        for raw_temp in range(128):
+            b[16] = raw_temp
+            ma = MopekaAdvertisement(b)
+            for raw_level in range(0x4000):
+                ma._raw_tank_level = raw_level
+                ma._tank_level_mm = None
+                self.assertEqual(ma.TankLevelInMM, self._tank_level_formula(raw_level, raw_temp))
+
+    def test_battery_and_temperature_all_inputs(self):
+        b = bytearray(BLE_MOPEKA_MFG[:])
+        for raw in range(128):
+            b[15] = raw
+            b[16] = raw
+            for ma in (MopekaAdvertisement(b), CompactMopekaAdvertisement(bytes(b))):
+                self.assertEqual(ma.BatteryPercent, self._battery_percent_formula(raw))
+                self.assertEqual(ma.TemperatureInFahrenheit, (((raw - 40) * 9) / 5) + 32)
+
+    def test_cached(self):
+        ma = MopekaAdvertisement(BLE_MOPEKA_MFG)
+        self.assertEqual(ma.TankLevelInMM, 126)
+        self.assertEqual(ma._tank_level_mm, 126)
+        self.assertEqual(ma.BatteryPercent, 100.0)
+        self.assertEqual(ma._battery_percent, 100.0)
+
+class HciTest(unittest.TestCase):
+    """ local copies of the bleson definitions used by the parser """
+    def test_matches_bleson(self):
+        from bleson.core.hci import constants, type_converters
+        from mopeka_pro_check import hci
+        self.assertEqual(hci.GAP_MFG_DATA, constants.GAP_MFG_DATA)
+        self.assertEqual(hci.GAP_NAME_COMPLETE, constants.GAP_NAME_COMPLETE)
+        self.assertEqual(hci.EVT_LE_ADVERTISING_REPORT, constants.EVT_LE_ADVERTISING_REPORT)
+        for b in range(256):
+            self.assertEqual(hci.rssi_from_byte(b), type_converters.rssi_from_byte(b))
+
+    def test_mac_built_on_access(self):
+        ma = MopekaAdvertisement(BLE_MOPEKA_MFG)
+        self.assertIs(ma.mac, ma.mac)
+        self.assertEqual(ma.mac.address, "E7:9D:05:C4:3C:76")
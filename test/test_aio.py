@@ -0,0 +1,107 @@
+"""Asyncio Mopeka service facade test using synthetic HCI packets
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import unittest
+import logging
+import asyncio
+import threading
+from types import SimpleNamespace
+from mopeka_pro_check.aio import AsyncMopekaService
+from mopeka_pro_check.sensor import MopekaSensor
+from mopeka_pro_check.replay import MakeMopekaPacket
+
+
+BLE_MOPEKA_MFG = bytes.fromhex(
+    "01 00 01 76 3C C4 05 9D E7 12  0D  FF  59  00  03  5D  31  2C  C1  C4  3C  76  3B  F9  03  02  E5  FE  A0")
+BLE_MOPEKA_MAC = "E7:9D:05:C4:3C:76"
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _packet(data: bytes):
+    """ hci packet stand in.  Service only uses the data attribute """
+    return SimpleNamespace(data=data)
+
+
+def _feed_from_thread(service: AsyncMopekaService, data: bytes, count: int = 1):
+    """ feed packets like the bleson scanning thread would.  Each packet after
+    the first gets a new tank level so the service doesn't drop it as a duplicate """
+    def run():
+        for i in range(count):
+            if i > 0:
+                data_i = MakeMopekaPacket(BLE_MOPEKA_MAC, raw_level=0x12C + i)
+            else:
+                data_i = data
+            service.Service.ProcessAdvertisementPacket(_packet(data_i))
+    t = threading.Thread(target=run)
+    t.start()
+    t.join()
+
+
+class AsyncMopekaServiceTest(unittest.TestCase):
+
+    def test_readings(self):
+        async def run():
+            async with AsyncMopekaService() as service:
+                sensor = MopekaSensor(BLE_MOPEKA_MAC)
+                service.AddSensorToMonitor(sensor)
+                readings = service.readings(sensor)
+                first = asyncio.ensure_future(readings.__anext__())
+                await asyncio.sleep(0)  # let the iterator subscribe
+
+                _feed_from_thread(service, BLE_MOPEKA_MFG, 2)
+                r1 = await asyncio.wait_for(first, 1)
+                r2 = await asyncio.wait_for(readings.__anext__(), 1)
+                await readings.aclose()
+                return r1, r2
+
+        r1, r2 = asyncio.run(run())
+        self.assertEqual(r1.TankLevelInMM, 126)
+        self.assertEqual(r2._raw_tank_level, 0x12D)
+
+    def test_full_queue_drops_oldest(self):
+        async def run():
+            async with AsyncMopekaService(queue_size=2) as service:
+                sensor = MopekaSensor(BLE_MOPEKA_MAC)
+                service.AddSensorToMonitor(sensor)
+                readings = service.readings(sensor)
+                first = asyncio.ensure_future(readings.__anext__())
+                await asyncio.sleep(0)
+
+                _feed_from_thread(service, BLE_MOPEKA_MFG, 1)
+                await asyncio.wait_for(first, 1)
+
+                # consumer is not reading so only the 2 newest are kept
+                _feed_from_thread(service, MakeMopekaPacket(BLE_MOPEKA_MAC, raw_level=1), 5)
+                await asyncio.sleep(0.01)  # deliver the callbacks
+                await readings.aclose()
+                return service.DroppedCount
+
+        self.assertEqual(asyncio.run(run()), 3)
+
+    def test_next_discovery(self):
+        b = bytearray(BLE_MOPEKA_MFG[:])
+        b[16] = b[16] | 0x80  # press sync button
+
+        async def run():
+            async with AsyncMopekaService() as service:
+                service.DoSensorDiscovery()
+                waiter = asyncio.ensure_future(service.next_discovery(1))
+                await asyncio.sleep(0)
+                _feed_from_thread(service, bytes(b))
+                return await waiter
+
+        sensor = asyncio.run(run())
+        self.assertEqual(sensor._mac, BLE_MOPEKA_MAC)
+
+    def test_next_discovery_timeout(self):
+        async def run():
+            async with AsyncMopekaService() as service:
+                service.DoSensorDiscovery()
+                return await service.next_discovery(0.01)
+
+        self.assertIsNone(asyncio.run(run()))
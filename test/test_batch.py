@@ -0,0 +1,81 @@
+"""Vectorized batch decoder test
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import unittest
+import logging
+from mopeka_pro_check.advertisement import MopekaAdvertisement
+
+try:
+    import numpy as np
+    from mopeka_pro_check.batch import MopekaAdvertisementBatch
+except ImportError:
+    np = None
+
+
+BLE_MOPEKA_MFG = bytes.fromhex(
+    "01 00 01 76 3C C4 05 9D E7 12  0D  FF  59  00  03  5D  31  2C  C1  C4  3C  76  3B  F9  03  02  E5  FE  A0")
+BLE_NOT_MOPEKA_MFG_ID = bytes.fromhex(
+    "01 00 01 76 3C C4 05 9D E7 12  0D  FF  04  00  03  5D  31  2C  C1  C4  3C  76  3B  F9  03  02  E5  FE  A0")
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _packets():
+    """ Known good packet with every temperature, battery and button value
+    and a spread of tank levels and quality stars """
+    b = bytearray(BLE_MOPEKA_MFG[:])
+    for value in range(256):
+        for level in range(0, 0x10000, 0x1F3):
+            b[15] = value
+            b[16] = value ^ 0x55
+            b[17] = level & 0xFF
+            b[18] = level >> 8
+            yield bytes(b)
+
+
+@unittest.skipIf(np is None, "numpy not installed")
+class MopekaAdvertisementBatchTest(unittest.TestCase):
+
+    FIELDS = (
+        "SyncButtonPressed", "ReadingQualityStars", "BatteryVoltage", "BatteryPercent",
+        "TemperatureInCelsius", "TemperatureInFahrenheit", "TankLevelInMM", "TankLevelInInches",
+    )
+
+    def test_matches_scalar_properties(self):
+        packets = list(_packets())
+        batch = MopekaAdvertisementBatch(b"".join(p[11:24] for p in packets))
+        self.assertEqual(len(batch), len(packets))
+        self.assertTrue(batch.valid.all())
+
+        advertisements = [MopekaAdvertisement(p) for p in packets]
+        for field in self.FIELDS:
+            column = getattr(batch, field).tolist()
+            expected = [getattr(ma, field) for ma in advertisements]
+            self.assertEqual(column, expected, field)
+
+    def test_array_input(self):
+        payloads = np.frombuffer(BLE_MOPEKA_MFG[11:24] * 4, dtype=np.uint8).reshape(4, 13)
+        batch = MopekaAdvertisementBatch(payloads)
+        self.assertEqual(batch.TankLevelInMM.tolist(), [126] * 4)
+
+    def test_invalid_payload_flagged(self):
+        batch = MopekaAdvertisementBatch(BLE_MOPEKA_MFG[11:24] + BLE_NOT_MOPEKA_MFG_ID[11:24])
+        self.assertEqual(batch.valid.tolist(), [True, False])
+
+    def test_bad_buffer_size(self):
+        with self.assertRaises(ValueError):
+            MopekaAdvertisementBatch(BLE_MOPEKA_MFG[11:23])
+
+    def test_hardware_profiles(self):
+        payloads = b""
+        for hardware_id in (0x3, 0x4, 0x5, 0x7F):
+            b = bytearray(BLE_MOPEKA_MFG[11:24])
+            b[3] = hardware_id
+            payloads += bytes(b)
+        batch = MopekaAdvertisementBatch(payloads)
+        self.assertEqual(batch.valid.tolist(), [True, True, True, False])
+        self.assertEqual(batch.TankLevelInMM.tolist(), [126, 50, 216, 0])
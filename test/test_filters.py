@@ -0,0 +1,132 @@
+"""Tank level filter test
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import unittest
+import logging
+from types import SimpleNamespace
+from mopeka_pro_check.filters import FilterMode, LevelFilter
+from mopeka_pro_check.replay import MakeMopekaPacket
+from mopeka_pro_check.service import MopekaService
+from mopeka_pro_check.sensor import MopekaSensor
+
+_LOGGER = logging.getLogger(__name__)
+
+REST = (0x3B, 0xF9)
+
+
+class LevelFilterTest(unittest.TestCase):
+
+    def _feed(self, f, levels, quality=3, accel=REST):
+        return [f.Update(level, quality, *accel) for level in levels]
+
+    def test_median(self):
+        f = LevelFilter(window=5, hampel_sigma=None)
+        self._feed(f, [100, 102, 500, 101, 99])
+        self.assertEqual(f.Value, 101)
+        self.assertEqual(f.LastRaw, 99)
+
+    def test_quality_weighted_median(self):
+        f = LevelFilter(window=3, hampel_sigma=None)
+        f.Update(100, 3, *REST)
+        f.Update(200, 1, *REST)
+        f.Update(300, 1, *REST)
+        # 100 counts three times so it is the middle of 5
+        self.assertEqual(f.Value, 100)
+        f.Update(300, 1, *REST)
+        self.assertEqual(f.Value, 300)
+
+    def test_window_wraps(self):
+        f = LevelFilter(window=3, hampel_sigma=None)
+        self._feed(f, range(100, 200))
+        self.assertEqual(f.Value, 198)
+        self.assertEqual(len(f._sorted), 9)
+
+    def test_min_quality(self):
+        f = LevelFilter(min_quality=2)
+        self.assertEqual(self._feed(f, [100], quality=1), [False])
+        self.assertEqual(f.RejectedQuality, 1)
+        self.assertIsNone(f.Value)
+
+    def test_hampel_ewma(self):
+        f = LevelFilter(FilterMode.EWMA, alpha=0.5)
+        self._feed(f, [100, 101, 99, 100, 100])
+        value = f.Value
+        f.Update(400, 3, *REST)
+        self.assertEqual(f.Outliers, 1)
+        self.assertAlmostEqual(f.Value, value, delta=1)
+
+    def test_step_passes(self):
+        f = LevelFilter(FilterMode.EWMA, window=5, alpha=1.0)
+        self._feed(f, [100] * 10 + [200] * 6)
+        self.assertEqual(f.Value, 200)
+
+    def test_ewma_quality(self):
+        f = LevelFilter(FilterMode.EWMA, alpha=0.6, hampel_sigma=None)
+        f.Update(100, 3, *REST)
+        f.Update(200, 1, *REST)
+        self.assertAlmostEqual(f.Value, 120)
+
+    def test_tilt_rejected(self):
+        f = LevelFilter(tilt_threshold=6, settle_readings=3)
+        self._feed(f, [100] * 3)
+        moved = (0x3B + 20, 0xF9)
+        self.assertEqual(self._feed(f, [150, 160], accel=moved), [False, False])
+        self.assertEqual(f.RejectedTilt, 2)
+        # back at rest
+        self.assertEqual(self._feed(f, [100]), [True])
+        self.assertEqual(f.Value, 100)
+
+    def test_new_resting_position(self):
+        f = LevelFilter(tilt_threshold=6, settle_readings=3)
+        self._feed(f, [100] * 3)
+        moved = (0x3B, 0xF9 - 30)
+        results = self._feed(f, [150] * 5, accel=moved)
+        self.assertEqual(results, [False, False, False, True, True])
+        self.assertEqual(f.Value, 150)
+
+    def test_signed_accel(self):
+        f = LevelFilter(tilt_threshold=6)
+        f.Update(100, 3, 0xFE, 0x00)
+        # -2 to 2 is a small move, not 254 to 2
+        self.assertTrue(f.Update(100, 3, 0x02, 0x00))
+
+    def test_reset(self):
+        f = LevelFilter()
+        self._feed(f, [100] * 3)
+        f.Reset()
+        self.assertIsNone(f.Value)
+        self._feed(f, [50])
+        self.assertEqual(f.Value, 50)
+
+
+class ServiceFilterTest(unittest.TestCase):
+
+    def test_raw_and_filtered(self):
+        service = MopekaService()
+        sensor = MopekaSensor("E7:9D:05:C4:3C:76")
+        sensor.Filter = LevelFilter(window=5)
+        service.AddSensorToMonitor(sensor)
+        self.assertIsNone(sensor.FilteredLevelInMM)
+        for level in (300, 302, 299, 900, 301):
+            service.ProcessAdvertisementPacket(SimpleNamespace(data=MakeMopekaPacket(sensor._mac, raw_level=level)))
+        reading = sensor.GetReading()
+        self.assertEqual(sensor.Filter.LastRaw, reading.TankLevelInMM)
+        self.assertLess(abs(sensor.FilteredLevelInMM - sensor.TankLevelInMM(reading)), 5)
+        tilted = MakeMopekaPacket(sensor._mac, raw_level=1200, x_accel=-40)
+        service.ProcessAdvertisementPacket(SimpleNamespace(data=tilted))
+        self.assertEqual(sensor.Filter.RejectedTilt, 1)
+        # the reading is still delivered raw
+        self.assertEqual(sensor.GetReading()._raw_tank_level, 1200)
+
+    def test_disabled_by_default(self):
+        sensor = MopekaSensor("E7:9D:05:C4:3C:76")
+        self.assertIsNone(sensor.Filter)
+        self.assertIsNone(sensor.FilteredLevelInMM)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+"""Consumption forecast test
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import unittest
+import logging
+import random
+import threading
+from types import SimpleNamespace
+from mopeka_pro_check.forecast import ConsumptionForecast, ForecastIndex, PROPANE_THERMAL_EXPANSION
+from mopeka_pro_check.profiles import WATER
+from mopeka_pro_check.replay import MakeMopekaPacket
+from mopeka_pro_check.service import MopekaService
+from mopeka_pro_check.sensor import MopekaSensor
+
+_LOGGER = logging.getLogger(__name__)
+
+HOUR = 3600.0
+
+
+def _feed(forecast, start_mm, rate_mm_per_hour, hours, noise=0.0, temperature=15, seed=1):
+    rng = random.Random(seed)
+    for i in range(int(hours * 60)):
+        t = i * 60.0
+        level = start_mm - rate_mm_per_hour * t / HOUR + rng.gauss(0, noise)
+        forecast.Update(level, temperature, 3, t)
+    return t
+
+
+class ConsumptionForecastTest(unittest.TestCase):
+
+    def test_empty(self):
+        f = ConsumptionForecast()
+        self.assertIsNone(f.LevelInMM)
+        self.assertIsNone(f.UsageRate)
+        self.assertIsNone(f.EmptyAt)
+
+    def test_steady_usage(self):
+        f = ConsumptionForecast(thermal_expansion=0)
+        t = _feed(f, 300, 10, 12, noise=2.0)
+        self.assertAlmostEqual(f.UsageRate, 10, delta=1.0)
+        self.assertAlmostEqual(f.LevelInMM, 300 - 10 * t / HOUR, delta=3)
+        # about 18 hours left
+        self.assertAlmostEqual((f.EmptyAt - t) / HOUR, 18, delta=2.5)
+        self.assertAlmostEqual(f.SecondsToLevel(f.LevelInMM + 5), 0.0)
+
+    def test_threshold(self):
+        f = ConsumptionForecast(threshold_mm=100, thermal_expansion=0)
+        t = _feed(f, 300, 10, 12)
+        self.assertAlmostEqual((f.EmptyAt - t) / HOUR, 8, delta=0.5)
+
+    def test_not_falling(self):
+        f = ConsumptionForecast(thermal_expansion=0)
+        _feed(f, 300, 0, 6, noise=2.0)
+        self.assertLess(abs(f.UsageRate), 1.0)
+
+    def test_temperature_compensation(self):
+        # same fuel reads higher when warm.  a 20C swing is not usage
+        f = ConsumptionForecast(thermal_expansion=PROPANE_THERMAL_EXPANSION)
+        for i in range(12 * 60):
+            temperature = 5 + 20 * i / (12 * 60)
+            level = 300 * (1 + PROPANE_THERMAL_EXPANSION * (temperature - 15))
+            f.Update(level, temperature, 3, i * 60.0)
+        self.assertAlmostEqual(f.LevelInMM, 300, delta=0.5)
+        self.assertLess(abs(f.UsageRate), 0.2)
+
+    def test_outlier_ignored(self):
+        f = ConsumptionForecast(thermal_expansion=0)
+        t = _feed(f, 300, 10, 2)
+        level = f.LevelInMM
+        f.Update(50, 15, 3, t + 60)
+        self.assertEqual(f.Refills, 0)
+        self.assertLess(abs(f.LevelInMM - level), 1)
+        f.Update(level - 10 / 60, 15, 3, t + 120)
+        self.assertAlmostEqual(f.UsageRate, 10, delta=1.0)
+
+    def test_zero_quality_ignored(self):
+        f = ConsumptionForecast(thermal_expansion=0)
+        f.Update(300, 15, 0, 0.0)
+        self.assertEqual(f.Count, 0)
+
+    def test_refill(self):
+        f = ConsumptionForecast(thermal_expansion=0)
+        t = _feed(f, 200, 10, 6)
+        results = [f.Update(350, 15, 3, t + 60 * (i + 1)) for i in range(3)]
+        self.assertEqual(results, [False, False, True])
+        self.assertEqual(f.Refills, 1)
+        self.assertEqual(f.LastRefill, t + 180)
+        self.assertAlmostEqual(f.LevelInMM, 350)
+        # usage pattern carries over
+        self.assertGreater(f.UsageRate, 5)
+
+    def test_drop_is_not_refill(self):
+        f = ConsumptionForecast(thermal_expansion=0)
+        t = _feed(f, 300, 10, 2)
+        results = [f.Update(100, 15, 3, t + 60 * (i + 1)) for i in range(3)]
+        self.assertEqual(results, [False, False, False])
+        self.assertEqual(f.Refills, 0)
+        self.assertAlmostEqual(f.LevelInMM, 100)
+
+
+class ForecastIndexTest(unittest.TestCase):
+
+    def test_soonest(self):
+        index = ForecastIndex()
+        for key, empty_at in (("a", 50.0), ("b", 10.0), ("c", 30.0), ("d", None)):
+            index.Update(key, empty_at)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.Soonest(2), [(10.0, "b"), (30.0, "c")])
+        # repeated queries return the same thing
+        self.assertEqual(index.Soonest(2), [(10.0, "b"), (30.0, "c")])
+
+    def test_update_and_remove(self):
+        index = ForecastIndex()
+        index.Update("a", 50.0)
+        index.Update("b", 10.0)
+        index.Update("b", 90.0)
+        self.assertEqual(index.Soonest(5), [(50.0, "a"), (90.0, "b")])
+        index.Update("a", None)
+        index.Remove("b")
+        self.assertEqual(index.Soonest(5), [])
+
+    def test_heap_bounded(self):
+        index = ForecastIndex()
+        for i in range(10000):
+            index.Update(i % 10, float(i))
+        self.assertLess(len(index._heap), 100)
+        self.assertEqual([k for _, k in index.Soonest(3)], [0, 1, 2])
+
+
+def _packet(mac: str, level: int):
+    return SimpleNamespace(data=MakeMopekaPacket(mac, raw_level=level, quality=3))
+
+
+class ServiceForecastTest(unittest.TestCase):
+
+    def setUp(self):
+        self.service = MopekaService()
+        self.macs = ["E7:9D:05:C4:3C:%02X" % i for i in range(4)]
+        self.sensors = [MopekaSensor(m) for m in self.macs]
+        self.service.AddSensorsToMonitor(self.sensors)
+        self.now = [0.0]
+        self.service.Clock = lambda: self.now[0]
+
+    def _run(self, minutes, rates, start=2000):
+        for m in range(minutes):
+            self.now[0] = m * 60.0
+            for mac, rate in zip(self.macs, rates):
+                self.service.ProcessAdvertisementPacket(_packet(mac, int(start - rate * m)))
+
+    def test_soonest_empty(self):
+        # raw level units per minute.  last sensor is not used
+        self._run(120, (1, 4, 2, 0))
+        soonest = self.service.GetSoonestEmpty(2)
+        self.assertEqual([s._mac for _, s in soonest], [self.macs[1], self.macs[2]])
+        self.assertLess(soonest[0][0], soonest[1][0])
+        self.service.RemoveSensorToMonitor(self.sensors[1])
+        self.assertEqual(self.service.GetSoonestEmpty(1)[0][1], self.sensors[2])
+
+    def test_refill_callback(self):
+        refilled = []
+        self.service.AddRefillCallback(refilled.append)
+        self._run(60, (2, 0, 0, 0), start=1000)
+        for m in range(60, 65):
+            self.now[0] = m * 60.0
+            self.service.ProcessAdvertisementPacket(_packet(self.macs[0], 3000 + m))
+        self.assertEqual(refilled, [self.sensors[0]])
+
+    def test_callbacks_can_query(self):
+        seen = []
+        self.service.AddReadingCallback(lambda sensor, reading: seen.append(self.service.GetSoonestEmpty(1)))
+        self.service.AddRefillCallback(lambda sensor: self.service.RemoveSensorToMonitor(sensor))
+        # a deadlock would hang the scanning thread, not the test
+        t = threading.Thread(target=self._run, args=(10, (2, 0, 0, 0)), daemon=True)
+        t.start()
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        # repeated payloads of the idle sensors are not readings
+        self.assertEqual(len(seen), 13)
+        for m in range(10, 15):
+            self.now[0] = m * 60.0
+            t = threading.Thread(target=self.service.ProcessAdvertisementPacket, args=(_packet(self.macs[0], 3000 + m),), daemon=True)
+            t.start()
+            t.join(5)
+            self.assertFalse(t.is_alive())
+        self.assertNotIn(self.sensors[0], self.service.SensorMonitoredList.values())
+
+    def test_profile_expansion(self):
+        sensor = MopekaSensor(self.macs[0], profile=WATER)
+        sensor._update_forecast(_reading(self.macs[0]), 0.0)
+        self.assertEqual(sensor.Forecast.ThermalExpansion, WATER.ThermalExpansion)
+
+
+def _reading(mac):
+    service = MopekaService()
+    sensor = MopekaSensor(mac)
+    service.AddSensorToMonitor(sensor)
+    service.ProcessAdvertisementPacket(_packet(mac, 500))
+    return sensor.GetReading()
+
+
+if __name__ == '__main__':
+    unittest.main()
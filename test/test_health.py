@@ -0,0 +1,98 @@
+"""Sensor health statistics test
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import unittest
+import logging
+from types import SimpleNamespace
+from mopeka_pro_check.health import SensorHealth, WorstSensors
+from mopeka_pro_check.replay import MakeMopekaPacket
+from mopeka_pro_check.service import MopekaService
+from mopeka_pro_check.sensor import MopekaSensor
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class SensorHealthTest(unittest.TestCase):
+
+    def test_empty(self):
+        h = SensorHealth()
+        self.assertEqual(h.Count, 0)
+        self.assertIsNone(h.MeanQuality)
+        self.assertEqual(h.LossRatio, 0.0)
+        self.assertEqual(h.Score(), 0.0)
+
+    def test_steady(self):
+        h = SensorHealth(expected_interval=1.0, alpha=0.5)
+        for i in range(10):
+            h.Update(-70, 3, float(i))
+        self.assertEqual(h.Count, 10)
+        self.assertEqual(h.RssiEwma, -70)
+        self.assertEqual(h.IntervalEwma, 1.0)
+        self.assertEqual(h.Jitter, 0.0)
+        self.assertEqual(h.Missed, 0)
+        self.assertEqual(h.QualityCounts, [0, 0, 0, 10])
+        self.assertAlmostEqual(h.Score(), 100.0 * (0.4 + 0.3 + 0.3 * 0.75))
+
+    def test_missed_and_jitter(self):
+        h = SensorHealth(expected_interval=1.0, alpha=0.5)
+        for t in (0.0, 1.0, 4.0, 5.0):
+            h.Update(-80, 1, t)
+        # 3 second gap is 2 missed advertisements
+        self.assertEqual(h.Missed, 2)
+        self.assertAlmostEqual(h.LossRatio, 2 / 6)
+        self.assertGreater(h.Jitter, 0.0)
+        self.assertEqual(h.MeanQuality, 1.0)
+
+    def test_copy_from_other_adapter_ignored(self):
+        h = SensorHealth(expected_interval=1.0)
+        h.Update(-70, 3, 1.0)
+        h.Update(-60, 3, 1.01)
+        self.assertEqual(h.Count, 1)
+        self.assertEqual(h.RssiEwma, -70)
+
+    def test_rssi_not_available(self):
+        h = SensorHealth()
+        h.Update(None, 2, 1.0)
+        self.assertIsNone(h.RssiEwma)
+        self.assertEqual(h.Count, 1)
+
+    def test_snapshot(self):
+        h = SensorHealth()
+        h.Update(-70, 3, 1.0)
+        snap = h.Snapshot()
+        self.assertEqual(snap["count"], 1)
+        self.assertEqual(snap["quality"], [0, 0, 0, 1])
+
+
+class WorstSensorsTest(unittest.TestCase):
+
+    def test_ranking(self):
+        sensors = []
+        for i, rssi in enumerate((-60, -95, -75)):
+            s = SimpleNamespace(Health=SensorHealth())
+            s.Health.Update(rssi, 3, 0.0)
+            s.name = i
+            sensors.append(s)
+        sensors.append(SimpleNamespace(Health=None, name="disabled"))
+        worst = WorstSensors(sensors, 2)
+        self.assertEqual([s.name for _, s in worst], [1, 2])
+
+    def test_service_tracks_duplicates(self):
+        service = MopekaService()
+        macs = ["E7:9D:05:C4:3C:%02X" % i for i in range(3)]
+        service.AddSensorsToMonitor(MopekaSensor(m) for m in macs)
+        now = [0.0]
+        service.Clock = lambda: now[0]
+        for t in range(5):
+            now[0] = float(t)
+            service.ProcessAdvertisementPacket(SimpleNamespace(data=MakeMopekaPacket(macs[0], rssi=-60)))
+            service.ProcessAdvertisementPacket(SimpleNamespace(data=MakeMopekaPacket(macs[1], rssi=-90, quality=1)))
+        sensor = next(s for s in service.SensorMonitoredList.values() if s._mac == macs[0])
+        self.assertEqual(sensor.Health.Count, 5)
+        self.assertEqual(service.ServiceStats._duplicate_ad_count, 8)
+        ranked = [s._mac for _, s in service.GetWorstSensors(3)]
+        self.assertEqual(ranked, [macs[2], macs[1], macs[0]])
@@ -0,0 +1,104 @@
+"""Sensor reading history ring buffer test
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import unittest
+import logging
+from types import SimpleNamespace
+from mopeka_pro_check.advertisement import MopekaAdvertisement
+from mopeka_pro_check.history import ReadingHistory
+from mopeka_pro_check.sensor import MopekaSensor
+from mopeka_pro_check.service import MopekaService
+
+
+BLE_MOPEKA_MFG = bytes.fromhex(
+    "01 00 01 76 3C C4 05 9D E7 12  0D  FF  59  00  03  5D  31  2C  C1  C4  3C  76  3B  F9  03  02  E5  FE  A0")
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _advertisement(raw_level: int) -> MopekaAdvertisement:
+    b = bytearray(BLE_MOPEKA_MFG[:])
+    b[17] = raw_level & 0xFF
+    b[18] = (b[18] & 0xC0) | (raw_level >> 8)
+    return MopekaAdvertisement(b)
+
+
+class ReadingHistoryTest(unittest.TestCase):
+
+    def test_empty(self):
+        h = ReadingHistory(4)
+        self.assertEqual(len(h), 0)
+        self.assertIsNone(h.Latest())
+        self.assertEqual(h.GetLast(3), [])
+        self.assertIsNone(h.LevelStats())
+
+    def test_invalid_capacity(self):
+        with self.assertRaises(ValueError):
+            ReadingHistory(0)
+
+    def test_decoded_fields(self):
+        h = ReadingHistory(4)
+        ma = MopekaAdvertisement(BLE_MOPEKA_MFG)
+        h.Append(ma, 1.5)
+        r = h.Latest()
+        self.assertEqual(r.timestamp, 1.5)
+        self.assertEqual(r.rssi, ma.rssi)
+        self.assertEqual(r.TankLevelInMM, ma.TankLevelInMM)
+        self.assertEqual(r.TemperatureInCelsius, ma.TemperatureInCelsius)
+        self.assertEqual(r.BatteryVoltage, ma.BatteryVoltage)
+        self.assertEqual(r.ReadingQualityStars, ma.ReadingQualityStars)
+
+    def test_rssi_not_available(self):
+        # 0x7F is "rssi not available" and decodes to None
+        data = BLE_MOPEKA_MFG[:-1] + b"\x7f"
+        h = ReadingHistory(4)
+        h.Append(MopekaAdvertisement(data), 1.0)
+        h.Append(MopekaAdvertisement(BLE_MOPEKA_MFG), 2.0)
+        self.assertEqual([r.rssi for r in h.GetLast(2)], [None, MopekaAdvertisement(BLE_MOPEKA_MFG).rssi])
+
+        service = MopekaService()
+        sensor = MopekaSensor("E7:9D:05:C4:3C:76")
+        service.AddSensorToMonitor(sensor)
+        service.ProcessAdvertisementPacket(SimpleNamespace(data=data))
+        self.assertIsNone(sensor.History.Latest().rssi)
+
+    def test_wrap_keeps_most_recent(self):
+        h = ReadingHistory(4)
+        for t in range(10):
+            h.Append(_advertisement(100 * (t + 1)), float(t))
+        self.assertEqual(len(h), 4)
+        self.assertEqual([r.timestamp for r in h.GetLast(10)], [6.0, 7.0, 8.0, 9.0])
+        self.assertEqual([r.timestamp for r in h.GetLast(2)], [8.0, 9.0])
+        self.assertEqual(h.Latest().timestamp, 9.0)
+
+    def test_get_since(self):
+        h = ReadingHistory(5)
+        for t in range(8):
+            h.Append(_advertisement(100), float(t))
+        self.assertEqual([r.timestamp for r in h.GetSince(5.5)], [6.0, 7.0])
+        self.assertEqual([r.timestamp for r in h.GetSince(6.0)], [6.0, 7.0])
+        self.assertEqual(len(h.GetSince(0.0)), 5)
+        self.assertEqual(h.GetSince(8.0), [])
+
+    def test_level_stats(self):
+        h = ReadingHistory(8)
+        levels = []
+        for t, raw in enumerate((100, 300, 200, 400)):
+            ma = _advertisement(raw)
+            levels.append(ma.TankLevelInMM)
+            h.Append(ma, float(t))
+        self.assertEqual(h.LevelStats(), (min(levels), max(levels), sum(levels) / 4))
+        self.assertEqual(h.LevelStats(n=2), (min(levels[2:]), max(levels[2:]), sum(levels[2:]) / 2))
+        self.assertEqual(h.LevelStats(since=3.0), (levels[3], levels[3], levels[3]))
+        self.assertIsNone(h.LevelStats(since=10.0))
+
+    def test_queries_do_not_clear(self):
+        h = ReadingHistory(4)
+        h.Append(_advertisement(100), 0.0)
+        h.GetLast(1)
+        h.LevelStats()
+        self.assertEqual(len(h), 1)
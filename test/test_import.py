@@ -0,0 +1,60 @@
+"""Import time test
+
+Short lived tools import the package thousands of times a day.  Parsing
+must not pull in bleson and imports must stay within a time budget.
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import unittest
+import subprocess
+import sys
+import os
+
+IMPORT_TIME_BUDGET = 0.25
+""" seconds for importing the service in a fresh interpreter (best of 3) """
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(elapsed, any(m == "bleson" or m.startswith("bleson.") for m in sys.modules))
+"""
+
+
+def _import(module: str):
+    out = subprocess.run(
+        [sys.executable, "-c", _SCRIPT.format(module=module)],
+        cwd=_ROOT, check=True, capture_output=True, text=True).stdout.split()
+    return float(out[0]), out[1] == "True"
+
+
+class ImportTest(unittest.TestCase):
+
+    def test_parser_without_bleson(self):
+        for module in (
+            "mopeka_pro_check",
+            "mopeka_pro_check.advertisement",
+            "mopeka_pro_check.sensor",
+            "mopeka_pro_check.service",
+            "mopeka_pro_check.replay",
+            "mopeka_pro_check.storage",
+        ):
+            _elapsed, bleson = _import(module)
+            self.assertFalse(bleson, f"{module} imports bleson")
+
+    def test_import_time_budget(self):
+        best = min(_import("mopeka_pro_check.service")[0] for _ in range(3))
+        self.assertLess(best, IMPORT_TIME_BUDGET)
+
+    def test_bdaddress_on_demand(self):
+        from mopeka_pro_check.sensor import MopekaSensor
+        from bleson import BDAddress
+        sensor = MopekaSensor("E7:9D:05:C4:3C:76")
+        self.assertEqual(sensor._bdaddress, BDAddress("E7:9D:05:C4:3C:76"))
+        self.assertIs(sensor._bdaddress, sensor._bdaddress)
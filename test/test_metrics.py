@@ -0,0 +1,95 @@
+"""Service metrics test
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import unittest
+import logging
+from mopeka_pro_check.metrics import LatencyHistogram, RateWindow
+from mopeka_pro_check.replay import ReplayPacket
+from mopeka_pro_check.service import MopekaService
+from mopeka_pro_check.sensor import MopekaSensor
+
+
+BLE_MOPEKA_MFG = bytes.fromhex(
+    "01 00 01 76 3C C4 05 9D E7 12  0D  FF  59  00  03  5D  31  2C  C1  C4  3C  76  3B  F9  03  02  E5  FE  A0")
+BLE_MOPEKA_MAC = "E7:9D:05:C4:3C:76"
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class LatencyHistogramTest(unittest.TestCase):
+
+    def test_buckets(self):
+        h = LatencyHistogram()
+        for ns in (1, 1000, 1000, 10 ** 9):
+            h.Observe(ns)
+        buckets = h.Buckets()
+        self.assertEqual(h.count, 4)
+        self.assertEqual(buckets[-1], (float("inf"), 4))
+        self.assertEqual(dict(buckets)[1024 / 1e9], 3)
+        self.assertEqual(h.Percentile(50), 1024 / 1e9)
+
+    def test_empty_percentile(self):
+        self.assertIsNone(LatencyHistogram().Percentile(50))
+
+
+class RateWindowTest(unittest.TestCase):
+
+    def test_rates(self):
+        r = RateWindow(windows=(10.0, 60.0))
+        for second in range(0, 121):
+            r.Sample(second * 100, now=float(second))
+        rates = r.Rates(120 * 100, now=120.0)
+        self.assertAlmostEqual(rates[10.0], 100.0)
+        self.assertAlmostEqual(rates[60.0], 100.0)
+
+    def test_no_samples(self):
+        self.assertEqual(RateWindow(windows=(10.0,)).Rates(0, now=5.0), {10.0: 0.0})
+
+
+class ServiceMetricsTest(unittest.TestCase):
+
+    def _service(self):
+        service = MopekaService()
+        service.AddSensorToMonitor(MopekaSensor(BLE_MOPEKA_MAC))
+        return service
+
+    def test_reading_and_latency(self):
+        service = self._service()
+        service.ProcessAdvertisementPacket(ReplayPacket(BLE_MOPEKA_MFG))
+        snapshot = service.GetMetricsSnapshot()
+        self.assertEqual(snapshot["packets"], 1)
+        self.assertEqual(snapshot["sensor_readings"], {BLE_MOPEKA_MAC: 1})
+        self.assertEqual(snapshot["parse_latency"]["count"], 1)
+        self.assertEqual(snapshot["ads"]["processed"], 1)
+
+    def test_filtered_parse_error_counted_as_error(self):
+        service = self._service()
+        b = bytearray(BLE_MOPEKA_MFG[:])
+        b[10] = 4  # change size of mfg data packet
+        service.ProcessAdvertisementPacket(ReplayPacket(bytes(b)))
+        self.assertEqual(service.ServiceStats._error_ad_count, 1)
+        self.assertEqual(service.ServiceStats._ignored_ad_count, 0)
+        snapshot = service.GetMetricsSnapshot()
+        self.assertEqual(snapshot["errors"], {"UNSUPPORTED_LENGTH": 1})
+        self.assertEqual(snapshot["sensor_errors"], {BLE_MOPEKA_MAC: 1})
+
+    def test_prometheus(self):
+        service = self._service()
+        service.ProcessAdvertisementPacket(ReplayPacket(BLE_MOPEKA_MFG))
+        text = service.GetMetricsPrometheus()
+        self.assertIn("# TYPE mopeka_parse_latency_seconds histogram", text)
+        self.assertIn('mopeka_parse_latency_seconds_bucket{le="+Inf"} 1', text)
+        self.assertIn('mopeka_sensor_readings_total{mac="%s"} 1' % BLE_MOPEKA_MAC, text)
+        self.assertIn('mopeka_ads_total{result="processed"} 1', text)
+
+    def test_disabled(self):
+        service = self._service()
+        service.EnableMetrics(False)
+        service.ProcessAdvertisementPacket(ReplayPacket(BLE_MOPEKA_MFG))
+        self.assertEqual(service.GetMetricsSnapshot(), {})
+        self.assertEqual(service.GetMetricsPrometheus(), "")
+        self.assertEqual(service.ServiceStats._processed_ad_count, 1)
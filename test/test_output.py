@@ -0,0 +1,165 @@
+"""Streaming reading output and command line gateway test
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import unittest
+import logging
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+from mopeka_pro_check.advertisement import MopekaAdvertisement
+from mopeka_pro_check.cli import main
+from mopeka_pro_check.output import ReadingWriter, CSV_FIELDS
+from mopeka_pro_check.replay import CaptureWriter, MakeMopekaPacket
+from mopeka_pro_check.sensor import MopekaSensor
+
+_LOGGER = logging.getLogger(__name__)
+
+MACS = ["E7:9D:05:C4:3C:%02X" % i for i in range(3)]
+
+
+def _reading(mac: str = MACS[0], level: int = 0x12C, button: bool = False):
+    return MopekaAdvertisement(MakeMopekaPacket(mac, raw_level=level, button=button))
+
+
+class ReadingWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "readings.log")
+        self.sensor = MopekaSensor(MACS[0])
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_ndjson(self):
+        stream = io.StringIO()
+        with ReadingWriter(stream=stream, clock=lambda: 12.5) as writer:
+            writer.OnReading(self.sensor, _reading(level=0x12C))
+            self.assertTrue(writer.Flush())
+        line = json.loads(stream.getvalue())
+        self.assertEqual(line["timestamp"], 12.5)
+        self.assertEqual(line["mac"], MACS[0])
+        self.assertEqual(line["level_mm"], self.sensor.TankLevelInMM(_reading(level=0x12C)))
+        self.assertEqual(line["quality"], 3)
+        self.assertEqual(line["rssi"], -96)
+        self.assertFalse(line["sync_button"])
+
+    def test_csv_header_once(self):
+        for _ in range(2):
+            with ReadingWriter(self.path, "csv") as writer:
+                writer.OnReading(self.sensor, _reading())
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], ",".join(CSV_FIELDS))
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[1].split(",")[1], MACS[0])
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            ReadingWriter(stream=io.StringIO(), fmt="xml")
+
+    def test_rotation(self):
+        with ReadingWriter(self.path, "csv", max_bytes=400, backup_count=2) as writer:
+            for i in range(30):
+                writer.OnReading(self.sensor, _reading(level=i))
+        self.assertTrue(os.path.exists(self.path + ".1"))
+        self.assertTrue(os.path.exists(self.path + ".2"))
+        self.assertFalse(os.path.exists(self.path + ".3"))
+        for path in (self.path, self.path + ".1", self.path + ".2"):
+            with open(path) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(lines[0], ",".join(CSV_FIELDS))
+            self.assertLessEqual(os.path.getsize(path), 400)
+        self.assertEqual(writer.WrittenCount, 30)
+
+    def test_drops_when_full(self):
+        stream = io.StringIO()
+        writer = ReadingWriter(stream=stream, flush_interval=60, queue_size=5)
+        for _ in range(8):
+            writer.OnReading(self.sensor, _reading())
+        self.assertEqual(writer.DroppedCount, 3)
+        writer.Close()
+        self.assertEqual(writer.WrittenCount, 5)
+        self.assertEqual(len(stream.getvalue().splitlines()), 5)
+
+    def test_block_when_full(self):
+        stream = io.StringIO()
+        with ReadingWriter(stream=stream, flush_interval=60, queue_size=5, block=True) as writer:
+            for _ in range(12):
+                writer.OnReading(self.sensor, _reading())
+        self.assertEqual(writer.DroppedCount, 0)
+        self.assertEqual(len(stream.getvalue().splitlines()), 12)
+
+    def test_flush_from_other_threads(self):
+        stream = io.StringIO()
+        writer = ReadingWriter(stream=stream, flush_interval=60)
+
+        def produce():
+            for _ in range(100):
+                writer.OnReading(self.sensor, _reading())
+        threads = [threading.Thread(target=produce) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertTrue(writer.Flush())
+        self.assertEqual(len(stream.getvalue().splitlines()), 400)
+        writer.Close()
+
+
+class CommandLineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.capture = os.path.join(self.dir, "capture.bin")
+        self.output = os.path.join(self.dir, "out.log")
+        records = []
+        for i in range(10):
+            for j, mac in enumerate(MACS):
+                records.append((1000.0 + i * 2 + j * 0.1, MakeMopekaPacket(mac, raw_level=200 + i, button=(i == 5 and j == 1))))
+        records.append((1030.0, bytes.fromhex("01 00 01 3b 69 19 46 88 c0 04 03 02 01 02 a0")))
+        with open(self.capture, "wb") as f:
+            CaptureWriter(f).WriteAll(records)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _lines(self):
+        with open(self.output) as f:
+            return f.read().splitlines()
+
+    def test_replay_ndjson(self):
+        self.assertEqual(main(["replay", self.capture, "-o", self.output]), 0)
+        lines = [json.loads(line) for line in self._lines()]
+        self.assertEqual(len(lines), 30)
+        self.assertEqual([line["mac"] for line in lines[:3]], MACS)
+        # stamped with the capture time
+        self.assertEqual(lines[0]["timestamp"], 1000.0)
+        self.assertEqual(lines[-1]["timestamp"], 1018.2)
+
+    def test_replay_mac_filter_csv(self):
+        self.assertEqual(main(["replay", self.capture, "-o", self.output, "-f", "csv", "-m", MACS[2]]), 0)
+        lines = self._lines()
+        self.assertEqual(lines[0], ",".join(CSV_FIELDS))
+        self.assertEqual({line.split(",")[1] for line in lines[1:]}, {MACS[2]})
+        self.assertEqual(len(lines), 11)
+
+    def test_replay_discover(self):
+        self.assertEqual(main(["replay", self.capture, "-o", self.output, "--discover"]), 0)
+        lines = [json.loads(line) for line in self._lines()]
+        self.assertEqual([line["mac"] for line in lines], [MACS[1]])
+        self.assertTrue(lines[0]["sync_button"])
+
+    def test_missing_capture(self):
+        self.assertEqual(main(["replay", os.path.join(self.dir, "missing.bin"), "-o", self.output]), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
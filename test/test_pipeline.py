@@ -0,0 +1,170 @@
+"""Multiprocess parsing pipeline test
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import unittest
+import logging
+import threading
+from types import SimpleNamespace
+from mopeka_pro_check.advertisement import CompactMopekaAdvertisement, MopekaAdvertisement
+from mopeka_pro_check.pipeline import ParsingPipeline, SharedRing
+from mopeka_pro_check.replay import MakeMopekaPacket
+from mopeka_pro_check.service import MopekaService
+from mopeka_pro_check.sensor import MopekaSensor
+
+
+BLE_NOT_MOPEKA = bytes.fromhex(
+    "01 00 01 3b 69 19 46 88 c0 19 02 01 02 11 09 44 56 33 33 30 30 53 2d 34 2e 30 2d 30 39 33 42 03 03 32 a0 a2")
+BLE_MOPEKA_MFG = bytes.fromhex(
+    "01 00 01 76 3C C4 05 9D E7 12  0D  FF  59  00  03  5D  31  2C  C1  C4  3C  76  3B  F9  03  02  E5  FE  A0")
+BLE_MOPEKA_MAC = "E7:9D:05:C4:3C:76"
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _packet(data: bytes):
+    """ hci packet stand in.  Service only uses the data and subevent_code attributes """
+    return SimpleNamespace(data=data, subevent_code=0x02)
+
+
+class SharedRingTest(unittest.TestCase):
+
+    def test_put_get(self):
+        ring = SharedRing(4, 16)
+        try:
+            self.assertEqual(ring.GetMany(), [])
+            for i in range(4):
+                self.assertTrue(ring.Put(bytes([i]) * (i + 1), i))
+            self.assertFalse(ring.Put(b"full"))
+            self.assertEqual(ring.GetMany(2), [(0, b"\x00"), (1, b"\x01\x01")])
+            # 14 bytes of payload fit in a 16 byte slot
+            self.assertFalse(ring.Put(b"x" * 15))
+            # wraps around
+            self.assertTrue(ring.Put(b"four", 4))
+            self.assertEqual(len(ring), 3)
+            self.assertEqual([t for t, _ in ring.GetMany()], [2, 3, 4])
+        finally:
+            ring.Close()
+
+    def test_attach(self):
+        ring = SharedRing(8, 16)
+        other = SharedRing(8, 16, ring.Name)
+        try:
+            ring.Put(b"abc", 7)
+            ring.Counters[1] = 5
+            self.assertEqual(other.GetMany(), [(7, b"abc")])
+            self.assertEqual(other.Counters[1], 5)
+            self.assertEqual(len(ring), 0)
+        finally:
+            other.Close()
+            ring.Close()
+
+    def test_power_of_two(self):
+        with self.assertRaises(ValueError):
+            SharedRing(6)
+
+
+class FromMfgDataTest(unittest.TestCase):
+
+    def test_matches_parsed(self):
+        expected = MopekaAdvertisement(BLE_MOPEKA_MFG)
+        ma = CompactMopekaAdvertisement.FromMfgData(BLE_MOPEKA_MFG[3:9], BLE_MOPEKA_MFG[11:24], BLE_MOPEKA_MFG[-1])
+        self.assertEqual(ma.mac, expected.mac)
+        self.assertEqual(ma.rssi, expected.rssi)
+        self.assertEqual(ma.TankLevelInMM, expected.TankLevelInMM)
+        self.assertEqual(ma._raw_mfg_data, expected._raw_mfg_data)
+
+
+class ParsingPipelineTest(unittest.TestCase):
+
+    def test_filtered_mode(self):
+        service = MopekaService()
+        sensor = MopekaSensor(BLE_MOPEKA_MAC)
+        service.AddSensorToMonitor(sensor)
+        readings = []
+        service.AddReadingCallback(lambda s, r: readings.append(r.TankLevelInMM))
+
+        with ParsingPipeline(service, workers=2) as pipeline:
+            self.assertIs(service.Pipeline, pipeline)
+            for level in (0x12C, 0x12C, 0x130, 0x12C):
+                service.HandleMetaEvent(_packet(MakeMopekaPacket(BLE_MOPEKA_MAC, raw_level=level)))
+            service.HandleMetaEvent(_packet(BLE_NOT_MOPEKA))
+            service.HandleMetaEvent(_packet(BLE_MOPEKA_MFG[:9] + b"\x00" + BLE_MOPEKA_MFG[-1:]))
+            self.assertTrue(pipeline.Flush())
+
+        self.assertIsNone(service.Pipeline)
+        self.assertEqual(readings, [126, 128, 126])
+        stats = service.ServiceStats
+        self.assertEqual(stats._processed_ad_count, 3)
+        self.assertEqual(stats._duplicate_ad_count, 1)
+        self.assertEqual(stats._ignored_ad_count, 1)
+        self.assertEqual(stats._zero_length_ad_count, 1)
+        self.assertIsInstance(sensor.GetReading(), CompactMopekaAdvertisement)
+
+    def test_discovery_mode(self):
+        service = MopekaService()
+        service.DoSensorDiscovery()
+        found = []
+        service.AddDiscoveryCallback(found.append)
+
+        with ParsingPipeline(service, workers=1) as pipeline:
+            service.HandleMetaEvent(_packet(MakeMopekaPacket(BLE_MOPEKA_MAC)))
+            service.HandleMetaEvent(_packet(BLE_NOT_MOPEKA))
+            service.HandleMetaEvent(_packet(MakeMopekaPacket(BLE_MOPEKA_MAC, button=True)))
+            self.assertTrue(pipeline.Flush())
+            # discovered sensors are skipped before queueing
+            service.HandleMetaEvent(_packet(MakeMopekaPacket(BLE_MOPEKA_MAC, raw_level=1, button=True)))
+            self.assertTrue(pipeline.Flush())
+
+        self.assertEqual([s._mac for s in found], [BLE_MOPEKA_MAC])
+        self.assertEqual(service.ServiceStats._processed_ad_count, 2)
+        self.assertEqual(service.ServiceStats._ignored_ad_count, 1)
+
+    def test_full_ring_drops(self):
+        service = MopekaService()
+        service.AddSensorToMonitor(MopekaSensor(BLE_MOPEKA_MAC))
+        pipeline = ParsingPipeline(service, workers=1, ring_size=4)
+        pipeline._packets = [SharedRing(4)]
+        try:
+            for level in range(6):
+                pipeline.Submit(MakeMopekaPacket(BLE_MOPEKA_MAC, raw_level=level))
+            self.assertEqual(pipeline.DroppedCount, 2)
+        finally:
+            pipeline._packets[0].Close()
+
+    def test_concurrent_submit(self):
+        # every adapter thread submits to the same ring
+        macs = ["E7:9D:05:C4:3C:%02X" % i for i in range(4)]
+        service = MopekaService()
+        service.AddSensorsToMonitor(MopekaSensor(m) for m in macs)
+        pipeline = ParsingPipeline(service, workers=1)
+        pipeline._packets = [SharedRing(4096)]
+        try:
+            def submit(mac):
+                for level in range(1000):
+                    pipeline.Submit(MakeMopekaPacket(mac, raw_level=level), adapter_index=macs.index(mac))
+            threads = [threading.Thread(target=submit, args=(m,)) for m in macs]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            items = pipeline._packets[0].GetMany(4096)
+            self.assertEqual(len(set(data for _, data in items)), 4000)
+            self.assertEqual(pipeline._submitted, [4000])
+            self.assertEqual(pipeline.DroppedCount, 0)
+        finally:
+            pipeline._packets[0].Close()
+
+    def test_submit_after_stop(self):
+        service = MopekaService()
+        service.AddSensorToMonitor(MopekaSensor(BLE_MOPEKA_MAC))
+        pipeline = ParsingPipeline(service, workers=1)
+        pipeline.Start()
+        pipeline.Stop()
+        # an adapter thread that read service.Pipeline before Stop cleared it
+        pipeline.Submit(MakeMopekaPacket(BLE_MOPEKA_MAC))
+        self.assertEqual(pipeline._submitted, [0])
+        self.assertEqual(pipeline.DroppedCount, 0)
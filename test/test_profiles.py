@@ -0,0 +1,141 @@
+"""Fluid profile and tank geometry test
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import unittest
+import logging
+from mopeka_pro_check.advertisement import (
+    MopekaAdvertisement,
+    CompactMopekaAdvertisement,
+    HardwareId,
+    ParseStatus,
+    HARDWARE_LEVEL_FACTOR_TABLES,
+)
+from mopeka_pro_check.profiles import (
+    SensorProfile,
+    RegisterProfile,
+    GetProfile,
+    GetDefaultProfile,
+    PROPANE,
+    AIR_SPACE,
+    WATER,
+)
+from mopeka_pro_check.sensor import MopekaSensor
+from mopeka_pro_check.tank import (
+    TankGeometry,
+    TankOrientation,
+    TANK_20LB_VERTICAL,
+    TANK_500GAL_HORIZONTAL,
+    TANK_GEOMETRIES,
+)
+
+
+BLE_MOPEKA_MFG = bytes.fromhex(
+    "01 00 01 76 3C C4 05 9D E7 12  0D  FF  59  00  03  5D  31  2C  C1  C4  3C  76  3B  F9  03  02  E5  FE  A0")
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _packet(hardware_id: HardwareId) -> bytes:
+    b = bytearray(BLE_MOPEKA_MFG[:])
+    b[14] = hardware_id.value
+    return bytes(b)
+
+
+class HardwareProfileTest(unittest.TestCase):
+
+    def test_supported_hardware(self):
+        for hardware_id, level in (
+            (HardwareId.STD_BOTTOM_UP_PROPANE, 126),
+            (HardwareId.TOP_DOWN_AIR_SPACE, 50),
+            (HardwareId.BOTTOM_UP_WATER, 216),
+        ):
+            data = _packet(hardware_id)
+            status, ma = MopekaAdvertisement.TryParse(data)
+            self.assertEqual(status, ParseStatus.OK)
+            self.assertEqual(ma.HardwareId, hardware_id)
+            self.assertEqual(ma.TankLevelInMM, level)
+            self.assertEqual(MopekaAdvertisement(data).TankLevelInMM, level)
+            self.assertEqual(CompactMopekaAdvertisement(data).TankLevelInMM, level)
+
+    def test_default_profiles(self):
+        self.assertIs(GetDefaultProfile(HardwareId.STD_BOTTOM_UP_PROPANE), PROPANE)
+        self.assertIs(GetDefaultProfile(HardwareId.TOP_DOWN_AIR_SPACE), AIR_SPACE)
+        self.assertIs(GetDefaultProfile(HardwareId.BOTTOM_UP_WATER), WATER)
+        self.assertIs(GetProfile("water"), WATER)
+        self.assertTrue(AIR_SPACE.MeasuresAirSpace)
+
+    def test_profile_matches_reading(self):
+        ma = MopekaAdvertisement(BLE_MOPEKA_MFG)
+        self.assertEqual(PROPANE.TankLevelInMM(ma), ma.TankLevelInMM)
+        self.assertEqual(WATER.TankLevelInMM(ma), 216)
+
+    def test_register_default_profile(self):
+        custom = SensorProfile("double", HardwareId.BOTTOM_UP_WATER, (1.0, 0.0, 0.0))
+        try:
+            RegisterProfile(custom, default=True)
+            self.assertIs(GetProfile("double"), custom)
+            self.assertEqual(MopekaAdvertisement(_packet(HardwareId.BOTTOM_UP_WATER)).TankLevelInMM, 300)
+        finally:
+            RegisterProfile(WATER, default=True)
+        self.assertIs(HARDWARE_LEVEL_FACTOR_TABLES[HardwareId.BOTTOM_UP_WATER.value], WATER.LevelFactors)
+
+
+class TankGeometryTest(unittest.TestCase):
+
+    def test_vertical(self):
+        t = TankGeometry("t", TankOrientation.VERTICAL, 300, 10.0, 50, 250)
+        self.assertEqual(t.PercentFull(0), 0.0)
+        self.assertEqual(t.PercentFull(50), 0.0)
+        self.assertEqual(t.PercentFull(150), 50.0)
+        self.assertEqual(t.PercentFull(150.5), 50.25)
+        self.assertEqual(t.PercentFull(250), 100.0)
+        self.assertEqual(t.PercentFull(1000), 100.0)
+        self.assertEqual(t.VolumeInLiters(150), 5.0)
+
+    def test_horizontal(self):
+        t = TANK_500GAL_HORIZONTAL
+        self.assertAlmostEqual(t.PercentFull(t.HeightInMM / 2), 50.0, places=3)
+        # a quarter of the diameter holds much less than a quarter of the volume
+        self.assertLess(t.PercentFull(t.HeightInMM / 4), 25.0)
+        self.assertGreater(t.PercentFull(3 * t.HeightInMM / 4), 75.0)
+        self.assertAlmostEqual(t.VolumeInLiters(t.HeightInMM), t.CapacityInLiters)
+
+    def test_invalid_range(self):
+        with self.assertRaises(ValueError):
+            TankGeometry("t", TankOrientation.VERTICAL, 100, 1.0, 80, 50)
+
+    def test_presets(self):
+        self.assertIs(TANK_GEOMETRIES["20lb"], TANK_20LB_VERTICAL)
+        self.assertEqual(set(TANK_GEOMETRIES), {"20lb", "100lb", "500gal"})
+
+
+class SensorProfileTest(unittest.TestCase):
+
+    def test_sensor_profile_and_tank(self):
+        ma = MopekaAdvertisement(BLE_MOPEKA_MFG)
+        ms = MopekaSensor(ma.mac.address, profile=WATER, tank=TANK_20LB_VERTICAL)
+        ms.AddReading(ma, timestamp=1.0)
+        self.assertEqual(ms.TankLevelInMM(ma), 216)
+        self.assertEqual(ms.History.Latest().TankLevelInMM, 216)
+        self.assertEqual(ms.PercentFull(ma), TANK_20LB_VERTICAL.PercentFull(216))
+        self.assertEqual(ms.VolumeInLiters(ma), TANK_20LB_VERTICAL.VolumeInLiters(216))
+
+    def test_sensor_default_profile(self):
+        ma = MopekaAdvertisement(BLE_MOPEKA_MFG)
+        ms = MopekaSensor(ma.mac.address, tank=TANK_20LB_VERTICAL)
+        self.assertEqual(ms.TankLevelInMM(ma), 126)
+        self.assertEqual(ms.FluidHeightInMM(ma), 126)
+
+    def test_air_space(self):
+        ma = MopekaAdvertisement(_packet(HardwareId.TOP_DOWN_AIR_SPACE))
+        ms = MopekaSensor(ma.mac.address, tank=TANK_20LB_VERTICAL)
+        self.assertEqual(ms.FluidHeightInMM(ma), TANK_20LB_VERTICAL.HeightInMM - 50)
+        ms.Tank = None
+        with self.assertRaises(ValueError):
+            ms.FluidHeightInMM(ma)
+        with self.assertRaises(ValueError):
+            ms.PercentFull(ma)
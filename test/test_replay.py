@@ -0,0 +1,115 @@
+"""Offline HCI capture replay test
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import unittest
+import logging
+import io
+import struct
+from mopeka_pro_check.replay import (
+    CaptureWriter,
+    ReadCapture,
+    Replay,
+    GenerateTraffic,
+    MakeMopekaPacket,
+    BTSNOOP_MAGIC,
+)
+from mopeka_pro_check.advertisement import MopekaAdvertisement, IsMopekaAdvertisement
+from mopeka_pro_check.service import MopekaService
+from mopeka_pro_check.sensor import MopekaSensor
+
+
+BLE_MOPEKA_MFG = bytes.fromhex(
+    "01 00 01 76 3C C4 05 9D E7 12  0D  FF  59  00  03  5D  31  2C  C1  C4  3C  76  3B  F9  03  02  E5  FE  A0")
+BLE_MOPEKA_MAC = "E7:9D:05:C4:3C:76"
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _btsnoop_h4(records):
+    """ build a btsnoop H4 capture holding LE advertising report events """
+    out = io.BytesIO()
+    out.write(BTSNOOP_MAGIC + struct.pack(">II", 1, 1002))
+    for timestamp_us, data in records:
+        packet = bytes([0x04, 0x3E, len(data) + 1, 0x02]) + data
+        out.write(struct.pack(">IIIIq", len(packet), len(packet), 1, 0, timestamp_us))
+        out.write(packet)
+    # a command packet that must be skipped
+    out.write(struct.pack(">IIIIq", 4, 4, 0, 0, 0) + bytes([0x01, 0x0C, 0x20, 0x00]))
+    out.seek(0)
+    return out
+
+
+def _btsnoop_monitor(records):
+    """ build a btsnoop BlueZ monitor capture (btmon -w) holding LE advertising report events """
+    out = io.BytesIO()
+    out.write(BTSNOOP_MAGIC + struct.pack(">II", 1, 2001))
+    for adapter, timestamp_us, data in records:
+        packet = bytes([0x3E, len(data) + 1, 0x02]) + data
+        out.write(struct.pack(">IIIIq", len(packet), len(packet), (adapter << 16) | 3, 0, timestamp_us))
+        out.write(packet)
+    # a command packet (opcode 2) from hci0 that must be skipped
+    out.write(struct.pack(">IIIIq", 3, 3, 2, 0, 0) + bytes([0x0C, 0x20, 0x00]))
+    out.seek(0)
+    return out
+
+
+class CaptureFormatTest(unittest.TestCase):
+
+    def test_simple_round_trip(self):
+        stream = io.BytesIO()
+        CaptureWriter(stream).WriteAll([(1.5, BLE_MOPEKA_MFG), (2.5, b"\x01\x02")])
+        stream.seek(0)
+        self.assertEqual(list(ReadCapture(stream)), [(1.5, BLE_MOPEKA_MFG), (2.5, b"\x01\x02")])
+
+    def test_btsnoop_h4(self):
+        stream = _btsnoop_h4([(0x00DCDDB30F2F8000 + 2000000, BLE_MOPEKA_MFG)])
+        records = list(ReadCapture(stream))
+        self.assertEqual(records, [(2.0, BLE_MOPEKA_MFG)])
+
+    def test_btsnoop_monitor(self):
+        base = 0x00DCDDB30F2F8000
+        stream = _btsnoop_monitor([(0, base + 1000000, BLE_MOPEKA_MFG), (1, base + 3000000, BLE_MOPEKA_MFG)])
+        records = list(ReadCapture(stream))
+        self.assertEqual(records, [(1.0, BLE_MOPEKA_MFG), (3.0, BLE_MOPEKA_MFG)])
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            ReadCapture(io.BytesIO(b"notacapture"))
+
+
+class ReplayTest(unittest.TestCase):
+
+    def test_replay_into_service(self):
+        service = MopekaService()
+        sensor = MopekaSensor(BLE_MOPEKA_MAC)
+        service.AddSensorToMonitor(sensor)
+
+        count = Replay(service, [(0.0, BLE_MOPEKA_MFG)] * 3)
+        self.assertEqual(count, 3)
+        self.assertEqual(service.ServiceStats._processed_ad_count, 1)
+        self.assertEqual(service.ServiceStats._duplicate_ad_count, 2)
+
+    def test_replay_timed(self):
+        service = MopekaService()
+        count = Replay(service, [(0.0, BLE_MOPEKA_MFG), (0.01, BLE_MOPEKA_MFG)], speed=1.0)
+        self.assertEqual(count, 2)
+
+
+class SyntheticTrafficTest(unittest.TestCase):
+
+    def test_make_mopeka_packet(self):
+        self.assertEqual(MakeMopekaPacket(BLE_MOPEKA_MAC), BLE_MOPEKA_MFG)
+        ma = MopekaAdvertisement(MakeMopekaPacket(BLE_MOPEKA_MAC, raw_level=100, quality=1, button=True, rssi=-50))
+        self.assertEqual(ma._raw_tank_level, 100)
+        self.assertEqual(ma.ReadingQualityStars, 1)
+        self.assertTrue(ma.SyncButtonPressed)
+        self.assertEqual(ma.rssi, -50)
+
+    def test_mix_ratio(self):
+        records = GenerateTraffic(2000, [BLE_MOPEKA_MAC], mopeka_ratio=0.25)
+        mopeka = sum(1 for _, data in records if IsMopekaAdvertisement(data))
+        self.assertAlmostEqual(mopeka / len(records), 0.25, delta=0.05)
@@ -28,6 +28,23 @@ class MopekaSensorTest(unittest.TestCase):
 
         self.assertIs(ms.GetReading(), ma)
 
+    def test_mopeka_sensor_history(self):
+        """ readings are kept in history after GetReading """
+        ma = MopekaAdvertisement(BLE_MOPEKA_MFG)
+        ms = MopekaSensor(ma.mac.address, history_size=2)
+        ms.AddReading(ma, timestamp=1.0)
+        ms.AddReading(ma, timestamp=2.0)
+        ms.AddReading(ma, timestamp=3.0)
+        ms.GetReading()
+
+        self.assertEqual([r.timestamp for r in ms.History.GetLast(5)], [2.0, 3.0])
+
+    def test_mopeka_sensor_history_disabled(self):
+        ma = MopekaAdvertisement(BLE_MOPEKA_MFG)
+        ms = MopekaSensor(ma.mac.address, history_size=0)
+        ms.AddReading(ma)
+        self.assertIsNone(ms.History)
+
     def test_mopeka_sensor_to_string(self):
         """ Make sure to string works"""
         ma = MopekaAdvertisement(BLE_MOPEKA_MFG)
@@ -0,0 +1,217 @@
+"""HTTP tank state endpoint test
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import unittest
+import logging
+import asyncio
+import json
+import threading
+from types import SimpleNamespace
+from mopeka_pro_check.replay import MakeMopekaPacket
+from mopeka_pro_check.sensor import MopekaSensor
+from mopeka_pro_check.server import StateServer
+from mopeka_pro_check.service import MopekaService
+
+_LOGGER = logging.getLogger(__name__)
+
+MACS = ["E7:9D:05:C4:3C:%02X" % i for i in range(3)]
+
+
+def _feed(service: MopekaService, mac: str, level: int) -> None:
+    service.ProcessAdvertisementPacket(SimpleNamespace(data=MakeMopekaPacket(mac, raw_level=level)))
+
+
+class _Client(object):
+    """ keep alive http client over one connection """
+
+    async def open(self, port: int) -> "_Client":
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", port)
+        return self
+
+    async def request(self, path: str, method: str = "GET", version: str = "HTTP/1.1", **headers):
+        lines = [f"{method} {path} {version}", "Host: localhost"]
+        lines += [f"{k.replace('_', '-')}: {v}" for k, v in headers.items()]
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("ascii"))
+        head = (await asyncio.wait_for(self.reader.readuntil(b"\r\n\r\n"), 5)).decode("ascii")
+        status_line, *header_lines = head.strip().split("\r\n")
+        response_headers = {}
+        for line in header_lines:
+            name, _, value = line.partition(":")
+            response_headers[name.lower()] = value.strip()
+        length = int(response_headers.get("content-length", 0))
+        body = b""
+        if method != "HEAD" and int(status_line.split(" ")[1]) != 304 and length:
+            body = await self.reader.readexactly(length)
+        return int(status_line.split(" ")[1]), response_headers, body
+
+    def close(self):
+        self.writer.close()
+
+
+class StateServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.service = MopekaService()
+        self.sensors = [MopekaSensor(m) for m in MACS]
+        self.service.AddSensorsToMonitor(self.sensors)
+        _feed(self.service, MACS[0], 300)
+
+    def _run(self, test):
+        async def run():
+            async with StateServer(self.service, port=0, render_interval=0) as server:
+                client = await _Client().open(server.Port)
+                try:
+                    return await test(server, client)
+                finally:
+                    client.close()
+        return asyncio.run(run())
+
+    def test_state(self):
+        async def test(server, client):
+            return await client.request("/state")
+        status, headers, body = self._run(test)
+        self.assertEqual(status, 200)
+        self.assertEqual(headers["content-type"], "application/json")
+        state = json.loads(body)
+        self.assertEqual([s["mac"] for s in state], MACS)
+        self.assertEqual(state[0]["level_mm"], self.sensors[0].TankLevelInMM(self.sensors[0]._last_reading))
+        self.assertEqual(state[0]["quality"], 3)
+        self.assertNotIn("level_mm", state[1])
+
+    def test_etag_not_modified(self):
+        async def test(server, client):
+            _, headers, _ = await client.request("/state")
+            etag = headers["etag"]
+            status, _, body = await client.request("/state", If_None_Match=etag)
+            self.assertEqual((status, body), (304, b""))
+            status, _, _ = await client.request("/state", If_None_Match=f'"other", W/{etag}')
+            self.assertEqual(status, 304)
+            # a new reading from the scanning thread changes the etag
+            t = threading.Thread(target=_feed, args=(self.service, MACS[1], 500))
+            t.start()
+            t.join()
+            status, headers, body = await client.request("/state", If_None_Match=etag)
+            self.assertEqual(status, 200)
+            self.assertNotEqual(headers["etag"], etag)
+            self.assertIn("level_mm", json.loads(body)[1])
+            return server
+        server = self._run(test)
+        self.assertEqual(server.NotModifiedCount, 2)
+        self.assertEqual(server.RequestCount, 4)
+
+    def test_rendered_once_per_change(self):
+        async def test(server, client):
+            for _ in range(20):
+                await client.request("/state")
+            renders = server.RenderCount
+            unchanged = server._fragments[self.sensors[2]._raw_mac]
+            _feed(self.service, MACS[0], 400)
+            for _ in range(20):
+                await client.request("/state")
+            # the sensor without a new reading kept its rendered fragment
+            self.assertIs(server._fragments[self.sensors[2]._raw_mac], unchanged)
+            return renders, server.RenderCount
+        self.assertEqual(self._run(test), (1, 2))
+
+    def test_render_interval(self):
+        async def run():
+            async with StateServer(self.service, port=0, render_interval=60) as server:
+                client = await _Client().open(server.Port)
+                _, first, _ = await client.request("/state")
+                _feed(self.service, MACS[0], 400)
+                _, second, _ = await client.request("/state")
+                # a change of the sensor list is not held back
+                self.service.RemoveSensorToMonitor(self.sensors[2])
+                _, third, body = await client.request("/state")
+                client.close()
+                return first["etag"], second["etag"], third["etag"], json.loads(body)
+        first, second, third, state = asyncio.run(run())
+        self.assertEqual(first, second)
+        self.assertNotEqual(second, third)
+        self.assertEqual(len(state), 2)
+        self.assertEqual(state[0]["level_mm"], self.sensors[0].TankLevelInMM(self.sensors[0]._last_reading))
+
+    def test_duplicate_reading_keeps_etag(self):
+        async def test(server, client):
+            _, first, _ = await client.request("/state")
+            # same reading again is dropped by the service as a repeat
+            _feed(self.service, MACS[0], 300)
+            _, second, _ = await client.request("/state")
+            return first["etag"], second["etag"]
+        first, second = self._run(test)
+        self.assertEqual(first, second)
+
+    def test_sensor_list_change(self):
+        async def test(server, client):
+            _, _, body = await client.request("/state")
+            self.service.RemoveSensorToMonitor(self.sensors[2])
+            _, _, after = await client.request("/state")
+            return json.loads(body), json.loads(after)
+        before, after = self._run(test)
+        self.assertEqual(len(before), 3)
+        self.assertEqual([s["mac"] for s in after], MACS[:2])
+
+    def test_metrics(self):
+        self.service.EnableMetrics()
+        _feed(self.service, MACS[0], 350)
+
+        async def test(server, client):
+            return await client.request("/metrics")
+        status, headers, body = self._run(test)
+        self.assertEqual(status, 200)
+        self.assertTrue(headers["content-type"].startswith("text/plain; version=0.0.4"))
+        text = body.decode()
+        self.assertIn("# TYPE mopeka_sensor_level_mm gauge", text)
+        self.assertIn(f'mopeka_sensor_offline{{mac="{MACS[2]}"}} 0', text)
+        self.assertIn(f'mopeka_sensor_readings_total{{mac="{MACS[0]}"}} 1', text)
+        # one TYPE line per metric
+        self.assertEqual(text.count("# TYPE mopeka_sensor_offline gauge"), 1)
+
+    def test_head_and_errors(self):
+        async def test(server, client):
+            results = [await client.request("/state", method="HEAD")]
+            results.append(await client.request("/nothing"))
+            results.append(await client.request("/state", method="POST"))
+            return results
+        (status, headers, body), (missing, _, _), (post, post_headers, _) = self._run(test)
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b"")
+        self.assertGreater(int(headers["content-length"]), 0)
+        self.assertEqual(missing, 404)
+        self.assertEqual(post, 405)
+        self.assertEqual(post_headers["allow"], "GET, HEAD")
+
+    def test_http10_closes(self):
+        async def test(server, client):
+            status, _, _ = await client.request("/state", version="HTTP/1.0")
+            return status, await asyncio.wait_for(client.reader.read(), 5)
+        self.assertEqual(self._run(test), (200, b""))
+
+    def test_bad_request(self):
+        async def test(server, client):
+            client.writer.write(b"nonsense\r\n\r\n")
+            return await asyncio.wait_for(client.reader.read(), 5)
+        self.assertTrue(self._run(test).startswith(b"HTTP/1.1 400"))
+
+    def test_close_with_idle_connection(self):
+        async def run():
+            server = StateServer(self.service, port=0)
+            await server.Start()
+            client = await _Client().open(server.Port)
+            await client.request("/state")
+            await server.Close()
+            data = await asyncio.wait_for(client.reader.read(), 5)
+            client.close()
+            return server, data
+        server, data = asyncio.run(run())
+        self.assertEqual(data, b"")
+        self.assertEqual(server._connections, {})
+        self.assertEqual(self.service._reading_callbacks, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,381 @@
+"""Mopeka service test using synthetic HCI packets
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import unittest
+import logging
+from types import SimpleNamespace
+import threading
+from mopeka_pro_check.service import MopekaService, AdapterMergePolicy, ChangeThreshold
+from mopeka_pro_check.replay import MakeMopekaPacket, ReplayPacket
+from mopeka_pro_check.sensor import MopekaSensor
+
+
+BLE_NOT_MOPEKA = bytes.fromhex(
+    "01 00 01 3b 69 19 46 88 c0 19 02 01 02 11 09 44 56 33 33 30 30 53 2d 34 2e 30 2d 30 39 33 42 03 03 32 a0 a2")
+BLE_MOPEKA_MFG = bytes.fromhex(
+    "01 00 01 76 3C C4 05 9D E7 12  0D  FF  59  00  03  5D  31  2C  C1  C4  3C  76  3B  F9  03  02  E5  FE  A0")
+BLE_MOPEKA_MAC = "E7:9D:05:C4:3C:76"
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _packet(data: bytes):
+    """ hci packet stand in.  Service only uses the data attribute """
+    return SimpleNamespace(data=data)
+
+
+class MopekaServiceFilteredModeTest(unittest.TestCase):
+
+    def test_monitored_sensor_gets_reading(self):
+        service = MopekaService()
+        sensor = MopekaSensor(BLE_MOPEKA_MAC)
+        service.AddSensorToMonitor(sensor)
+
+        service.ProcessAdvertisementPacket(_packet(BLE_MOPEKA_MFG))
+        self.assertEqual(service.ServiceStats._processed_ad_count, 1)
+        self.assertEqual(sensor.GetReading().TankLevelInMM, 126)
+
+    def test_unknown_sensor_ignored(self):
+        service = MopekaService()
+        service.AddSensorToMonitor(MopekaSensor("00:11:22:33:44:55"))
+
+        service.ProcessAdvertisementPacket(_packet(BLE_MOPEKA_MFG))
+        service.ProcessAdvertisementPacket(_packet(BLE_NOT_MOPEKA))
+        self.assertEqual(service.ServiceStats._processed_ad_count, 0)
+        self.assertEqual(service.ServiceStats._ignored_ad_count, 2)
+
+
+class _FakeAdapter(object):
+    """ stands in for a bleson adapter """
+
+    def __init__(self):
+        self.start_count = 0
+        self.stop_count = 0
+        self._handle_meta_event = None
+
+    def start_scanning(self):
+        self.start_count += 1
+
+    def stop_scanning(self):
+        self.stop_count += 1
+
+
+class _FakeProvider(object):
+    """ stands in for a bleson provider """
+
+    def __init__(self):
+        self.adapters = {}
+
+    def get_adapter(self, index):
+        return self.adapters.setdefault(index, _FakeAdapter())
+
+
+class MopekaServiceMonitoredListTest(unittest.TestCase):
+
+    def test_remove_sensor(self):
+        service = MopekaService()
+        sensor = MopekaSensor(BLE_MOPEKA_MAC)
+        service.AddSensorToMonitor(sensor)
+        service.RemoveSensorToMonitor(sensor)
+        self.assertEqual(len(service.SensorMonitoredList), 0)
+
+        service.ProcessAdvertisementPacket(_packet(BLE_MOPEKA_MFG))
+        self.assertEqual(service.ServiceStats._processed_ad_count, 0)
+
+    def test_remove_unknown_sensor(self):
+        service = MopekaService()
+        service.AddSensorToMonitor(MopekaSensor(BLE_MOPEKA_MAC))
+        service.RemoveSensorToMonitor(MopekaSensor("00:11:22:33:44:55"))
+        self.assertEqual(len(service.SensorMonitoredList), 1)
+
+    def test_bulk_add_remove(self):
+        service = MopekaService()
+        sensors = [MopekaSensor("00:00:00:00:%02X:%02X" % (i >> 8, i & 0xFF)) for i in range(1000)]
+        service.AddSensorsToMonitor(sensors)
+        self.assertEqual(len(service.SensorMonitoredList), 1000)
+        self.assertEqual(service.MonitoredListVersion, 1)
+
+        service.RemoveSensorsToMonitor(sensors[:500])
+        self.assertEqual(len(service.SensorMonitoredList), 500)
+        self.assertEqual(service.MonitoredListVersion, 2)
+
+    def test_update_does_not_stop_scanning(self):
+        provider = _FakeProvider()
+        service = MopekaService(provider)
+        first = MopekaSensor("00:11:22:33:44:55")
+        service.AddSensorToMonitor(first)
+        service.Start()
+        adapter = provider.adapters[0]
+        self.assertEqual(adapter.start_count, 1)
+
+        sensor = MopekaSensor(BLE_MOPEKA_MAC)
+        service.AddSensorToMonitor(sensor)
+        service.RemoveSensorToMonitor(first)
+        self.assertEqual(adapter.stop_count, 0)
+        self.assertEqual(adapter.start_count, 1)
+
+        service.ProcessAdvertisementPacket(_packet(BLE_MOPEKA_MFG))
+        self.assertIsNotNone(sensor.GetReading())
+
+
+class MopekaServiceDeduplicateTest(unittest.TestCase):
+
+    def _service(self):
+        service = MopekaService()
+        sensor = MopekaSensor(BLE_MOPEKA_MAC)
+        service.AddSensorToMonitor(sensor)
+        return service, sensor
+
+    def test_repeated_payload_not_parsed(self):
+        service, sensor = self._service()
+        service.ProcessAdvertisementPacket(_packet(MakeMopekaPacket(BLE_MOPEKA_MAC, rssi=-80)))
+        service.ProcessAdvertisementPacket(_packet(MakeMopekaPacket(BLE_MOPEKA_MAC, rssi=-70)))
+        self.assertEqual(service.ServiceStats._processed_ad_count, 1)
+        self.assertEqual(service.ServiceStats._duplicate_ad_count, 1)
+        self.assertEqual(len(sensor.History), 1)
+
+    def test_latest_reading_still_available(self):
+        service, sensor = self._service()
+        service.ProcessAdvertisementPacket(_packet(BLE_MOPEKA_MFG))
+        first = sensor.GetReading()
+        service.ProcessAdvertisementPacket(_packet(BLE_MOPEKA_MFG))
+        self.assertIs(sensor.GetReading(), first)
+
+    def test_repeated_payload_updates_health_under_lock(self):
+        service, sensor = self._service()
+        service.ProcessAdvertisementPacket(_packet(BLE_MOPEKA_MFG))
+        with service._reading_lock:
+            # another adapter thread is applying a reading
+            t = threading.Thread(target=service.ProcessAdvertisementPacket, args=(_packet(BLE_MOPEKA_MFG),), daemon=True)
+            t.start()
+            t.join(0.2)
+            self.assertTrue(t.is_alive())
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(service.ServiceStats._duplicate_ad_count, 1)
+
+    def test_changed_payload_parsed(self):
+        service, sensor = self._service()
+        service.ProcessAdvertisementPacket(_packet(BLE_MOPEKA_MFG))
+        service.ProcessAdvertisementPacket(_packet(MakeMopekaPacket(BLE_MOPEKA_MAC, raw_level=10)))
+        self.assertEqual(service.ServiceStats._processed_ad_count, 2)
+        self.assertEqual(sensor.GetReading()._raw_tank_level, 10)
+
+    def test_disabled(self):
+        service, _ = self._service()
+        service.DeduplicateReadings = False
+        service.ProcessAdvertisementPacket(_packet(BLE_MOPEKA_MFG))
+        service.ProcessAdvertisementPacket(_packet(BLE_MOPEKA_MFG))
+        self.assertEqual(service.ServiceStats._processed_ad_count, 2)
+
+    def test_change_threshold(self):
+        service, _ = self._service()
+        service.ReadingChangeThreshold = ChangeThreshold(TankLevelInMM=50, TemperatureInCelsius=None, BatteryPercent=None)
+        reported = []
+        service.AddReadingCallback(lambda sensor, ma: reported.append(ma._raw_tank_level))
+
+        for raw_level in (1000, 1010, 1020, 1200, 1210):
+            service.ProcessAdvertisementPacket(_packet(MakeMopekaPacket(BLE_MOPEKA_MAC, raw_level=raw_level)))
+        self.assertEqual(reported, [1000, 1200])
+        self.assertEqual(service.ServiceStats._suppressed_ad_count, 3)
+        self.assertEqual(service.ServiceStats._processed_ad_count, 5)
+
+
+class MopekaServiceDiscoveryModeTest(unittest.TestCase):
+
+    def test_discover_sensor_with_button_pressed(self):
+        service = MopekaService()
+        service.DoSensorDiscovery()
+        b = bytearray(BLE_MOPEKA_MFG[:])
+        b[16] = b[16] | 0x80  # press sync button
+
+        service.ProcessAdvertisementPacket(_packet(BLE_NOT_MOPEKA))
+        service.ProcessAdvertisementPacket(_packet(bytes(b)))
+        service.ProcessAdvertisementPacket(_packet(bytes(b)))
+
+        self.assertEqual(len(service.SensorDiscoveredList), 1)
+        self.assertEqual(service.ServiceStats._ignored_ad_count, 1)
+        self.assertEqual(service.ServiceStats._processed_ad_count, 1)
+
+    def test_sensor_without_button_not_discovered(self):
+        service = MopekaService()
+        service.DoSensorDiscovery()
+
+        service.ProcessAdvertisementPacket(_packet(BLE_MOPEKA_MFG))
+        self.assertEqual(len(service.SensorDiscoveredList), 0)
+
+
+class MopekaServiceMultiAdapterTest(unittest.TestCase):
+
+    def _service(self):
+        provider = _FakeProvider()
+        service = MopekaService(provider)
+        # test the adapter merge on its own.  Payload dedup would catch these first
+        service.DeduplicateReadings = False
+        self.assertTrue(service.SetHostControllerIndexes([0, 1]))
+        sensor = MopekaSensor(BLE_MOPEKA_MAC)
+        service.AddSensorToMonitor(sensor)
+        service.Start()
+        return service, provider, sensor
+
+    def _deliver(self, adapter, data):
+        """ deliver a packet on a separate thread like bleson would """
+        t = threading.Thread(target=adapter._handle_meta_event, args=(ReplayPacket(data),))
+        t.start()
+        t.join()
+
+    def test_all_adapters_started(self):
+        service, provider, _ = self._service()
+        self.assertEqual(sorted(provider.adapters), [0, 1])
+        self.assertTrue(all(a.start_count == 1 for a in provider.adapters.values()))
+        self.assertFalse(service.SetHostControllerIndexes([2]))
+        service.Stop()
+        self.assertTrue(all(a.stop_count == 1 for a in provider.adapters.values()))
+
+    def test_duplicate_from_second_adapter(self):
+        service, provider, sensor = self._service()
+        self._deliver(provider.adapters[0], BLE_MOPEKA_MFG)
+        self._deliver(provider.adapters[1], BLE_MOPEKA_MFG)
+
+        self.assertEqual(service.ServiceStats._processed_ad_count, 1)
+        self.assertEqual(service.AdapterStatsList[0]._reading_count, 1)
+        self.assertEqual(service.AdapterStatsList[1]._duplicate_count, 1)
+        self.assertEqual(service.AdapterStatsList[1]._packet_count, 1)
+        self.assertEqual(len(sensor.History), 1)
+
+    def test_new_payload_from_second_adapter(self):
+        service, provider, _ = self._service()
+        self._deliver(provider.adapters[0], BLE_MOPEKA_MFG)
+        self._deliver(provider.adapters[1], MakeMopekaPacket(BLE_MOPEKA_MAC, raw_level=10))
+        self.assertEqual(service.ServiceStats._processed_ad_count, 2)
+
+    def test_best_rssi(self):
+        service, provider, sensor = self._service()
+        service.MergePolicy = AdapterMergePolicy.BEST_RSSI
+        self._deliver(provider.adapters[0], MakeMopekaPacket(BLE_MOPEKA_MAC, rssi=-90))
+        self._deliver(provider.adapters[1], MakeMopekaPacket(BLE_MOPEKA_MAC, rssi=-60))
+        self.assertEqual(sensor.GetReading().rssi, -60)
+
+    def test_best_rssi_not_available(self):
+        # 127 is the "rssi not available" byte.  Any real rssi beats it
+        service, provider, sensor = self._service()
+        service.MergePolicy = AdapterMergePolicy.BEST_RSSI
+        self._deliver(provider.adapters[0], MakeMopekaPacket(BLE_MOPEKA_MAC, rssi=127))
+        self._deliver(provider.adapters[1], MakeMopekaPacket(BLE_MOPEKA_MAC, rssi=-90))
+        self.assertEqual(sensor.GetReading().rssi, -90)
+        self._deliver(provider.adapters[0], MakeMopekaPacket(BLE_MOPEKA_MAC, raw_level=10, rssi=-90))
+        self._deliver(provider.adapters[1], MakeMopekaPacket(BLE_MOPEKA_MAC, raw_level=10, rssi=127))
+        self.assertEqual(sensor.GetReading().rssi, -90)
+
+    def test_freshest(self):
+        service, provider, sensor = self._service()
+        self._deliver(provider.adapters[0], MakeMopekaPacket(BLE_MOPEKA_MAC, rssi=-90))
+        self._deliver(provider.adapters[1], MakeMopekaPacket(BLE_MOPEKA_MAC, rssi=-60))
+        self.assertEqual(sensor.GetReading().rssi, -90)
+
+    def test_duplicate_payload_from_second_adapter(self):
+        service, provider, sensor = self._service()
+        service.DeduplicateReadings = True
+        self._deliver(provider.adapters[0], BLE_MOPEKA_MFG)
+        self._deliver(provider.adapters[1], BLE_MOPEKA_MFG)
+        self.assertEqual(service.ServiceStats._processed_ad_count, 1)
+        self.assertEqual(service.ServiceStats._duplicate_ad_count, 1)
+
+    def test_best_rssi_with_deduplicate(self):
+        service, provider, sensor = self._service()
+        service.DeduplicateReadings = True
+        service.MergePolicy = AdapterMergePolicy.BEST_RSSI
+        self._deliver(provider.adapters[0], MakeMopekaPacket(BLE_MOPEKA_MAC, rssi=-90))
+        self._deliver(provider.adapters[1], MakeMopekaPacket(BLE_MOPEKA_MAC, rssi=-60))
+        self.assertEqual(sensor.GetReading().rssi, -60)
+
+
+def _foreign_packet(mac_byte: int) -> bytes:
+    """ advertisement with 4 bytes of Apple (0x004C) mfg data """
+    b = bytearray(BLE_MOPEKA_MFG[:10]) + bytes([0x05, 0xFF, 0x4C, 0x00, 0x10, 0x05]) + BLE_MOPEKA_MFG[-1:]
+    b[3] = mac_byte
+    b[9] = 6
+    return bytes(b)
+
+
+class DiscoveryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.service = MopekaService()
+        self.service.Clock = lambda: self.now
+        self.service.DoSensorDiscovery()
+
+    def test_negative_cache(self):
+        service = self.service
+        for _ in range(3):
+            service.ProcessAdvertisementPacket(_packet(_foreign_packet(1)))
+        stats = service.DiscoveryCacheStats
+        self.assertEqual(stats._misses, 1)
+        self.assertEqual(stats._negative_hits, 2)
+        self.assertEqual(service.ServiceStats._ignored_ad_count, 3)
+        # entries expire
+        self.now = service.DiscoveryCacheTtl + 1
+        service.ProcessAdvertisementPacket(_packet(_foreign_packet(1)))
+        self.assertEqual(stats._misses, 2)
+
+    def test_no_mfg_data_not_cached(self):
+        # sensors send packets without GAP data.  They must not hide the sensor
+        empty = BLE_MOPEKA_MFG[:9] + b"\x00" + BLE_MOPEKA_MFG[-1:]
+        self.service.ProcessAdvertisementPacket(_packet(empty))
+        self.service.ProcessAdvertisementPacket(_packet(BLE_NOT_MOPEKA))
+        self.assertEqual(len(self.service._negative_cache), 0)
+
+    def test_lru_eviction(self):
+        service = self.service
+        service.DiscoveryCacheSize = 2
+        for mac_byte in (1, 2, 1, 3):
+            service.ProcessAdvertisementPacket(_packet(_foreign_packet(mac_byte)))
+        # 2 was least recently used
+        self.assertEqual(list(service._negative_cache), [bytes(_foreign_packet(m)[3:9]) for m in (1, 3)])
+        self.assertEqual(service.DiscoveryCacheStats._evictions, 1)
+
+    def test_pending_sensor_checks_button(self):
+        service = self.service
+        found = []
+        service.AddDiscoveryCallback(found.append)
+        for level in range(3):
+            service.ProcessAdvertisementPacket(_packet(MakeMopekaPacket(BLE_MOPEKA_MAC, raw_level=level)))
+        self.assertEqual(service.DiscoveryCacheStats._pending_hits, 2)
+        self.assertEqual(found, [])
+
+        service.ProcessAdvertisementPacket(_packet(MakeMopekaPacket(BLE_MOPEKA_MAC, button=True)))
+        self.assertEqual([s._mac for s in found], [BLE_MOPEKA_MAC])
+        self.assertEqual(service.ServiceStats._processed_ad_count, 4)
+        self.assertEqual(len(service._pending_cache), 0)
+        self.assertAlmostEqual(service.DiscoveryCacheStats.HitRate, 0.5)
+
+    def test_shared_by_adapter_threads(self):
+        service = self.service
+        service.DiscoveryCacheSize = 2
+        for mac_byte in (1, 2):
+            service.ProcessAdvertisementPacket(_packet(_foreign_packet(mac_byte)))
+        # another adapter thread is updating the caches
+        with service._discovery_cache_lock:
+            t = threading.Thread(target=service.ProcessAdvertisementPacket, args=(_packet(_foreign_packet(3)), 1), daemon=True)
+            t.start()
+            t.join(0.1)
+            self.assertTrue(t.is_alive())
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(list(service._negative_cache), [bytes(_foreign_packet(m)[3:9]) for m in (2, 3)])
+        self.assertEqual(service.DiscoveryCacheStats._evictions, 1)
+
+    def test_cache_disabled(self):
+        service = self.service
+        service.DiscoveryCacheSize = 0
+        for _ in range(2):
+            service.ProcessAdvertisementPacket(_packet(_foreign_packet(1)))
+            service.ProcessAdvertisementPacket(_packet(BLE_MOPEKA_MFG))
+        self.assertEqual(service.DiscoveryCacheStats.HitRate, 0.0)
+        self.assertEqual(service.ServiceStats._ignored_ad_count, 2)
+        self.assertEqual(service.ServiceStats._processed_ad_count, 2)
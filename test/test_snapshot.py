@@ -0,0 +1,162 @@
+"""Service snapshot test
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import unittest
+import logging
+import os
+import tempfile
+import threading
+from types import SimpleNamespace
+from mopeka_pro_check.profiles import SensorProfile, WATER
+from mopeka_pro_check.advertisement import HardwareId
+from mopeka_pro_check.replay import MakeMopekaPacket
+from mopeka_pro_check.service import MopekaService
+from mopeka_pro_check.sensor import MopekaSensor
+from mopeka_pro_check.snapshot import (
+    LoadSnapshot,
+    RestoreService,
+    SaveSnapshot,
+    SnapshotService,
+    SNAPSHOT_MAGIC,
+)
+from mopeka_pro_check.tank import TANK_20LB_VERTICAL, TankGeometry, TankOrientation
+
+_LOGGER = logging.getLogger(__name__)
+
+MACS = ["E7:9D:05:C4:3C:%02X" % i for i in range(4)]
+
+
+def _packet(mac: str, level: int, button: bool = False, rssi: int = -70):
+    return SimpleNamespace(data=MakeMopekaPacket(mac, raw_level=level, button=button, rssi=rssi))
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = [1000.0]
+        self.service = MopekaService()
+        self.service.Clock = lambda: self.now[0]
+        custom = SensorProfile("custom", HardwareId.STD_BOTTOM_UP_PROPANE, (0.5, 0.001, 0.0), thermal_expansion=0.001)
+        tank = TankGeometry("custom", TankOrientation.HORIZONTAL, 500, 100.0)
+        self.sensors = [
+            MopekaSensor(MACS[0], tank=TANK_20LB_VERTICAL),
+            MopekaSensor(MACS[1], history_size=3, profile=WATER),
+            MopekaSensor(MACS[2], profile=custom, tank=tank),
+        ]
+        self.sensors[1].StaleTimeout = 30.0
+        self.sensors[2].Forecast = None
+        self.sensors[2].Health = None
+        self.service.AddSensorsToMonitor(self.sensors)
+        for m in range(5):
+            self.now[0] = 1000.0 + m * 60
+            for i, mac in enumerate(MACS[:3]):
+                self.service.ProcessAdvertisementPacket(_packet(mac, 2000 - m * 10 - i))
+
+    def _restore(self, data, now=5000.0):
+        service = MopekaService()
+        service.Clock = lambda: now
+        count = RestoreService(service, data)
+        return service, count
+
+    def test_round_trip(self):
+        data = SnapshotService(self.service)
+        self.assertTrue(data.startswith(SNAPSHOT_MAGIC))
+        service, count = self._restore(data)
+        self.assertEqual(count, 3)
+        restored = {s._mac: s for s in service.SensorMonitoredList.values()}
+        self.assertEqual(sorted(restored), MACS[:3])
+        for old in self.sensors:
+            new = restored[old._mac]
+            self.assertEqual(new.Profile is None, old.Profile is None)
+            self.assertEqual(new.StaleTimeout, old.StaleTimeout)
+            reading = new.GetReading()
+            self.assertEqual(reading.TankLevelInMM, old._last_reading.TankLevelInMM)
+            self.assertEqual(reading.rssi, -70)
+            self.assertEqual(len(new.History), len(old.History))
+            self.assertEqual(
+                [h[1:] for h in new.History.GetLast(10)],
+                [h[1:] for h in old.History.GetLast(10)])
+        self.assertIs(restored[MACS[0]].Tank, TANK_20LB_VERTICAL)
+        self.assertIs(restored[MACS[1]].Profile, WATER)
+        self.assertEqual(restored[MACS[2]].Tank.HeightInMM, 500)
+        self.assertEqual(restored[MACS[2]].Profile.Coefficients, (0.5, 0.001, 0.0))
+        self.assertIsNone(restored[MACS[2]].Forecast)
+        self.assertIsNone(restored[MACS[2]].Health)
+        self.assertEqual(service.ServiceStats._processed_ad_count, 15)
+
+    def test_health_and_forecast(self):
+        old = self.sensors[0]
+        service, _ = self._restore(SnapshotService(self.service))
+        new = next(s for s in service.SensorMonitoredList.values() if s._mac == MACS[0])
+        self.assertEqual(new.Health.Snapshot()["count"], old.Health.Count)
+        self.assertAlmostEqual(new.Health.Score(), old.Health.Score())
+        self.assertAlmostEqual(new.Forecast.UsageRate, old.Forecast.UsageRate)
+        self.assertAlmostEqual(new.Forecast.LevelInMM, old.Forecast.LevelInMM)
+        self.assertEqual(service.GetSoonestEmpty(1)[0][1], new)
+
+    def test_forecast_index_locked(self):
+        data = SnapshotService(self.service)
+        service = MopekaService()
+        # a GetSoonestEmpty caller holds the index
+        with service._forecast_lock:
+            t = threading.Thread(target=RestoreService, args=(service, data), daemon=True)
+            t.start()
+            t.join(0.2)
+            self.assertTrue(t.is_alive())
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(len(service.GetSoonestEmpty(10)), 2)
+
+    def test_time_shift(self):
+        # snapshot taken at clock 1240, restored in a process whose clock reads 5000
+        service, _ = self._restore(SnapshotService(self.service), now=5000.0)
+        new = next(s for s in service.SensorMonitoredList.values() if s._mac == MACS[0])
+        self.assertAlmostEqual(new.LastSeen, 5000.0, delta=1.0)
+        times = [h.timestamp for h in new.History.GetLast(10)]
+        self.assertAlmostEqual(times[-1] - times[0], 240.0)
+        self.assertAlmostEqual(new.Forecast.LastUpdate, new.LastSeen)
+
+    def test_discovered(self):
+        service = MopekaService()
+        service.SetHostControllerIndex(0)
+        service._scanning_mode = service._scanning_mode.__class__.DISCOVERY_MODE
+        service.ProcessAdvertisementPacket(_packet(MACS[3], 500, button=True))
+        self.assertEqual(len(service.SensorDiscoveredList), 1)
+        restored, count = self._restore(SnapshotService(service))
+        self.assertEqual(count, 1)
+        self.assertEqual([s._mac for s in restored.SensorDiscoveredList.values()], [MACS[3]])
+        self.assertIn(MopekaSensor(MACS[3])._raw_mac, restored._discovered_by_raw_mac)
+        self.assertEqual(restored.SensorMonitoredList, {})
+
+    def test_restored_sensor_keeps_working(self):
+        service, _ = self._restore(SnapshotService(self.service))
+        service.ProcessAdvertisementPacket(_packet(MACS[0], 1500))
+        new = next(s for s in service.SensorMonitoredList.values() if s._mac == MACS[0])
+        self.assertEqual(new.GetReading()._raw_tank_level, 1500)
+        self.assertEqual(len(new.History), 6)
+
+    def test_bad_data(self):
+        with self.assertRaises(ValueError):
+            self._restore(b"garbage")
+        data = SnapshotService(self.service)
+        with self.assertRaises(ValueError):
+            self._restore(data[:-5])
+        newer = data[:8] + b"\x63\x00" + data[10:]
+        with self.assertRaises(ValueError):
+            self._restore(newer)
+
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "state.bin")
+            SaveSnapshot(self.service, path)
+            service = MopekaService()
+            self.assertEqual(LoadSnapshot(service, path), 3)
+            self.assertFalse(os.path.exists(path + ".tmp"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+"""Persistent reading store test
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import unittest
+import logging
+import os
+import tempfile
+from mopeka_pro_check.storage import ReadingStore, STORE_MAGIC, RECORD_SIZE
+from mopeka_pro_check.advertisement import MopekaAdvertisement, MacToRaw
+from mopeka_pro_check.replay import MakeMopekaPacket, ReplayPacket
+from mopeka_pro_check.service import MopekaService
+from mopeka_pro_check.sensor import MopekaSensor
+
+
+BLE_MOPEKA_MAC = "E7:9D:05:C4:3C:76"
+OTHER_MAC = "E7:9D:05:C4:3C:77"
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class ReadingStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(self.path)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _fill(self, store, count=10):
+        for i in range(count):
+            mac = BLE_MOPEKA_MAC if i % 2 == 0 else OTHER_MAC
+            ma = MopekaAdvertisement(MakeMopekaPacket(mac, raw_level=i, rssi=-50 - i))
+            store.Append(MacToRaw(mac), ma._raw_mfg_data, ma.rssi, timestamp=1000.0 + i)
+
+    def test_round_trip(self):
+        with ReadingStore(self.path) as store:
+            self._fill(store)
+        readings = ReadingStore.Query(self.path)
+        self.assertEqual(len(readings), 10)
+        self.assertEqual(readings[3].mac, OTHER_MAC)
+        self.assertEqual(readings[3].timestamp, 1003.0)
+        self.assertEqual(readings[3].rssi, -53)
+        self.assertEqual(len(readings[3].mfg_data), 13)
+        self.assertEqual(os.path.getsize(self.path), len(STORE_MAGIC) + 10 * RECORD_SIZE)
+
+    def test_range_and_mac_query(self):
+        with ReadingStore(self.path) as store:
+            self._fill(store)
+        readings = ReadingStore.Query(self.path, mac=BLE_MOPEKA_MAC, start=1002.0, end=1008.0)
+        self.assertEqual([r.timestamp for r in readings], [1002.0, 1004.0, 1006.0])
+        self.assertEqual(ReadingStore.Query(self.path, start=2000.0), [])
+
+    def test_query_payloads(self):
+        with ReadingStore(self.path) as store:
+            self._fill(store, 4)
+        timestamps, payloads = ReadingStore.QueryPayloads(self.path, mac=OTHER_MAC)
+        self.assertEqual(timestamps, [1001.0, 1003.0])
+        self.assertEqual(len(payloads), 26)
+
+    def test_reopen_appends_and_drops_partial_record(self):
+        with ReadingStore(self.path) as store:
+            self._fill(store, 2)
+        with open(self.path, "ab") as f:
+            f.write(b"\x00" * 5)  # torn write
+        with ReadingStore(self.path) as store:
+            self._fill(store, 2)
+        self.assertEqual(len(ReadingStore.Query(self.path)), 4)
+
+    def test_clock_step_back_keeps_order(self):
+        raw = MacToRaw(BLE_MOPEKA_MAC)
+        ma = MopekaAdvertisement(MakeMopekaPacket(BLE_MOPEKA_MAC))
+        with ReadingStore(self.path) as store:
+            for t in (1000.0, 1005.0, 1002.0, 1006.0):
+                store.Append(raw, ma._raw_mfg_data, ma.rssi, timestamp=t)
+        # a new store continues from the last record in the file
+        with ReadingStore(self.path) as store:
+            store.Append(raw, ma._raw_mfg_data, ma.rssi, timestamp=900.0)
+        readings = ReadingStore.Query(self.path)
+        self.assertEqual([r.timestamp for r in readings], [1000.0, 1005.0, 1005.0, 1006.0, 1006.0])
+        ranged = ReadingStore.Query(self.path, start=1005.0, end=1006.0)
+        self.assertEqual([r.timestamp for r in ranged], [1005.0, 1005.0])
+
+    def test_rssi_not_available_and_bad_record(self):
+        raw = MacToRaw(BLE_MOPEKA_MAC)
+        ma = MopekaAdvertisement(MakeMopekaPacket(BLE_MOPEKA_MAC))
+        with ReadingStore(self.path) as store:
+            store.Append(raw, ma._raw_mfg_data, None, timestamp=1000.0)
+            # logged and skipped, the writer keeps going
+            with self.assertLogs("mopeka_pro_check.storage", logging.ERROR):
+                store.Append(raw, ma._raw_mfg_data, 500, timestamp=1001.0)
+                self.assertTrue(store.Flush())
+            store.Append(raw, ma._raw_mfg_data, -60, timestamp=1002.0)
+        readings = ReadingStore.Query(self.path)
+        self.assertEqual([(r.timestamp, r.rssi) for r in readings], [(1000.0, None), (1002.0, -60)])
+
+    def test_not_a_store(self):
+        with open(self.path, "wb") as f:
+            f.write(b"something else")
+        with self.assertRaises(ValueError):
+            ReadingStore(self.path)
+
+    def test_full_queue_drops(self):
+        with ReadingStore(self.path, queue_size=2, flush_interval=60) as store:
+            self._fill(store, 5)
+            self.assertEqual(store.DroppedCount, 3)
+
+    def test_service_callback_and_flush(self):
+        service = MopekaService()
+        service.AddSensorToMonitor(MopekaSensor(BLE_MOPEKA_MAC))
+        with ReadingStore(self.path, flush_interval=60) as store:
+            service.AddReadingCallback(store.OnReading)
+            service.ProcessAdvertisementPacket(ReplayPacket(MakeMopekaPacket(BLE_MOPEKA_MAC)))
+            self.assertTrue(store.Flush())
+            readings = ReadingStore.Query(self.path)
+        self.assertEqual(len(readings), 1)
+        self.assertEqual(readings[0].mac, BLE_MOPEKA_MAC)
@@ -0,0 +1,178 @@
+"""Batched reading subscriptions test
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import unittest
+import logging
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+from mopeka_pro_check.advertisement import HardwareId
+from mopeka_pro_check.replay import MakeMopekaPacket
+from mopeka_pro_check.service import MopekaService, ChangeThreshold
+from mopeka_pro_check.sensor import MopekaSensor
+from mopeka_pro_check.subscriptions import Subscription
+
+_LOGGER = logging.getLogger(__name__)
+
+MACS = ["E7:9D:05:C4:3C:%02X" % i for i in range(3)]
+
+
+def _packet(mac: str, level: int):
+    return SimpleNamespace(data=MakeMopekaPacket(mac, raw_level=level))
+
+
+class Collector(object):
+
+    def __init__(self, delay: float = 0.0):
+        self.batches = []
+        self.delay = delay
+        self.event = threading.Event()
+
+    def __call__(self, batch):
+        if self.delay:
+            time.sleep(self.delay)
+        self.batches.append(batch)
+        self.event.set()
+
+    @property
+    def macs(self):
+        return [sensor._mac for batch in self.batches for sensor, _ in batch]
+
+
+class SubscriptionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.service = MopekaService()
+        self.service.AddSensorsToMonitor(MopekaSensor(m) for m in MACS)
+
+    def _send(self, mac: str, count: int, start: int = 100):
+        for i in range(count):
+            self.service.ProcessAdvertisementPacket(_packet(mac, start + i * 50))
+
+    def test_batch_by_count(self):
+        c = Collector()
+        sub = self.service.Subscribe(c, batch_size=4, flush_interval=60)
+        self._send(MACS[0], 4)
+        self.assertTrue(c.event.wait(5))
+        self.assertEqual(len(c.batches[0]), 4)
+        self.service.Unsubscribe(sub)
+        self.assertEqual(sub.DeliveredCount, 4)
+
+    def test_flush_by_time(self):
+        c = Collector()
+        sub = self.service.Subscribe(c, batch_size=100, flush_interval=0.05)
+        self._send(MACS[0], 2)
+        self.assertTrue(c.event.wait(5))
+        self.assertEqual(len(c.batches[0]), 2)
+        self.service.Unsubscribe(sub)
+
+    def test_mac_filter(self):
+        c = Collector()
+        sub = self.service.Subscribe(c, macs=[MACS[1]], batch_size=100, flush_interval=60)
+        self._send(MACS[0], 3)
+        self._send(MACS[1], 2)
+        self.service.Unsubscribe(sub)
+        self.assertEqual(c.macs, [MACS[1]] * 2)
+
+    def test_hardware_filter(self):
+        c = Collector()
+        sub = self.service.Subscribe(c, hardware_ids=[HardwareId.BOTTOM_UP_WATER], batch_size=100, flush_interval=60)
+        self._send(MACS[0], 3)
+        self.service.Unsubscribe(sub)
+        self.assertEqual(c.batches, [])
+
+    def test_change_threshold(self):
+        c = Collector()
+        sub = self.service.Subscribe(
+            c, change_threshold=ChangeThreshold(TankLevelInMM=50, TemperatureInCelsius=None, BatteryPercent=None), batch_size=100, flush_interval=60)
+        # 0x12C and 0x12D are within 1mm of each other
+        for level in (0x12C, 0x12D, 0x12C, 0x1F4):
+            self.service.ProcessAdvertisementPacket(_packet(MACS[0], level))
+        self.service.Unsubscribe(sub)
+        self.assertEqual(len(c.macs), 2)
+
+    def test_queue_drops_oldest(self):
+        c = Collector()
+        sub = self.service.Subscribe(c, batch_size=100, flush_interval=60, queue_size=3)
+        self._send(MACS[0], 5)
+        self.assertEqual(sub.DroppedCount, 2)
+        self.service.Unsubscribe(sub)
+        levels = [reading._raw_tank_level for batch in c.batches for _, reading in batch]
+        self.assertEqual(levels, [200, 250, 300])
+
+    def test_slow_subscriber_does_not_block(self):
+        release = threading.Event()
+        entered = threading.Event()
+
+        def slow(batch):
+            entered.set()
+            release.wait(5)
+        sub = self.service.Subscribe(slow, batch_size=1, flush_interval=60, queue_size=4)
+        self._send(MACS[0], 1)
+        self.assertTrue(entered.wait(5))
+        # dispatcher is stuck in the callback.  scanning keeps going and the
+        # queue drops the oldest readings
+        start = time.monotonic()
+        self._send(MACS[0], 10, start=1000)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(sub.DroppedCount, 6)
+        release.set()
+        self.service.Unsubscribe(sub)
+        self.assertEqual(sub.DeliveredCount, 5)
+
+    def test_callback_exception(self):
+        def bad(batch):
+            raise RuntimeError("subscriber bug")
+        c = Collector()
+        bad_sub = self.service.Subscribe(bad, batch_size=1, flush_interval=60)
+        sub = self.service.Subscribe(c, batch_size=1, flush_interval=60)
+        self._send(MACS[0], 1)
+        self.assertTrue(c.event.wait(5))
+        self.service.Unsubscribe(bad_sub)
+        self.service.Unsubscribe(sub)
+        self.assertEqual(bad_sub.DeliveredCount, 1)
+
+    def test_unsubscribe_stops_delivery(self):
+        c = Collector()
+        sub = self.service.Subscribe(c, batch_size=100, flush_interval=60)
+        self.service.Unsubscribe(sub)
+        self._send(MACS[0], 3)
+        self.assertEqual(c.batches, [])
+        self.assertEqual(len(sub), 0)
+
+    def test_offer_while_flushing(self):
+        sub = Subscription(Collector(), batch_size=100, flush_interval=60)
+        woke = []
+        threads = []
+
+        class Queue(deque):
+            """ a reading arrives from the scanning thread right after Flush
+            has seen the queue empty for the second time """
+            empty_checks = 0
+
+            def __len__(self):
+                n = deque.__len__(self)
+                if n == 0:
+                    Queue.empty_checks += 1
+                    if Queue.empty_checks == 2:
+                        t = threading.Thread(target=lambda: woke.append(sub._offer((None, None), time.monotonic())))
+                        t.start()
+                        t.join(0.2)
+                        threads.append(t)
+                return n
+        sub._queue = Queue(maxlen=10)
+        sub._offer((None, None), time.monotonic())
+        sub.Flush()
+        threads[0].join(5)
+        self.assertEqual(len(sub), 1)
+        # the reading is not stranded: the dispatcher was woken and will flush it
+        self.assertEqual(woke, [True])
+        self.assertIsNotNone(sub._due(time.monotonic()))
+
+if __name__ == '__main__':
+    unittest.main()
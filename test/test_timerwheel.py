@@ -0,0 +1,179 @@
+"""Timer wheel and stale sensor detection test
+
+Copyright (c) 2021 Sean Brogan
+
+SPDX-License-Identifier: MIT
+
+"""
+import unittest
+import logging
+import threading
+from types import SimpleNamespace
+from mopeka_pro_check.timerwheel import TimerWheel
+from mopeka_pro_check.replay import MakeMopekaPacket
+from mopeka_pro_check.service import MopekaService
+from mopeka_pro_check.sensor import MopekaSensor
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def test_expiry(self):
+        w = TimerWheel(1.0, 8, now=0.0)
+        w.Schedule("a", 2.5)
+        w.Schedule("b", 20.2)  # more than one rotation out
+        w.Schedule("c", 0.1)
+        self.assertEqual(len(w), 3)
+        self.assertEqual(w.Advance(0.9), [])
+        self.assertEqual(w.Advance(1.0), ["c"])
+        self.assertEqual(w.Advance(3.0), ["a"])
+        self.assertEqual(w.Advance(19.9), [])
+        self.assertEqual(w.Advance(21.0), ["b"])
+        self.assertEqual(len(w), 0)
+
+    def test_cancel_and_reschedule(self):
+        w = TimerWheel(1.0, 8)
+        w.Schedule("a", 2.0)
+        w.Schedule("a", 5.0)
+        self.assertEqual(len(w), 1)
+        self.assertEqual(w.Advance(4.0), [])
+        self.assertEqual(w.Cancel("a"), 5.0)
+        self.assertIsNone(w.Cancel("a"))
+        self.assertNotIn("a", w)
+        self.assertEqual(w.Advance(10.0), [])
+
+    def test_past_deadline(self):
+        w = TimerWheel(1.0, 8, now=5.0)
+        w.Schedule("late", 1.0)
+        self.assertEqual(w.Advance(6.0), ["late"])
+
+    def test_large_jump(self):
+        w = TimerWheel(1.0, 4)
+        for i in range(10):
+            w.Schedule(i, float(i))
+        self.assertEqual(sorted(w.Advance(100.0)), list(range(10)))
+
+
+def _packet(mac: str, level: int = 0x12C):
+    return SimpleNamespace(data=MakeMopekaPacket(mac, raw_level=level))
+
+
+class StaleSensorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.service = MopekaService()
+        self.service.Clock = lambda: self.now
+        self.macs = ["E7:9D:05:C4:3C:%02X" % i for i in range(3)]
+        self.sensors = [MopekaSensor(m) for m in self.macs]
+        self.service.AddSensorsToMonitor(self.sensors)
+        self.offline = []
+        self.online = []
+        self.service.AddOfflineCallback(self.offline.append)
+        self.service.AddOnlineCallback(self.online.append)
+        self.service.EnableStaleDetection(10.0)
+
+    def test_offline_and_online(self):
+        s0, s1, s2 = self.sensors
+        for t in range(0, 30, 2):
+            self.now = float(t)
+            self.service.ProcessAdvertisementPacket(_packet(self.macs[0]))
+            if t < 6:
+                self.service.ProcessAdvertisementPacket(_packet(self.macs[1], t))
+            self.service.CheckStaleSensors()
+        # s2 never heard, s1 silent since t=4
+        self.assertEqual(self.offline, [s2, s1])
+        self.assertTrue(s1.Offline)
+        self.assertFalse(s0.Offline)
+        self.assertEqual(s0.LastSeen, 28.0)
+
+        self.service.ProcessAdvertisementPacket(_packet(self.macs[1], 99))
+        self.assertEqual(self.online, [s1])
+        self.assertFalse(s1.Offline)
+        # repeated payloads count as advertisements too
+        self.now = 35.0
+        self.service.ProcessAdvertisementPacket(_packet(self.macs[1], 99))
+        self.now = 44.0
+        self.assertEqual(self.service.CheckStaleSensors(), [s0])
+        self.now = 46.0
+        self.assertEqual(self.service.CheckStaleSensors(), [s1])
+
+    def test_per_sensor_timeout(self):
+        self.sensors[0].StaleTimeout = 100.0
+        self.service.EnableStaleDetection(10.0)
+        self.now = 20.0
+        self.assertEqual(set(self.service.CheckStaleSensors()), set(self.sensors[1:]))
+
+    def test_removed_sensor_not_reported(self):
+        self.service.RemoveSensorToMonitor(self.sensors[2])
+        self.now = 20.0
+        self.assertEqual(set(self.service.CheckStaleSensors()), set(self.sensors[:2]))
+
+    def test_added_sensor_scheduled(self):
+        self.now = 5.0
+        late = MopekaSensor("E7:9D:05:C4:3C:99")
+        self.service.AddSensorToMonitor(late)
+        self.now = 12.0
+        self.assertNotIn(late, self.service.CheckStaleSensors())
+        self.now = 16.0
+        self.assertEqual(self.service.CheckStaleSensors(), [late])
+
+    def test_callbacks_can_change_sensors(self):
+        self.service.AddOfflineCallback(self.service.RemoveSensorToMonitor)
+        self.service.AddOnlineCallback(lambda sensor: self.service.AddSensorToMonitor(MopekaSensor("E7:9D:05:C4:3C:99")))
+        self.now = 20.0
+        # a deadlock would hang the checking thread, not the test
+        t = threading.Thread(target=self.service.CheckStaleSensors, daemon=True)
+        t.start()
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(len(self.service.SensorMonitoredList), 0)
+
+        self.service.AddSensorToMonitor(self.sensors[0])
+        self.sensors[0].Offline = True
+        t = threading.Thread(target=self.service.ProcessAdvertisementPacket, args=(_packet(self.macs[0]),), daemon=True)
+        t.start()
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(self.online, [self.sensors[0]])
+        self.assertEqual(len(self.service.SensorMonitoredList), 2)
+
+    def test_reading_callbacks_can_change_sensors(self):
+        self.service.AddReadingCallback(lambda sensor, reading: self.service.RemoveSensorToMonitor(sensor))
+        t = threading.Thread(target=self.service.ProcessAdvertisementPacket, args=(_packet(self.macs[0]),), daemon=True)
+        t.start()
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(len(self.service.SensorMonitoredList), 2)
+
+        found = MopekaSensor(self.macs[0])
+        self.service.DoSensorDiscovery()
+        self.service.AddDiscoveryCallback(self.service.AddSensorToMonitor)
+        data = MakeMopekaPacket(self.macs[0], button=True)
+        t = threading.Thread(target=self.service.ProcessAdvertisementPacket, args=(SimpleNamespace(data=data),), daemon=True)
+        t.start()
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(len(self.service.SensorMonitoredList), 3)
+        self.assertIn(found._raw_mac, self.service._monitored_by_raw_mac)
+
+    def test_disable(self):
+        self.service.EnableStaleDetection(None)
+        self.now = 100.0
+        self.assertEqual(self.service.CheckStaleSensors(), [])
+
+    def test_thread_while_scanning(self):
+        provider = SimpleNamespace(get_adapter=lambda index: SimpleNamespace(
+            start_scanning=lambda: None, stop_scanning=lambda: None))
+        service = MopekaService(provider)
+        service.AddSensorToMonitor(MopekaSensor(self.macs[0]))
+        went_offline = threading.Event()
+        service.AddOfflineCallback(lambda sensor: went_offline.set())
+        service.EnableStaleDetection(0.05, tick=0.01)
+        service.Start()
+        try:
+            self.assertTrue(went_offline.wait(5.0))
+        finally:
+            service.Stop()
+        self.assertIsNone(service._stale_thread)